@@ -9,6 +9,7 @@ setup(
         "streamlit",
         "folium",
         "pandas",
+        "pyarrow",
         "streamlit-folium"
     ],
 )
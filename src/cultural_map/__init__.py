@@ -1,6 +1,14 @@
 """Cultural Map application package."""
 
-from .core import main
-
 __version__ = "0.1.0"
 __all__ = ["main"]
+
+
+def __getattr__(name):
+    # The application, and Streamlit with it, is only imported when used, so
+    # that the data preparation modules start fast
+    if name == "main":
+        from .core import main
+
+        return main
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
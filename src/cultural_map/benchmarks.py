@@ -0,0 +1,995 @@
+"""Benchmarks for the performance-sensitive parts of the cultural map.
+
+Run with ``python -m cultural_map.benchmarks <name>`` from the ``src`` directory,
+or with ``PYTHONPATH=src`` from the repository root for the benchmarks reading
+the files of ``data/``.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import branca
+import folium
+import numpy as np
+import pandas as pd
+from folium import plugins
+
+from .components.layers import (
+    DensityCircleLayer,
+    EquipmentLayer,
+    build_density_circles,
+    build_marker_payload,
+    to_js_payload,
+)
+from .components.map import (
+    DEFAULT_STYLE,
+    TYPE_STYLES,
+    build_static_layers,
+    create_equipment_layers,
+    create_map,
+)
+from .config.settings import ACCESSIBILITY_CONFIG
+from .data.clustering import build_cluster_index
+from .data.communes import MISSING_KEY, insee_keys
+from .data.convert_coordinates import convert_coordinates
+from .data.database import build_database, open_database, select_rows
+from .data import accessibility, columnar, osm, sirene
+from .data.columnar import (
+    CULTURAL_SCHEMA,
+    DENSITY_SCORE_SCHEMA,
+    HEATMAP_SCHEMA,
+    read_table,
+    write_table,
+)
+from .data.commune_search import CommuneSearchIndex, normalize
+from .data.density_raster import colormap, density_scale, density_tiles, write_png
+from .data.filter_index import FilterIndex
+from .data.loader import (
+    DENSITY_CIRCLE_COLUMNS,
+    MAP_COLUMNS,
+    VISUALISATION_COLUMNS,
+    filter_data,
+    get_unique_values,
+)
+from .data.scoring import ScoreEngine, ScoreParameters
+from .data.spatial_index import GridIndex, haversine_km
+
+
+def synthetic_cultural_data(n_rows, n_communes=35_000, seed=0):
+    """
+    Generate a DataFrame shaped like data/cultural_data.csv.
+
+    Args:
+        n_rows (int): Number of equipments
+        n_communes (int): Number of distinct communes
+        seed (int): Random seed
+
+    Returns:
+        pd.DataFrame: Synthetic equipments spread over metropolitan France
+    """
+    rng = np.random.default_rng(seed)
+    types = np.array(list(TYPE_STYLES))
+    categories = np.array(["patrimoine", "vivant"])
+    commune_ids = rng.integers(0, n_communes, n_rows)
+    commune_lat = rng.uniform(42.5, 51.0, n_communes)
+    commune_lon = rng.uniform(-4.5, 8.0, n_communes)
+    commune_pop = rng.lognormal(6.5, 1.3, n_communes).round()
+    commune_density = rng.gamma(1.5, 2.0, n_communes)
+    return pd.DataFrame(
+        {
+            "commune_key": (commune_ids % 95_000 + 1000).astype("int32"),
+            "nom_commune": pd.Series(commune_ids).map("Commune {}".format),
+            "code_postal": pd.Series(commune_ids % 95_000 + 1000).astype(str),
+            "type_infrastructure": types[rng.integers(0, len(types), n_rows)],
+            "nom_infrastructure": pd.Series(np.arange(n_rows)).map("Équipement {}".format),
+            "latitude": commune_lat[commune_ids] + rng.normal(0, 0.01, n_rows),
+            "longitude": commune_lon[commune_ids] + rng.normal(0, 0.01, n_rows),
+            "population": commune_pop[commune_ids],
+            "categorie": categories[rng.integers(0, 2, n_rows)],
+            "cultural_density": commune_density[commune_ids],
+        }
+    )
+
+
+def _legacy_marker_layer(data):
+    """Per-row CircleMarker construction, as create_map used to do it."""
+    marker_cluster = plugins.MarkerCluster(name="Équipements culturels")
+    for _, row in data.iterrows():
+        style = TYPE_STYLES.get(row["type_infrastructure"], DEFAULT_STYLE)
+        population = f"{int(row['population']):,}".replace(",", " ")
+        density = f"{row['cultural_density']:.1f}"
+        tooltip_content = f"""
+        <div style="text-align: center;">
+            <strong>{row['nom_infrastructure']}</strong><br>
+            Type: {row['type_infrastructure']}<br>
+            Commune: {row['nom_commune']}<br>
+            Population: {population} habitants<br>
+            Équipements culturels pour 1000 hab.: {density}<br>
+            Code INSEE: {row['code_postal']}
+        </div>
+        """
+        folium.CircleMarker(
+            location=[row["latitude"], row["longitude"]],
+            radius=style["radius"],
+            color=style["color"],
+            fill=True,
+            fillColor=style["color"],
+            fillOpacity=0.6,
+            weight=1,
+            opacity=0.8,
+            tooltip=tooltip_content,
+        ).add_to(marker_cluster)
+    return marker_cluster
+
+
+def _render_layer(build_layer, data):
+    """Build a layer on an empty map and render it, returning (seconds, html)."""
+    start = time.perf_counter()
+    m = folium.Map(location=[46.5, 2.5], zoom_start=6, prefer_canvas=True)
+    build_layer(data).add_to(m)
+    html = m.get_root().render()
+    return time.perf_counter() - start, html
+
+
+def _time_layer_build(build_layer, data):
+    """Build a layer on an empty map and render it, returning (seconds, bytes)."""
+    seconds, html = _render_layer(build_layer, data)
+    return seconds, len(html.encode("utf-8"))
+
+
+_NODE_PARSE_SCRIPT = """
+const html = require("fs").readFileSync(process.argv[1], "utf8");
+const scripts = [...html.matchAll(/<script>([\\s\\S]*?)<\\/script>/g)].map(m => m[1]);
+const timings = [];
+for (let run = 0; run < 5; run++) {
+    const start = process.hrtime.bigint();
+    scripts.forEach(script => new Function(script));
+    timings.push(Number(process.hrtime.bigint() - start) / 1e6);
+}
+console.log(timings.sort((a, b) => a - b)[2]);
+"""
+
+
+def _node_parse_ms(html):
+    """Median time for node to parse the inline scripts of a page, or None without node."""
+    if shutil.which("node") is None:
+        return None
+    with tempfile.NamedTemporaryFile("w", suffix=".html", encoding="utf-8", delete=False) as f:
+        f.write(html)
+    try:
+        result = subprocess.run(
+            ["node", "-e", _NODE_PARSE_SCRIPT, f.name], capture_output=True, text=True, check=True
+        )
+    finally:
+        os.remove(f.name)
+    return float(result.stdout)
+
+
+def benchmark_marker_layer(sizes=(10_000, 100_000, 1_000_000), legacy_limit=10_000):
+    """Compare the columnar equipment layer with per-row CircleMarker objects."""
+    print(f"{'rows':>10} {'builder':>10} {'seconds':>10} {'html MB':>10}")
+    for size in sizes:
+        data = synthetic_cultural_data(size)
+        builders = {
+            "columnar": lambda d: EquipmentLayer(d, TYPE_STYLES, DEFAULT_STYLE)
+        }
+        if size <= legacy_limit:
+            builders["per-row"] = _legacy_marker_layer
+        for label, build_layer in builders.items():
+            seconds, size_bytes = _time_layer_build(build_layer, data)
+            print(f"{size:>10} {label:>10} {seconds:>10.2f} {size_bytes / 1e6:>10.1f}")
+
+
+def _median_ms(func, repeat=50):
+    """Median wall time of `func()` in milliseconds."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return float(np.median(timings)) * 1e3
+
+
+def benchmark_bbox_query(n_points=1_000_000):
+    """Time viewport bounding-box queries against the grid index."""
+    data = synthetic_cultural_data(n_points)
+    start = time.perf_counter()
+    index = GridIndex(data["latitude"], data["longitude"])
+    print(f"index build: {time.perf_counter() - start:.2f} s for {n_points} points")
+    boxes = {
+        "city (zoom 13)": (48.70, 2.10, 49.00, 2.60),
+        "department (zoom 9)": (44.80, 3.80, 46.20, 5.60),
+        "region (zoom 7)": (43.00, 0.00, 46.50, 5.00),
+    }
+    print(f"{'box':>20} {'points':>10} {'median ms':>10}")
+    for label, box in boxes.items():
+        found = len(index.query_bbox(*box))
+        print(f"{label:>20} {found:>10} {_median_ms(lambda: index.query_bbox(*box)):>10.2f}")
+
+
+def benchmark_radius_query(n_points=1_000_000, n_centers=10_000, radius_km=15, k=10):
+    """Time batched radius and nearest-neighbour queries against a brute-force scan."""
+    data = synthetic_cultural_data(n_points)
+    index = GridIndex(data["latitude"], data["longitude"])
+    rng = np.random.default_rng(1)
+    latitudes = rng.uniform(42.5, 51.0, n_centers)
+    longitudes = rng.uniform(-4.5, 8.0, n_centers)
+    print(f"{n_points} points, {n_centers} centers")
+
+    start = time.perf_counter()
+    for latitude, longitude in zip(latitudes[:100], longitudes[:100]):
+        np.flatnonzero(haversine_km(latitude, longitude, data["latitude"], data["longitude"]) <= radius_km)
+    print(f"brute force, {radius_km} km: {(time.perf_counter() - start) * n_centers / 100:.1f} s (extrapolated)")
+    for label, query in [
+        (f"radius {radius_km} km", lambda: index.query_radius_batch(latitudes, longitudes, radius_km)),
+        (
+            f"radius {radius_km} km, unsorted",
+            lambda: index.query_radius_batch(latitudes, longitudes, radius_km, sort=False),
+        ),
+        (f"{k} nearest", lambda: index.query_nearest_batch(latitudes, longitudes, k)),
+    ]:
+        start = time.perf_counter()
+        query()
+        print(f"{label}: {time.perf_counter() - start:.2f} s")
+    print(f"single radius query: {_median_ms(lambda: index.query_radius(48.85, 2.35, radius_km)):.2f} ms")
+
+
+def benchmark_accessibility(n_points=1_000_000, n_communes=35_000, jobs=None):
+    """Time the accessibility table of every commune and type."""
+    data = synthetic_cultural_data(n_points)
+    rng = np.random.default_rng(2)
+    communes = pd.DataFrame(
+        {
+            "commune_key": np.arange(n_communes, dtype="int32") + 1000,
+            "departement": (np.arange(n_communes) % 96).astype(str),
+            "latitude": rng.uniform(42.5, 51.0, n_communes),
+            "longitude": rng.uniform(-4.5, 8.0, n_communes),
+        }
+    )
+    radii_km = list(ACCESSIBILITY_CONFIG["RADII_KM"])
+    start = time.perf_counter()
+    table = accessibility.compute_accessibility(data, communes, radii_km, jobs)
+    seconds = time.perf_counter() - start
+    size = table.astype(accessibility.accessibility_schema(radii_km)).memory_usage(deep=True).sum()
+    print(
+        f"{n_communes} communes x {table['type_infrastructure'].nunique()} types over {n_points} equipments,"
+        f" {jobs or os.cpu_count()} workers: {seconds:.1f} s, {size / 1e6:.1f} MB"
+    )
+
+
+def benchmark_rerun(n_rows=2_000, n_communes=3):
+    """Time map creation and rendering on reruns, with and without the static layer cache."""
+    data = synthetic_cultural_data(n_rows)
+    communes = data["commune_key"].drop_duplicates().head(n_communes)
+    print(f"{'commune':>16} {'cache':>8} {'seconds':>10} {'html MB':>10}")
+    for commune in communes:
+        for label in ("cold", "warm"):
+            if label == "cold":
+                build_static_layers.clear()
+            start = time.perf_counter()
+            m = create_map(data, selected_commune=commune)
+            equipment, _ = create_equipment_layers(
+                data[data["commune_key"] == commune], selected_commune=commune
+            )
+            html = equipment.add_to(m).get_root().render()
+            seconds = time.perf_counter() - start
+            print(f"{commune:>16} {label:>8} {seconds:>10.2f} {len(html) / 1e6:>10.1f}")
+
+
+def benchmark_density_raster(n_points=35_000, zooms=range(5, 10), out_dir="/tmp"):
+    """Compare the rasterized density tiles with the Leaflet.heat payload."""
+    data = synthetic_cultural_data(n_points, n_communes=n_points)
+    columns = (
+        data["latitude"].to_numpy(),
+        data["longitude"].to_numpy(),
+        data["cultural_density"].to_numpy(),
+    )
+    heatmap = plugins.HeatMap(np.column_stack(columns).tolist())
+    _, heatmap_bytes = _time_layer_build(lambda _: heatmap, None)
+    print(f"HeatMap payload: {heatmap_bytes / 1e6:.1f} MB, density computed in the browser")
+    print(f"{'zoom':>6} {'tiles':>8} {'seconds':>10} {'PNG kB':>10} {'largest kB':>11}")
+    bounds = ((41.333, -4.833), (51.2, 9.833))
+    path = f"{out_dir}/density_tile.png"
+    for zoom in zooms:
+        start = time.perf_counter()
+        scale = density_scale(density_tiles(*columns, zoom, bounds))
+        sizes = []
+        for _, _, grid in density_tiles(*columns, zoom, bounds):
+            write_png(path, colormap(np.clip(grid / scale, 0.0, 1.0)))
+            sizes.append(os.path.getsize(path) / 1e3)
+        seconds = time.perf_counter() - start
+        print(f"{zoom:>6} {len(sizes):>8} {seconds:>10.2f} {sum(sizes):>10.0f} {max(sizes, default=0):>11.1f}")
+
+
+def synthetic_density_data(n_communes=22_000, seed=0):
+    """Generate a DataFrame shaped like Heatmap_Culture_with_score.csv."""
+    rng = np.random.default_rng(seed)
+    population = rng.lognormal(6.5, 1.3, n_communes).round()
+    facilities = rng.geometric(0.4, n_communes)
+    return pd.DataFrame(
+        {
+            "Commune": pd.Series(np.arange(n_communes)).map("Commune {}".format),
+            "latitude": rng.uniform(42.5, 51.0, n_communes),
+            "longitude": rng.uniform(-4.5, 8.0, n_communes),
+            "Population_Totale": population,
+            "nbr_total_culturel": facilities,
+            "Nbre culturels pour1000 habitants": facilities / population * 1000,
+        }
+    )
+
+
+def _density_colormap(data):
+    density = data["Nbre culturels pour1000 habitants"]
+    return branca.colormap.LinearColormap(
+        colors=["#0C0786", "#6A00A8", "#B12A90", "#E16462", "#FCA636", "#F0F921"],
+        vmin=density.min(),
+        vmax=density.max(),
+    )
+
+
+def _legacy_density_circles(data):
+    """Per-row folium.Circle construction, as create_map used to do it."""
+    colormap = _density_colormap(data)
+    scatter_group = folium.FeatureGroup(name="Densité culturelle (cercles)")
+    for _, row in data.iterrows():
+        facilities = row["nbr_total_culturel"]
+        density = row["Nbre culturels pour1000 habitants"]
+        radius = min(1000 + 300 * np.sqrt(facilities), 5000)
+        tooltip_content = f"""
+        <div style="text-align: center;">
+            <strong>{row['Commune']}</strong><br>
+            Population: {int(row['Population_Totale']):,} habitants<br>
+            Équipements culturels: {int(facilities)}<br>
+            Densité culturelle: {density:.2f} pour 1000 hab.
+        </div>
+        """
+        folium.Circle(
+            location=[row["latitude"], row["longitude"]],
+            radius=radius,
+            color=colormap(density),
+            fill=True,
+            fillColor=colormap(density),
+            fillOpacity=0.7,
+            weight=1,
+            opacity=0.8,
+            tooltip=tooltip_content,
+        ).add_to(scatter_group)
+    return scatter_group
+
+
+def benchmark_density_circles(n_communes=22_000):
+    """Compare the FeatureCollection density circles with per-row folium.Circle objects."""
+    data = synthetic_density_data(n_communes)
+    builders = {
+        "per-row": _legacy_density_circles,
+        "geojson": lambda d: DensityCircleLayer(build_density_circles(d, _density_colormap(d))),
+    }
+    print(f"{'builder':>10} {'seconds':>10} {'html MB':>10}")
+    for label, build_layer in builders.items():
+        seconds, size_bytes = _time_layer_build(build_layer, data)
+        print(f"{label:>10} {seconds:>10.2f} {size_bytes / 1e6:>10.1f}")
+
+
+def _per_row_tooltip_layer(data):
+    """Equipment layer repeating the commune fields on every equipment."""
+    layer = EquipmentLayer(data, TYPE_STYLES, DEFAULT_STYLE)
+    payload = build_marker_payload(data, TYPE_STYLES, DEFAULT_STYLE)
+    rows = payload.pop("commune")
+    communes = payload.pop("communes")
+    communes["commune"] = communes.pop("name")
+    payload.update({field: [values[row] for row in rows] for field, values in communes.items()})
+    layer.payload_js = to_js_payload(payload)
+    return layer
+
+
+def benchmark_tooltips(sizes=(10_000, 100_000), legacy_limit=10_000):
+    """Compare tooltip storage: HTML per marker, fields per marker, commune table."""
+    builders = {
+        "html": _legacy_marker_layer,
+        "fields": _per_row_tooltip_layer,
+        "table": lambda d: EquipmentLayer(d, TYPE_STYLES, DEFAULT_STYLE),
+    }
+    print(f"{'rows':>10} {'tooltips':>10} {'html MB':>10} {'parse ms':>10}")
+    for size in sizes:
+        data = synthetic_cultural_data(size)
+        for label, build_layer in builders.items():
+            if label == "html" and size > legacy_limit:
+                continue
+            _, html = _render_layer(build_layer, data)
+            parse_ms = _node_parse_ms(html)
+            parse = "n/a" if parse_ms is None else f"{parse_ms:.1f}"
+            print(f"{size:>10} {label:>10} {len(html.encode('utf-8')) / 1e6:>10.1f} {parse:>10}")
+
+
+def benchmark_filter_update(n_rows=5_000):
+    """Compare a full map rebuild with an incremental equipment update on filter toggles."""
+    data = synthetic_cultural_data(n_rows)
+    index = build_cluster_index(data, max_zoom=12)
+    types = list(TYPE_STYLES)
+    steps = [types, types[1:], types[2:], types[1:], types]
+    previous = None
+    print(f"{'types':>6} {'rebuild s':>10} {'rebuild kB':>11} {'update s':>10} {'update kB':>10}")
+    for selected_types in steps:
+        subset = data[data["type_infrastructure"].isin(selected_types)]
+
+        start = time.perf_counter()
+        m = create_map(data)
+        EquipmentLayer(
+            subset, TYPE_STYLES, DEFAULT_STYLE, cluster_index=index, selected_types=selected_types
+        ).add_to(m)
+        html = m.get_root().render()
+        rebuild_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        layer = EquipmentLayer(
+            subset,
+            TYPE_STYLES,
+            DEFAULT_STYLE,
+            cluster_index=index,
+            selected_types=selected_types,
+            cluster_url="clusters.json",
+            previous=previous,
+        )
+        update = layer._template.module.script(layer)
+        update_seconds = time.perf_counter() - start
+        previous = layer.state
+        print(
+            f"{len(selected_types):>6} {rebuild_seconds:>10.2f} {len(html.encode('utf-8')) / 1e3:>11.0f}"
+            f" {update_seconds:>10.3f} {len(update.encode('utf-8')) / 1e3:>10.1f}"
+        )
+
+
+_MEASURE_SCRIPT = """
+import json, os, sys, time
+arguments = json.loads(sys.argv[1])
+result = None
+{setup}
+
+def status(field):
+    with open("/proc/self/status") as f:
+        return next(int(line.split()[1]) for line in f if line.startswith(field))
+
+# Reset the peak RSS, which the process inherits from its parent
+with open("/proc/self/clear_refs", "w") as f:
+    f.write("5")
+baseline = status("VmRSS")
+start = time.perf_counter()
+{code}
+seconds = time.perf_counter() - start
+print(json.dumps([result, seconds, (status("VmHWM") - baseline) / 1024]))
+"""
+
+
+def _measure_in_subprocess(code, arguments=None, setup=""):
+    """
+    Run code in a fresh interpreter, timing it and measuring its peak RSS increase (Linux only).
+
+    The package is importable from the subprocess, which changes no state
+    of the benchmark process.
+
+    Args:
+        code (str): Statements to measure, which may set `result`
+        arguments: JSON-serializable value, available to the code as `arguments`
+        setup (str): Statements run before the measure, such as imports
+
+    Returns:
+        tuple: (result, seconds, peak RSS increase in MB)
+    """
+    src = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    script = _MEASURE_SCRIPT.replace("{setup}", setup.strip()).replace("{code}", code.strip())
+    completed = subprocess.run(
+        [sys.executable, "-c", script, json.dumps(arguments)],
+        capture_output=True,
+        text=True,
+        check=True,
+        env=dict(os.environ, PYTHONPATH=src),
+    )
+    # The last line, after anything the measured code prints
+    result, seconds, peak_mb = json.loads(completed.stdout.splitlines()[-1])
+    return result, seconds, peak_mb
+
+
+def _cold_load(path, columns=None, schema=None, **csv_options):
+    """Time a table load in a fresh interpreter and measure its peak RSS increase in MB (Linux only)."""
+    setup = """
+import importlib.util
+import pandas as pd
+import pyarrow.parquet
+module_path, path, columns, schema, options = arguments
+# Load the module alone, without the app the package imports
+spec = importlib.util.spec_from_file_location("columnar", module_path)
+columnar = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(columnar)
+"""
+    code = """
+if schema is None:
+    pd.read_csv(path, **options)
+else:
+    columnar.read_table(path, columns, schema, **options)
+"""
+    _, seconds, peak_mb = _measure_in_subprocess(
+        code, [columnar.__file__, path, columns, schema, csv_options], setup
+    )
+    return seconds, peak_mb
+
+
+def benchmark_storage(n_rows=200_000, n_communes=35_000):
+    """Compare cold loads of the CSV outputs with projected loads of the typed Parquet outputs."""
+    equipments = synthetic_cultural_data(n_rows, n_communes)
+    heatmap = synthetic_cultural_data(n_communes, n_communes)[list(HEATMAP_SCHEMA)]
+    scores = synthetic_density_data(n_communes)
+    score_schema = {column: DENSITY_SCORE_SCHEMA[column] for column in DENSITY_CIRCLE_COLUMNS}
+    datasets = [
+        ("map", equipments, CULTURAL_SCHEMA, MAP_COLUMNS, {}),
+        ("visualisation", equipments, CULTURAL_SCHEMA, VISUALISATION_COLUMNS, {}),
+        ("heatmap", heatmap, HEATMAP_SCHEMA, None, {}),
+        ("circles", scores, score_schema, DENSITY_CIRCLE_COLUMNS, {"sep": "\t"}),
+    ]
+    print(f"{'dataset':>14} {'format':>8} {'file MB':>8} {'seconds':>8} {'peak MB':>8}")
+    with tempfile.TemporaryDirectory() as directory:
+        for name, data, schema, columns, csv_options in datasets:
+            csv_path = os.path.join(directory, f"{name}.csv")
+            parquet_path = os.path.join(directory, f"{name}.parquet")
+            data.to_csv(csv_path, index=False, **csv_options)
+            write_table(data, parquet_path, schema)
+            runs = [
+                ("csv", csv_path, _cold_load(csv_path, **csv_options)),
+                ("parquet", parquet_path, _cold_load(parquet_path, columns, schema)),
+            ]
+            for label, path, (seconds, peak_mb) in runs:
+                size_mb = os.path.getsize(path) / 1e6
+                print(f"{name:>14} {label:>8} {size_mb:>8.1f} {seconds:>8.3f} {peak_mb:>8.1f}")
+
+
+def synthetic_pipeline_inputs(directory, n_rows, n_communes=35_000):
+    """Write synthetic Equipements_Communes.csv and Heatmap_Culture.csv files to data/results."""
+    equipments = synthetic_cultural_data(n_rows, n_communes)
+    communes = equipments.drop_duplicates("nom_commune")
+    results = os.path.join(directory, "data", "results")
+    os.makedirs(results, exist_ok=True)
+    pd.DataFrame(
+        {
+            "Nom_commune": equipments["nom_commune"],
+            "Code_insee": equipments["code_postal"],
+            "Type": equipments["type_infrastructure"],
+            "Nom_equipement": equipments["nom_infrastructure"],
+            "Population_totale": equipments["population"],
+            "Equipement_latitude": equipments["latitude"],
+            "Equipement_longitude": equipments["longitude"],
+            "Categorie": equipments["categorie"],
+        }
+    ).to_csv(os.path.join(results, "Equipements_Communes.csv"), sep=";", index=False)
+    pd.DataFrame(
+        {
+            "Commune": communes["nom_commune"].repeat(2),
+            "code_insee": communes["code_postal"].repeat(2),
+            "Region": "Région",
+            "Population_Totale": communes["population"].repeat(2),
+            "latitude": communes["latitude"].repeat(2),
+            "longitude": communes["longitude"].repeat(2),
+            "Nombre_categorie": np.tile([1, 2], len(communes)),
+        }
+    ).to_csv(os.path.join(results, "Heatmap_Culture.csv"), sep="\t", index=False)
+
+
+def benchmark_prepare(n_rows=1_000_000, chunk_sizes=(None, 200_000, 50_000)):
+    """Compare the in-memory and streaming modes of transform_data (Linux only)."""
+    setup = """
+directory, chunk_rows = arguments
+os.chdir(directory)
+from cultural_map.data.prepare_data import transform_data
+"""
+    print(f"{'chunk rows':>10} {'seconds':>8} {'rows/s':>10} {'peak MB':>8}")
+    with tempfile.TemporaryDirectory() as directory:
+        synthetic_pipeline_inputs(directory, n_rows)
+        for chunk_rows in chunk_sizes:
+            _, seconds, peak_mb = _measure_in_subprocess(
+                "transform_data(force=True, chunk_rows=chunk_rows)", [directory, chunk_rows], setup
+            )
+            label = "all" if chunk_rows is None else chunk_rows
+            print(f"{label:>10} {seconds:>8.2f} {n_rows / seconds:>10.0f} {peak_mb:>8.1f}")
+
+
+def _legacy_convert_coordinates(path, output_path):
+    """Row-by-row coordinate conversion, as convert_coordinates used to do it."""
+    df = pd.read_csv(path, sep=";", low_memory=False)
+
+    def safe_float_convert(x):
+        try:
+            return float(str(x).replace(",", "."))
+        except (ValueError, TypeError):
+            return np.nan
+
+    df["Equipement_latitude"] = df["Equipement_latitude"].apply(safe_float_convert)
+    df["Equipement_longitude"] = df["Equipement_longitude"].apply(safe_float_convert)
+    df.to_csv(output_path, sep=";", index=False)
+
+
+def benchmark_coordinates(n_rows=2_000_000, invalid_share=0.001):
+    """Compare the chunked vectorized coordinate conversion with the row-by-row one."""
+    rng = np.random.default_rng(0)
+    equipments = synthetic_cultural_data(n_rows)
+    data = pd.DataFrame(
+        {
+            "Nom_commune": equipments["nom_commune"],
+            "Code_insee": equipments["code_postal"],
+            "Type": equipments["type_infrastructure"],
+            "Nom_equipement": equipments["nom_infrastructure"],
+        }
+    )
+    for column, values in [
+        ("Equipement_latitude", equipments["latitude"]),
+        ("Equipement_longitude", equipments["longitude"]),
+    ]:
+        text = values.round(6).astype(str).str.replace(".", ",", regex=False)
+        text[rng.random(n_rows) < invalid_share] = "inconnu"
+        data[column] = text
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "equipements.csv")
+        output_path = os.path.join(directory, "converted.csv")
+        data.to_csv(path, sep=";", index=False)
+        start = time.perf_counter()
+        _legacy_convert_coordinates(path, output_path)
+        legacy_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        stats = convert_coordinates(
+            path, output_path, manifest_path=os.path.join(directory, "manifest.json")
+        )
+        seconds = time.perf_counter() - start
+    print(f"{n_rows} rows, {stats['invalid']} invalid")
+    print(f"{'method':>10} {'seconds':>8} {'rows/s':>10}")
+    for method, elapsed in [("row", legacy_seconds), ("vectorized", seconds)]:
+        print(f"{method:>10} {elapsed:>8.2f} {n_rows / elapsed:>10.0f}")
+
+
+def _commune_join_inputs(path, n_rows, seed=0):
+    """Heatmap rows of `path`, or synthetic ones with homonyms, and equipments sampled from them."""
+    rng = np.random.default_rng(seed)
+    if os.path.exists(path):
+        heatmap = pd.read_csv(path, sep="\t", dtype={"code_insee": str}, low_memory=False)
+    else:
+        heatmap = synthetic_cultural_data(35_000, 35_000).drop_duplicates("commune_key")
+        # One commune name out of ten is shared with another commune
+        names = heatmap["nom_commune"].to_numpy(copy=True)
+        names[::10] = names[1::10][: len(names[::10])]
+        heatmap = pd.DataFrame(
+            {
+                "Commune": names,
+                "code_insee": heatmap["code_postal"],
+                "Population_Totale": heatmap["population"],
+                "Nombre_categorie": 1,
+            }
+        )
+    rows = heatmap.iloc[rng.integers(0, len(heatmap), n_rows)]
+    equipments = pd.DataFrame(
+        {"Nom_commune": rows["Commune"].to_numpy(), "Code_insee": rows["code_insee"].to_numpy()}
+    )
+    return heatmap, equipments
+
+
+def benchmark_commune_search(path="data/results/Heatmap_Culture.csv", repeat=20):
+    """Compare the commune search index with a scan of all the commune names."""
+    heatmap = _commune_join_inputs(path, 0)[0].drop_duplicates("code_insee")
+    communes = pd.DataFrame(
+        {
+            "commune_key": insee_keys(heatmap["code_insee"]),
+            "code_insee": heatmap["code_insee"].astype(str),
+            "nom_commune": heatmap["Commune"].astype(str),
+            "departement": heatmap["code_insee"].astype(str).str[:2],
+            "population": heatmap["Population_Totale"],
+        }
+    )
+    start = time.perf_counter()
+    index = CommuneSearchIndex(communes)
+    print(f"{len(communes)} communes, {len(index.keys)} keys, built in {time.perf_counter() - start:.2f} s")
+    names = communes["nom_commune"].map(normalize)
+    print(f"{'query':>16} {'scan ms':>8} {'index ms':>9}  best match")
+    for query in ["s", "sa", "st et", "Saint-Étienne", "ste", "mont", "aix en", "bages", "31555"]:
+        text = normalize(query)
+        scan_ms = _median_ms(lambda: communes[names.str.contains(text, regex=False)], repeat)
+        index_ms = _median_ms(lambda: index.search(query), repeat)
+        best = index.search(query, 1)
+        print(f"{query:>16} {scan_ms:>8.2f} {index_ms:>9.3f}  {best[0][1] if best else ''}")
+
+
+def benchmark_commune_join(n_rows=1_000_000, path="data/results/Heatmap_Culture.csv"):
+    """Compare the commune name join of the equipments with the INSEE key join."""
+    heatmap, equipments = _commune_join_inputs(path, n_rows)
+    print(f"{len(heatmap)} heatmap rows, {n_rows} equipments")
+
+    start = time.perf_counter()
+    by_name = heatmap.groupby("Commune")[["Nombre_categorie", "Population_Totale"]].agg(
+        {"Nombre_categorie": "sum", "Population_Totale": "first"}
+    )
+    density = equipments["Nom_commune"].map(by_name["Nombre_categorie"] / by_name["Population_Totale"])
+    name_seconds = time.perf_counter() - start
+    codes_per_name = heatmap.groupby("Commune")["code_insee"].nunique()
+    shared = codes_per_name.index[codes_per_name > 1]
+    name_stats = (density.isna().sum(), equipments["Nom_commune"].isin(shared).sum())
+
+    start = time.perf_counter()
+    keys = pd.Series(insee_keys(heatmap["code_insee"]))
+    valid = (keys != MISSING_KEY).to_numpy()
+    by_key = heatmap[valid].groupby(keys[valid].to_numpy())[["Nombre_categorie", "Population_Totale"]].agg(
+        {"Nombre_categorie": "sum", "Population_Totale": "first"}
+    )
+    density = pd.Series(insee_keys(equipments["Code_insee"])).map(
+        by_key["Nombre_categorie"] / by_key["Population_Totale"]
+    )
+    key_seconds = time.perf_counter() - start
+    key_stats = (density.isna().sum(), 0)
+
+    print(f"{'join':>6} {'seconds':>8} {'unmatched':>10} {'ambiguous':>10}")
+    for label, seconds, (unmatched, ambiguous) in [
+        ("name", name_seconds, name_stats),
+        ("key", key_seconds, key_stats),
+    ]:
+        print(f"{label:>6} {seconds:>8.2f} {unmatched:>10} {ambiguous:>10}")
+
+
+def synthetic_osm_extract(path, n_nodes, cultural_share=0.01, way_size=10, seed=0):
+    """
+    Write a synthetic .osm XML extract over metropolitan France.
+
+    Every `way_size` consecutive nodes form a way; a `cultural_share` of
+    the nodes and of the ways carry a cultural tag, the other nodes a
+    non-cultural one.
+    """
+    rng = np.random.default_rng(seed)
+    tags = [f'<tag k="{key}" v="{value}"/>' for key, value in osm.CULTURAL_TAGS]
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n')
+        for start in range(0, n_nodes, 100_000):
+            ids = np.arange(start, min(start + 100_000, n_nodes)) + 1
+            lat = rng.uniform(42.5, 51.0, len(ids))
+            lon = rng.uniform(-4.5, 8.0, len(ids))
+            cultural = rng.random(len(ids)) < cultural_share
+            for node_id, node_lat, node_lon, is_cultural in zip(ids, lat, lon, cultural):
+                tag = tags[node_id % len(tags)] if is_cultural else '<tag k="highway" v="crossing"/>'
+                f.write(
+                    f'<node id="{node_id}" lat="{node_lat:.7f}" lon="{node_lon:.7f}">'
+                    f'<tag k="name" v="Lieu {node_id}"/>{tag}</node>\n'
+                )
+        for way_id in range(1, n_nodes // way_size + 1):
+            refs = "".join(f'<nd ref="{ref}"/>' for ref in range((way_id - 1) * way_size + 1, way_id * way_size + 1))
+            tag = tags[way_id % len(tags)] if rng.random() < cultural_share else '<tag k="building" v="yes"/>'
+            f.write(f'<way id="{way_id}">{refs}{tag}</way>\n')
+        f.write("</osm>\n")
+
+
+def synthetic_osm_diff(path, n_nodes, n_changes, seed=1):
+    """Write a synthetic .osc diff moving, creating and deleting cultural nodes."""
+    rng = np.random.default_rng(seed)
+    tag = '<tag k="amenity" v="theatre"/>'
+    moved = rng.choice(np.arange(1, n_nodes + 1), n_changes, replace=False)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<osmChange version="0.6">\n<modify>\n')
+        for node_id in moved[: n_changes // 2]:
+            lat, lon = rng.uniform(42.5, 51.0), rng.uniform(-4.5, 8.0)
+            f.write(f'<node id="{node_id}" lat="{lat:.7f}" lon="{lon:.7f}">{tag}</node>\n')
+        f.write("</modify>\n<create>\n")
+        for node_id in range(n_nodes + 1, n_nodes + 1 + n_changes // 4):
+            lat, lon = rng.uniform(42.5, 51.0), rng.uniform(-4.5, 8.0)
+            f.write(f'<node id="{node_id}" lat="{lat:.7f}" lon="{lon:.7f}">{tag}</node>\n')
+        f.write("</create>\n<delete>\n")
+        for node_id in moved[n_changes // 2 : n_changes // 2 + n_changes // 4]:
+            f.write(f'<node id="{node_id}"/>\n')
+        f.write("</delete>\n</osmChange>\n")
+
+
+def benchmark_osm(sizes=(200_000, 2_000_000), n_changes=1_000):
+    """Time the ingestion of synthetic OSM extracts, then of a diff (Linux only)."""
+    setup = """
+os.chdir(arguments)
+from cultural_map.data.osm import update_osm
+"""
+    code = """
+stats = update_osm("extract.osm", "diffs", "features.parquet", "way_nodes.parquet", manifest_path="manifest.json")
+result = stats["features"]
+"""
+    print(f"{'nodes':>10} {'MB':>6} {'step':>8} {'features':>9} {'seconds':>8} {'peak MB':>8}")
+    for n_nodes in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            extract = os.path.join(directory, "extract.osm")
+            synthetic_osm_extract(extract, n_nodes)
+            os.makedirs(os.path.join(directory, "diffs"))
+            size_mb = os.path.getsize(extract) / (1 << 20)
+            for step in ("extract", "diff"):
+                if step == "diff":
+                    synthetic_osm_diff(os.path.join(directory, "diffs", "000001.osc"), n_nodes, n_changes)
+                features, seconds, peak_mb = _measure_in_subprocess(code, directory, setup)
+                print(
+                    f"{n_nodes:>10} {size_mb:>6.0f} {step:>8} {features:>9} "
+                    f"{seconds:>8.2f} {peak_mb:>8.1f}"
+                )
+
+
+def benchmark_database(sizes=(100_000, 5_000_000), repeat=5):
+    """Compare the pandas filters with the SQL ones on the equipment database."""
+    print(f"{'rows':>9} {'query':>10} {'rows out':>9} {'pandas ms':>10} {'SQL ms':>8}")
+    for n_rows in sizes:
+        data = synthetic_cultural_data(n_rows)
+        with tempfile.TemporaryDirectory() as directory:
+            source = os.path.join(directory, "cultural_data.parquet")
+            path = os.path.join(directory, "cultural_data.sqlite")
+            write_table(data, source, CULTURAL_SCHEMA)
+            start = time.perf_counter()
+            build_database(source, path)
+            print(f"{n_rows:>9} built in {time.perf_counter() - start:.1f} s, {os.path.getsize(path) / 1e6:.0f} MB")
+            pool = open_database(path, source)
+            data = read_table(source, schema=CULTURAL_SCHEMA)
+            index = GridIndex(data["latitude"], data["longitude"])
+            types = sorted(data["type_infrastructure"].unique())
+            bounds = (48.5, 2.0, 49.0, 2.75)
+            commune = int(data["commune_key"].iloc[0])
+            queries = {
+                "category": ((["patrimoine"], None, None, None), lambda: filter_data(data, ["patrimoine"])),
+                "types": (([], types[:3], None, None), lambda: filter_data(data, [], types[:3])),
+                "commune": (([], [], commune, None), lambda: filter_data(data, [], [], commune)),
+                "viewport": (
+                    (["vivant"], types[:3], None, bounds),
+                    lambda: filter_data(data.iloc[index.query_bbox(*bounds)], ["vivant"], types[:3]),
+                ),
+            }
+            for name, (arguments, pandas_query) in queries.items():
+                rows = len(select_rows(pool, *arguments))
+                pandas_ms = _median_ms(pandas_query, repeat)
+                sql_ms = _median_ms(lambda: select_rows(pool, *arguments), repeat)
+                print(f"{n_rows:>9} {name:>10} {rows:>9} {pandas_ms:>10.1f} {sql_ms:>8.1f}")
+            pandas_ms = _median_ms(lambda: get_unique_values(data), repeat)
+            sql_ms = _median_ms(lambda: get_unique_values(data, pool), repeat)
+            print(f"{n_rows:>9} {'options':>10} {'':>9} {pandas_ms:>10.1f} {sql_ms:>8.1f}")
+            pool.close()
+
+
+def benchmark_filter_index(sizes=(100_000, 5_000_000), repeat=5):
+    """Compare the pandas filters with the filter index."""
+    print(f"{'rows':>9} {'query':>10} {'rows out':>9} {'pandas ms':>10} {'index ms':>9}")
+    for n_rows in sizes:
+        data = synthetic_cultural_data(n_rows).astype(
+            {column: CULTURAL_SCHEMA[column] for column in ["categorie", "type_infrastructure", "commune_key"]}
+        )
+        start = time.perf_counter()
+        index = FilterIndex(data)
+        build_seconds = time.perf_counter() - start
+        size = sum(bitmap.nbytes for bitmaps in index.bitmaps.values() for bitmap in bitmaps.values())
+        size += index.positions.nbytes + index.communes.nbytes + index.starts.nbytes
+        print(f"{n_rows:>9} built in {build_seconds:.2f} s, {size / 1e6:.0f} MB")
+        grid = GridIndex(data["latitude"], data["longitude"])
+        types = sorted(data["type_infrastructure"].unique())
+        visible = grid.query_bbox(48.5, 2.0, 49.0, 2.75)
+        commune = int(data["commune_key"].iloc[0])
+        queries = {
+            "category": ((["patrimoine"], None, None, None), lambda: filter_data(data, ["patrimoine"])),
+            "types": (([], types[:3], None, None), lambda: filter_data(data, [], types[:3])),
+            "both": ((["vivant"], types[:3], None, None), lambda: filter_data(data, ["vivant"], types[:3])),
+            "commune": (([], types[:3], commune, None), lambda: filter_data(data, [], types[:3], commune)),
+            "viewport": (
+                (["vivant"], types[:3], None, visible),
+                lambda: filter_data(data.iloc[visible], ["vivant"], types[:3]),
+            ),
+        }
+        for name, (arguments, pandas_query) in queries.items():
+            rows = len(pandas_query())
+            assert np.array_equal(data.iloc[index.select(*arguments)].index, pandas_query().index)
+            pandas_ms = _median_ms(pandas_query, repeat)
+            index_ms = _median_ms(lambda: data.iloc[index.select(*arguments)], repeat)
+            print(f"{n_rows:>9} {name:>10} {rows:>9} {pandas_ms:>10.1f} {index_ms:>9.1f}")
+
+
+def synthetic_sirene_stock(path, n_rows, cultural_share=0.02, seed=0):
+    """Write a synthetic StockEtablissement CSV file, with filler columns to match its width."""
+    rng = np.random.default_rng(seed)
+    codes = np.array(list(sirene.CULTURAL_NAF_CODES) + ["47.11F", "56.10A", "68.20B", "86.21Z"])
+    fillers = [f"colonne{index}" for index in range(40)]
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(",".join(["siret"] + sirene.SIRENE_COLUMNS + fillers) + "\n")
+        for start in range(0, n_rows, 200_000):
+            size = min(200_000, n_rows - start)
+            cultural = rng.random(size) < cultural_share
+            activity = np.where(
+                cultural,
+                codes[rng.integers(0, len(sirene.CULTURAL_NAF_CODES), size)],
+                codes[rng.integers(len(sirene.CULTURAL_NAF_CODES), len(codes), size)],
+            )
+            chunk = pd.DataFrame(
+                {
+                    "siret": np.arange(start, start + size) + 10**13,
+                    sirene.COMMUNE_COLUMN: pd.Series(rng.integers(1001, 95_000, size)).astype(str).str.zfill(5),
+                    sirene.STATUS_COLUMN: np.where(rng.random(size) < 0.6, "A", "F"),
+                    sirene.ACTIVITY_COLUMN: activity,
+                    sirene.NOMENCLATURE_COLUMN: "NAFRev2",
+                    **{filler: "valeur" for filler in fillers},
+                }
+            )
+            chunk.to_csv(f, header=False, index=False)
+
+
+def benchmark_sirene(sizes=(500_000, 2_000_000), jobs=None):
+    """Time the Sirene counts and measure the peak memory of the reading process (Linux only)."""
+    setup = """
+path, jobs = arguments
+from cultural_map.data.sirene import count_establishments
+"""
+    print(f"{'lines':>10} {'MB':>6} {'seconds':>8} {'lines/s':>10} {'peak MB':>8}")
+    for n_rows in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "StockEtablissement_utf8.csv")
+            synthetic_sirene_stock(path, n_rows)
+            lines, seconds, peak_mb = _measure_in_subprocess(
+                "table, result = count_establishments(path, jobs)", [path, jobs], setup
+            )
+            size_mb = os.path.getsize(path) / (1 << 20)
+            print(f"{lines:>10.0f} {size_mb:>6.0f} {seconds:>8.2f} {lines / seconds:>10.0f} {peak_mb:>8.1f}")
+
+
+def _legacy_score(synthese, per_inhabitants, threshold, category_weights):
+    """Group the rows again for each parameter set, as calcul_score used to do it."""
+    synthese = synthese.assign(
+        Nombre_pondere=synthese["Nombre_categorie"] * synthese["categorie"].map(dict(category_weights)).fillna(1)
+    )
+    keys = ["code_insee", "Commune", "Region", "latitude", "longitude", "Population_Totale", "Num_Region", "Num_Dep"]
+    scores = synthese.groupby(keys)["Nombre_pondere"].sum().reset_index(name="nbr_total_culturel")
+    scores["score"] = scores["nbr_total_culturel"] / scores["Population_Totale"] * per_inhabitants
+    scores.loc[scores["score"] > threshold, "score"] = threshold
+    scores.replace([np.inf, -np.inf], np.nan, inplace=True)
+    return scores.dropna()
+
+
+def benchmark_scoring(path="data/results/Heatmap_Culture.csv", n_sets=(1, 48)):
+    """Compare regrouping the rows per parameter set with the score engine."""
+    synthese = pd.read_csv(path, sep="\t", low_memory=False)
+    start = time.perf_counter()
+    engine = ScoreEngine(synthese)
+    print(f"{len(synthese)} rows, {len(engine.communes)} communes, statistics in {time.perf_counter() - start:.2f} s")
+    grid = [
+        ScoreParameters(per_inhabitants, threshold, (("patrimoine", weight),))
+        for per_inhabitants in (100, 1000, 10000)
+        for threshold in (1, 5, 10, 50)
+        for weight in (0, 0.5, 1, 2)
+    ]
+    print(f"{'sets':>5} {'regroup ms':>11} {'engine ms':>10}")
+    for count in n_sets:
+        parameters_list = grid[:count]
+        legacy_ms = _median_ms(
+            lambda: [_legacy_score(synthese, *parameters[:3]) for parameters in parameters_list], 3
+        )
+        engine_ms = _median_ms(lambda: engine.evaluate(parameters_list), 20)
+        print(f"{count:>5} {legacy_ms:>11.1f} {engine_ms:>10.2f}")
+
+
+BENCHMARKS = {
+    "markers": benchmark_marker_layer,
+    "bbox": benchmark_bbox_query,
+    "radius": benchmark_radius_query,
+    "accessibility": benchmark_accessibility,
+    "rerun": benchmark_rerun,
+    "density": benchmark_density_raster,
+    "circles": benchmark_density_circles,
+    "tooltips": benchmark_tooltips,
+    "update": benchmark_filter_update,
+    "storage": benchmark_storage,
+    "prepare": benchmark_prepare,
+    "coordinates": benchmark_coordinates,
+    "communes": benchmark_commune_join,
+    "search": benchmark_commune_search,
+    "osm": benchmark_osm,
+    "database": benchmark_database,
+    "filters": benchmark_filter_index,
+    "sirene": benchmark_sirene,
+    "scoring": benchmark_scoring,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("names", nargs="*", metavar="name", help=", ".join(BENCHMARKS))
+    for name in parser.parse_args().names or list(BENCHMARKS):
+        print(f"== {name}")
+        BENCHMARKS[name]()
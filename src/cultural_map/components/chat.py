@@ -3,11 +3,13 @@
 import streamlit as st
 import os
 
+
 def initialize_chat():
     """Initialize chat history in session state."""
     if 'chat_history' not in st.session_state:
         st.session_state.chat_history = []
 
+
 def process_chat_input(user_input, df, map_obj):
     """
     Process the chat input and return a response.
@@ -30,6 +32,7 @@ def process_chat_input(user_input, df, map_obj):
     except Exception as e:
         return f"Error processing your request: {str(e)}"
 
+
 def render_chat_interface():
     """Render the chat interface in the sidebar."""
     with st.sidebar.expander("⚙️ Configuration"):
@@ -0,0 +1,1003 @@
+"""Custom Leaflet layers built from compact columnar payloads.
+
+Instead of creating one folium object per row, these layers serialize whole
+DataFrame columns into a single JSON payload and let a small JavaScript
+builder create the Leaflet objects in the browser.
+"""
+
+import json
+
+import numpy as np
+import pandas as pd
+from branca.element import CssLink, Element, JavascriptLink
+from folium.elements import JSCSSMixin
+from folium.map import Layer
+from folium.template import Template
+
+from ..data.clustering import clusters_at_zoom, selected_groups
+from ..data.tiles import build_commune_table, equipment_ids
+
+PRERENDERED_MAP_ID = "prerendered"
+
+# Fetch a JSON asset, decompressed in the page when served gzipped as is
+FETCH_JSON_JS = """function(url) {
+    return fetch(url).then(function(response) {
+        if (!response.ok) throw new Error(url + ": HTTP " + response.status);
+        return response.arrayBuffer();
+    }).then(function(buffer) {
+        var bytes = new Uint8Array(buffer, 0, Math.min(buffer.byteLength, 2));
+        if (bytes[0] !== 0x1f || bytes[1] !== 0x8b) return new Response(buffer).json();
+        var stream = new Blob([buffer]).stream().pipeThrough(new DecompressionStream("gzip"));
+        return new Response(stream).json();
+    });
+}"""
+
+# Tooltip of an equipment, from its name, type and commune fields
+EQUIPMENT_TOOLTIP_JS = """function(row) {
+    var escape = function(text) {
+        return String(text).replace(/[&<>"']/g, function(c) {
+            return "&#" + c.charCodeAt(0) + ";";
+        });
+    };
+    var population = String(row.population).replace(/\\B(?=(\\d{3})+(?!\\d))/g, " ");
+    return '<div style="text-align: center;">'
+        + "<strong>" + escape(row.name) + "</strong><br>"
+        + "Type: " + escape(row.type) + "<br>"
+        + "Commune: " + escape(row.commune) + "<br>"
+        + "Population: " + population + " habitants<br>"
+        + "Équipements culturels pour 1000 hab.: " + row.density.toFixed(1) + "<br>"
+        + "Code INSEE: " + escape(row.code)
+        + "</div>";
+}"""
+
+
+def to_js_payload(payload):
+    """Serialize a payload to a compact JSON literal safe to inline in a script."""
+    text = json.dumps(payload, separators=(",", ":"), ensure_ascii=False)
+    return text.replace("</", "<\\/")
+
+
+def encode_coordinates(values, precision=5):
+    """Round a coordinate column to `precision` decimals (~1 m) as a list."""
+    return np.round(np.asarray(values, dtype="float64"), precision).tolist()
+
+
+def build_marker_payload(data, type_styles, default_style):
+    """
+    Build the columnar payload of the equipment layer in one pass.
+
+    Fields shared by the equipments of a commune (name, population, density,
+    INSEE code) are stored once per commune in a separate table.
+
+    Args:
+        data (pd.DataFrame): Equipments with the columns of cultural_data.csv
+        type_styles (dict): Style per infrastructure type
+        default_style (dict): Style used for unknown types
+
+    Returns:
+        dict: Column arrays, the commune table and a per-type style lookup table
+    """
+    codes, types = pd.factorize(data["type_infrastructure"], sort=False)
+    commune_rows, communes = build_commune_table(data)
+    return {
+        "types": [str(name) for name in types],
+        "styles": [type_styles.get(name, default_style) for name in types],
+        "lat": encode_coordinates(data["latitude"]),
+        "lon": encode_coordinates(data["longitude"]),
+        "type": codes.tolist(),
+        "name": data["nom_infrastructure"].astype(str).tolist(),
+        "commune": commune_rows.tolist(),
+        "communes": communes,
+    }
+
+
+def build_cluster_payload(
+    index, type_styles, default_style, min_zoom, max_zoom,
+    selected_categories=None, selected_types=None,
+):
+    """
+    Build the per-zoom cluster payload from a precomputed cluster index.
+
+    Args:
+        index (dict): Cluster index from build_cluster_index
+        type_styles (dict): Style per infrastructure type
+        default_style (dict): Style used for unknown types
+        min_zoom (int): First zoom level showing clusters
+        max_zoom (int): Last zoom level showing clusters
+        selected_categories (list): Categories to keep, all if empty
+        selected_types (list): Infrastructure types to keep, all if empty
+
+    Returns:
+        dict: Group labels and styles, and cluster columns per zoom level
+    """
+    levels = {}
+    for zoom in range(min_zoom, max_zoom + 1):
+        clusters = clusters_at_zoom(index, zoom, selected_categories, selected_types)
+        levels[str(zoom)] = {
+            "lat": encode_coordinates(clusters["latitude"]),
+            "lon": encode_coordinates(clusters["longitude"]),
+            "count": clusters["count"].tolist(),
+            "offsets": clusters["offsets"].tolist(),
+            "group": clusters["group"].tolist(),
+            "group_count": clusters["group_count"].tolist(),
+        }
+    group_types = index["group_type"].tolist()
+    return {
+        "min_zoom": min_zoom,
+        "max_zoom": max_zoom,
+        "group_types": group_types,
+        "group_styles": [type_styles.get(name, default_style) for name in group_types],
+        "levels": levels,
+    }
+
+
+class PayloadLayer(Layer):
+    """
+    Layer built in the browser from a JSON payload.
+
+    The payload is inlined in the script, unless `payload_url` is set, in
+    which case it is fetched from there when the page loads.
+    """
+
+    payload_js = "null"
+    payload_url = None
+    payload_asset = None
+
+    def payload_loader(self):
+        """Get a JavaScript function calling its argument with the payload."""
+        if self.payload_url is None:
+            return f"(function(build) {{ build({self.payload_js}); }})"
+        return "(function(build) { (%s)(%s).then(build); })" % (FETCH_JSON_JS, json.dumps(self.payload_url))
+
+
+def build_points_update(data, type_styles, default_style, previous=None):
+    """
+    Build the equipment payload as a diff against the equipments already sent.
+
+    Equipments are identified by their stable ids: the payload only holds
+    the rows missing from `previous` and the ids of the rows to remove. A
+    full payload (with a null "base") is built when there is no previous
+    state, and the previous payload is returned as is when nothing changed.
+
+    Args:
+        data (pd.DataFrame): Equipments to display individually
+        type_styles (dict): Style per infrastructure type
+        default_style (dict): Style used for unknown types
+        previous (dict): State returned with the last payload sent
+
+    Returns:
+        tuple: (payload, full payload of the same version or None when the
+            payload is already full, state to pass on to the next update)
+    """
+    ids = equipment_ids(data)
+    # Exact duplicates share an id and would be drawn on top of each other
+    unique = ~pd.Series(ids).duplicated().to_numpy()
+    data, ids = data[unique], ids[unique]
+    sorted_ids = np.sort(ids)
+    if previous is not None and np.array_equal(sorted_ids, previous["ids"]):
+        return previous["payload"], previous["snapshot"], previous
+
+    version = 0 if previous is None else previous["version"] + 1
+    full = build_marker_payload(data, type_styles, default_style)
+    full.update(version=version, base=None, ids=ids.tolist(), removed=[])
+    if previous is None:
+        payload, snapshot = full, None
+    else:
+        added = ~np.isin(ids, previous["ids"], assume_unique=True)
+        payload = build_marker_payload(data[added], type_styles, default_style)
+        payload.update(
+            version=version,
+            base=previous["version"],
+            ids=ids[added].tolist(),
+            removed=np.setdiff1d(previous["ids"], sorted_ids, assume_unique=True).tolist(),
+        )
+        snapshot = full
+    state = {"version": version, "ids": sorted_ids, "payload": payload, "snapshot": snapshot}
+    return payload, snapshot, state
+
+
+class EquipmentLayer(PayloadLayer):
+    """
+    Equipment layer created client-side from a columnar payload.
+
+    Below `disaggregate_zoom` the layer shows the precomputed clusters of the
+    current zoom level, with their exact counts; from that zoom on it shows
+    the individual equipments. Each level is built on first display.
+
+    The equipments and the cluster data are kept in the page between
+    updates, so that a new layer built with the `previous` state of the last
+    one only carries the equipments added and removed since, and the
+    clusters are filtered in the browser. If the page lost that state, the
+    full equipment list is fetched from `snapshot_url` instead.
+
+    Args:
+        data (pd.DataFrame): Equipments to display individually
+        type_styles (dict): Style per infrastructure type
+        default_style (dict): Style used for unknown types
+        cluster_index (dict): Cluster index, or None to always show equipments
+        selected_categories (list): Categories kept in the clusters
+        selected_types (list): Infrastructure types kept in the clusters
+        min_zoom (int): First zoom level showing clusters
+        disaggregate_zoom (int): First zoom level showing equipments
+        name (str): Layer name shown in the layer control
+        cluster_url (str): URL of the unfiltered cluster payload, inlined if None
+        previous (dict): State of the last layer sent to the page, if any
+    """
+
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = L.featureGroup();
+            {{ this.payload_loader() }}(function(data) {
+                var layer = {{ this.get_name() }};
+                var fetchJson = {{ this.fetch_json_js }};
+                var store = window.equipmentStore = window.equipmentStore
+                    || {version: null, rows: new Map(), clusters: {}};
+                var renderer = L.canvas({padding: 0.5});
+                var escape = function(text) {
+                    return String(text).replace(/[&<>"']/g, function(c) {
+                        return "&#" + c.charCodeAt(0) + ";";
+                    });
+                };
+                var applyPoints = function(points) {
+                    if (points.base === null) store.rows.clear();
+                    points.removed.forEach(function(id) { store.rows.delete(id); });
+                    var communes = points.communes;
+                    for (var i = 0; i < points.ids.length; i++) {
+                        var c = points.commune[i];
+                        store.rows.set(points.ids[i], {
+                            lat: points.lat[i],
+                            lon: points.lon[i],
+                            style: points.styles[points.type[i]],
+                            type: points.types[points.type[i]],
+                            name: points.name[i],
+                            commune: communes.name[c],
+                            population: communes.population[c],
+                            density: communes.density[c],
+                            code: communes.code[c]
+                        });
+                    }
+                    store.version = points.version;
+                };
+                var equipmentTooltip = {{ this.tooltip_js }};
+                var tooltip = function(marker) {
+                    return equipmentTooltip(marker.options.row);
+                };
+                var buildPoints = function() {
+                    var group = L.featureGroup();
+                    store.rows.forEach(function(row) {
+                        L.circleMarker([row.lat, row.lon], {
+                            renderer: renderer,
+                            row: row,
+                            radius: row.style.radius,
+                            color: row.style.color,
+                            fill: true,
+                            fillColor: row.style.color,
+                            fillOpacity: 0.6,
+                            weight: 1,
+                            opacity: 0.8
+                        }).bindTooltip(tooltip).addTo(group);
+                    });
+                    return group;
+                };
+                var buildClusters = function(clusters, zoom) {
+                    var level = clusters.levels[zoom];
+                    var visible = data.visible_groups;
+                    var group = L.featureGroup();
+                    var clusterTooltip = function(marker) {
+                        var i = marker.options.row;
+                        var byType = {};
+                        for (var j = level.offsets[i]; j < level.offsets[i + 1]; j++) {
+                            if (!visible[level.group[j]]) continue;
+                            var type = clusters.group_types[level.group[j]];
+                            byType[type] = (byType[type] || 0) + level.group_count[j];
+                        }
+                        var lines = Object.keys(byType).sort(function(a, b) {
+                            return byType[b] - byType[a];
+                        }).map(function(type) {
+                            return escape(type) + ": " + byType[type];
+                        });
+                        return '<div style="text-align: center;">'
+                            + "<strong>" + marker.options.count + " équipements culturels</strong><br>"
+                            + lines.join("<br>") + "</div>";
+                    };
+                    for (var i = 0; i < level.lat.length; i++) {
+                        var count = 0;
+                        var first = -1;
+                        for (var j = level.offsets[i]; j < level.offsets[i + 1]; j++) {
+                            if (!visible[level.group[j]]) continue;
+                            count += level.group_count[j];
+                            if (first < 0) first = j;
+                        }
+                        if (count == 0) continue;
+                        var style = count == 1
+                            ? clusters.group_styles[level.group[first]]
+                            : {
+                                radius: Math.min(10 + 4 * Math.log2(count), 40),
+                                color: count < 10 ? "#6ecc39" : count < 100 ? "#f0c20c" : "#f18017"
+                            };
+                        L.circleMarker([level.lat[i], level.lon[i]], {
+                            renderer: renderer,
+                            row: i,
+                            count: count,
+                            radius: style.radius,
+                            color: style.color,
+                            fill: true,
+                            fillColor: style.color,
+                            fillOpacity: 0.6,
+                            weight: 1,
+                            opacity: 0.8
+                        }).bindTooltip(clusterTooltip).on("click", function(e) {
+                            e.target._map.setView(e.latlng, zoom + 2);
+                        }).addTo(group);
+                    }
+                    return group;
+                };
+                var start = function(clusters) {
+                    var levels = {};
+                    var current = null;
+                    var refresh = function() {
+                        var zoom = layer._map.getZoom();
+                        var key = "points";
+                        if (clusters && zoom <= clusters.max_zoom) {
+                            key = String(Math.max(zoom, clusters.min_zoom));
+                        }
+                        if (!(key in levels)) {
+                            levels[key] = key == "points" ? buildPoints() : buildClusters(clusters, Number(key));
+                        }
+                        if (levels[key] !== current) {
+                            if (current) layer.removeLayer(current);
+                            current = levels[key];
+                            layer.addLayer(current);
+                        }
+                    };
+                    layer.on("add", function(e) {
+                        e.target._map.on("zoomend", refresh);
+                        refresh();
+                    });
+                    layer.on("remove", function(e) {
+                        e.target._map.off("zoomend", refresh);
+                    });
+                    if (layer._map) {
+                        // Added to the map before its data was ready
+                        layer._map.on("zoomend", refresh);
+                        refresh();
+                    }
+                };
+                var points = Promise.resolve(data);
+                if (data.base !== null && store.version !== data.base && store.version !== data.version) {
+                    // The page does not hold the state this update applies to
+                    var snapshot = {{ this.snapshot_url|tojson }};
+                    points = snapshot === null ? Promise.reject(new Error("Missing equipment snapshot"))
+                        : fetchJson(snapshot);
+                }
+                var clusters = data.clusters;
+                if (typeof clusters === "string") {
+                    store.clusters[clusters] = store.clusters[clusters]
+                        || fetchJson(clusters);
+                    clusters = store.clusters[clusters];
+                }
+                Promise.all([points, clusters]).then(function(results) {
+                    applyPoints(results[0]);
+                    start(results[1]);
+                }).catch(function(error) {
+                    console.error("Equipment layer not loaded", error);
+                });
+            });
+        {% endmacro %}
+        """
+    )
+
+    fetch_json_js = FETCH_JSON_JS
+    tooltip_js = EQUIPMENT_TOOLTIP_JS
+    snapshot_js = None
+    snapshot_url = None
+
+    def __init__(
+        self,
+        data,
+        type_styles,
+        default_style,
+        cluster_index=None,
+        selected_categories=None,
+        selected_types=None,
+        min_zoom=5,
+        disaggregate_zoom=13,
+        name="Équipements culturels",
+        cluster_url=None,
+        previous=None,
+    ):
+        super().__init__(name=name, overlay=True, control=True)
+        self._name = "EquipmentLayer"
+        points, snapshot, self.state = build_points_update(
+            data, type_styles, default_style, previous
+        )
+        payload = dict(points)
+        if cluster_index is not None:
+            payload["clusters"] = cluster_url or build_cluster_payload(
+                cluster_index, type_styles, default_style, min_zoom, disaggregate_zoom - 1
+            )
+            payload["visible_groups"] = selected_groups(
+                cluster_index, selected_categories, selected_types
+            ).tolist()
+        self.payload_js = to_js_payload(payload)
+        if snapshot is not None:
+            self.snapshot_js = to_js_payload(snapshot)
+
+
+class EquipmentTileLayer(Layer):
+    """
+    Equipment layer drawn on canvas from the local JSON tile pyramid.
+
+    Beyond the last zoom level of the pyramid, tiles are cut out of their
+    ancestor at that level. Tooltips are resolved on hover from the
+    equipment fields stored in the tiles of the metadata's attribute_zoom.
+
+    Args:
+        url (str): Base URL of the pyramid
+        metadata (dict): Pyramid metadata (types, zoom range, extent)
+        type_styles (dict): Style per infrastructure type
+        default_style (dict): Style used for unknown types
+        visible_types (list): Types to draw, all if None
+        min_zoom (int): First zoom level where the layer is drawn
+        name (str): Layer name shown in the layer control
+    """
+
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = (function(options) {
+                var TileLayer = L.GridLayer.extend({
+                    createTile: function(coords, done) {
+                        var tile = L.DomUtil.create("canvas", "leaflet-tile");
+                        var size = this.getTileSize();
+                        tile.width = size.x;
+                        tile.height = size.y;
+                        var shift = Math.max(coords.z - options.max_zoom, 0);
+                        var x = coords.x >> shift;
+                        var y = coords.y >> shift;
+                        var scale = size.x * Math.pow(2, shift) / options.extent;
+                        var offsetX = (coords.x - (x << shift)) * size.x;
+                        var offsetY = (coords.y - (y << shift)) * size.y;
+                        var url = options.url + "/" + (coords.z - shift) + "/" + x + "/" + y + ".json";
+                        fetch(url).then(function(response) {
+                            return response.ok ? response.json() : null;
+                        }).then(function(data) {
+                            var context = tile.getContext("2d");
+                            for (var i = 0; data && i < data.x.length; i++) {
+                                if (!options.visible[data.type[i]]) continue;
+                                var style = options.styles[data.type[i]];
+                                var px = data.x[i] * scale - offsetX;
+                                var py = data.y[i] * scale - offsetY;
+                                if (px < -style.radius || py < -style.radius
+                                    || px > size.x + style.radius || py > size.y + style.radius) continue;
+                                context.beginPath();
+                                context.arc(px, py, style.radius, 0, 2 * Math.PI);
+                                context.globalAlpha = 0.6;
+                                context.fillStyle = style.color;
+                                context.fill();
+                                context.globalAlpha = 0.8;
+                                context.lineWidth = 1;
+                                context.strokeStyle = style.color;
+                                context.stroke();
+                            }
+                            done(null, tile);
+                        }).catch(function(error) {
+                            done(error, tile);
+                        });
+                        return tile;
+                    },
+                    onAdd: function(map) {
+                        L.GridLayer.prototype.onAdd.call(this, map);
+                        map.on("mousemove", this._hover, this);
+                        map.on("mouseout zoomstart", this._closeTooltip, this);
+                    },
+                    onRemove: function(map) {
+                        map.off("mousemove", this._hover, this);
+                        map.off("mouseout zoomstart", this._closeTooltip, this);
+                        this._closeTooltip();
+                        L.GridLayer.prototype.onRemove.call(this, map);
+                    },
+                    _attributeTile: function(x, y) {
+                        // Last tiles hovered, most recent last
+                        var cache = this._attributeTiles = this._attributeTiles || new Map();
+                        var key = x + "/" + y;
+                        var tile = cache.get(key);
+                        if (tile === undefined) {
+                            var url = options.url + "/" + options.attribute_zoom + "/" + key + ".json";
+                            tile = fetch(url).then(function(response) {
+                                return response.ok ? response.json() : null;
+                            }).catch(function() { return null; });
+                            if (cache.size >= 64) cache.delete(cache.keys().next().value);
+                        }
+                        cache.delete(key);
+                        cache.set(key, tile);
+                        return tile.then(function(data) {
+                            return data && {x: x, y: y, data: data};
+                        });
+                    },
+                    _hover: function(event) {
+                        var map = this._map;
+                        var zoom = map.getZoom();
+                        if (zoom < options.min_zoom || options.attribute_zoom == null) return;
+                        var size = this.getTileSize().x;
+                        var scale = Math.pow(2, options.attribute_zoom - zoom);
+                        var point = map.project(event.latlng, options.attribute_zoom);
+                        var reach = (options.max_radius + 1) * scale;
+                        var tiles = [];
+                        for (var x = Math.floor((point.x - reach) / size); x <= Math.floor((point.x + reach) / size); x++) {
+                            for (var y = Math.floor((point.y - reach) / size); y <= Math.floor((point.y + reach) / size); y++) {
+                                tiles.push(this._attributeTile(x, y));
+                            }
+                        }
+                        var hover = this._hoverCount = (this._hoverCount || 0) + 1;
+                        var layer = this;
+                        Promise.all(tiles).then(function(tiles) {
+                            if (hover !== layer._hoverCount || !layer._map) return;
+                            var unit = size / options.extent;
+                            var best = null;
+                            var bestDistance = Infinity;
+                            tiles.forEach(function(tile) {
+                                for (var i = 0; tile && i < tile.data.x.length; i++) {
+                                    if (!options.visible[tile.data.type[i]]) continue;
+                                    var dx = (tile.x * size + tile.data.x[i] * unit - point.x) / scale;
+                                    var dy = (tile.y * size + tile.data.y[i] * unit - point.y) / scale;
+                                    var distance = Math.sqrt(dx * dx + dy * dy);
+                                    if (distance <= options.styles[tile.data.type[i]].radius + 1
+                                        && distance < bestDistance) {
+                                        best = {tile: tile.data, index: i};
+                                        bestDistance = distance;
+                                    }
+                                }
+                            });
+                            if (best === null) return layer._closeTooltip();
+                            var data = best.tile;
+                            var i = best.index;
+                            var c = data.commune[i];
+                            var content = equipmentTooltip({
+                                name: data.name[i],
+                                type: options.types[data.type[i]],
+                                commune: data.communes.name[c],
+                                population: data.communes.population[c],
+                                density: data.communes.density[c],
+                                code: data.communes.code[c]
+                            });
+                            layer._tooltip = layer._tooltip || L.tooltip();
+                            map.openTooltip(layer._tooltip.setContent(content), event.latlng);
+                        });
+                    },
+                    _closeTooltip: function() {
+                        if (this._tooltip && this._map) this._map.closeTooltip(this._tooltip);
+                    }
+                });
+                var equipmentTooltip = {{ this.tooltip_js }};
+                return new TileLayer({minZoom: options.min_zoom});
+            })({{ this.options_js }});
+        {% endmacro %}
+        """
+    )
+
+    tooltip_js = EQUIPMENT_TOOLTIP_JS
+
+    def __init__(
+        self,
+        url,
+        metadata,
+        type_styles,
+        default_style,
+        visible_types=None,
+        min_zoom=None,
+        name="Équipements culturels (tuiles)",
+    ):
+        super().__init__(name=name, overlay=True, control=True)
+        self._name = "EquipmentTileLayer"
+        types = metadata["types"]
+        styles = [type_styles.get(name, default_style) for name in types]
+        self.options_js = to_js_payload(
+            {
+                "url": url,
+                "extent": metadata["extent"],
+                "max_zoom": metadata["max_zoom"],
+                "min_zoom": metadata["min_zoom"] if min_zoom is None else min_zoom,
+                "attribute_zoom": metadata.get("attribute_zoom"),
+                "types": types,
+                "styles": styles,
+                "max_radius": max((style["radius"] for style in styles), default=0),
+                "visible": [visible_types is None or name in visible_types for name in types],
+            }
+        )
+
+
+class DensityRasterLayer(Layer):
+    """
+    Pre-rendered density surface shown as a pyramid of image tiles.
+
+    Beyond the last zoom level of the pyramid, its tiles are stretched.
+    Only the tiles listed in the metadata are requested, the others being
+    transparent.
+
+    Args:
+        url (str): Base URL of the tile pyramid
+        metadata (dict): Raster metadata (tiles written at each zoom level)
+        name (str): Layer name shown in the layer control
+        show (bool): Whether the layer is shown by default
+    """
+
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = (function(options) {
+                var written = {};
+                options.levels.forEach(function(level) {
+                    level.tiles.forEach(function(tile) {
+                        written[level.zoom + "/" + tile[0] + "/" + tile[1]] = true;
+                    });
+                });
+                var TileLayer = L.TileLayer.extend({
+                    createTile: function(coords, done) {
+                        if (written[coords.z + "/" + coords.x + "/" + coords.y]) {
+                            return L.TileLayer.prototype.createTile.call(this, coords, done);
+                        }
+                        var tile = L.DomUtil.create("div", "leaflet-tile");
+                        L.Util.requestAnimFrame(function() { done(null, tile); });
+                        return tile;
+                    }
+                });
+                return new TileLayer(options.url + "/{z}/{x}/{y}.png", {
+                    minNativeZoom: options.min_zoom,
+                    maxNativeZoom: options.max_zoom,
+                    bounds: options.bounds,
+                    pane: "overlayPane"
+                });
+            })({{ this.options_js }});
+        {% endmacro %}
+        """
+    )
+
+    def __init__(self, url, metadata, name="Densité culturelle", show=True):
+        super().__init__(name=name, overlay=True, control=True, show=show)
+        self._name = "DensityRasterLayer"
+        self.options_js = to_js_payload(
+            {
+                "url": url,
+                "min_zoom": metadata["min_zoom"],
+                "max_zoom": metadata["max_zoom"],
+                "bounds": metadata["bounds"],
+                "levels": metadata["levels"],
+            }
+        )
+
+
+def colormap_hex(values, colormap):
+    """
+    Look up the colors of a branca LinearColormap for a whole array at once.
+
+    Args:
+        values (array-like): Values to color
+        colormap (branca.colormap.LinearColormap): Color scale
+
+    Returns:
+        np.ndarray: "#rrggbb" strings
+    """
+    values = np.clip(np.asarray(values, dtype="float64"), colormap.vmin, colormap.vmax)
+    colors = np.asarray(colormap.colors)[:, :3]
+    channels = np.column_stack(
+        [np.interp(values, colormap.index, colors[:, channel]) for channel in range(3)]
+    )
+    codes = (channels * 255.9999).astype("int64")  # As branca does
+    packed = codes[:, 0] << 16 | codes[:, 1] << 8 | codes[:, 2]
+    return np.char.add("#", np.char.zfill(np.char.mod("%x", packed), 6))
+
+
+def build_density_circles(data, colormap):
+    """
+    Build the density circles as one GeoJSON FeatureCollection.
+
+    Radius and color are computed column-wise: the radius grows with the
+    square root of the number of equipments (1000 m plus 300 m per unit,
+    capped at 5000 m) and the color follows the density.
+
+    Args:
+        data (pd.DataFrame): Rows of Heatmap_Culture_with_score.csv
+        colormap (branca.colormap.LinearColormap): Color scale of the density
+
+    Returns:
+        dict: FeatureCollection of points with radius, color and tooltip fields
+    """
+    facilities = data["nbr_total_culturel"].fillna(0).to_numpy(dtype="float64")
+    density = data["Nbre culturels pour1000 habitants"].to_numpy(dtype="float64")
+    columns = zip(
+        encode_coordinates(data["longitude"]),
+        encode_coordinates(data["latitude"]),
+        np.round(np.minimum(1000 + 300 * np.sqrt(facilities), 5000)).tolist(),
+        colormap_hex(density, colormap).tolist(),
+        data["Commune"].astype(str).tolist(),
+        data["Population_Totale"].fillna(0).round().astype("int64").tolist(),
+        facilities.astype("int64").tolist(),
+        np.round(density, 2).tolist(),
+    )
+    return {
+        "type": "FeatureCollection",
+        "features": [
+            {
+                "type": "Feature",
+                "geometry": {"type": "Point", "coordinates": [lon, lat]},
+                "properties": {
+                    "radius": radius,
+                    "color": color,
+                    "commune": commune,
+                    "population": population,
+                    "facilities": count,
+                    "density": value,
+                },
+            }
+            for lon, lat, radius, color, commune, population, count, value in columns
+        ],
+    }
+
+
+class DensityCircleLayer(PayloadLayer):
+    """
+    Density circles drawn from one FeatureCollection with a single style function.
+
+    Args:
+        feature_collection (dict): FeatureCollection from build_density_circles
+        name (str): Layer name shown in the layer control
+        show (bool): Whether the layer is shown by default
+    """
+
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = (function() {
+                var renderer = L.canvas({padding: 0.5});
+                var escape = function(text) {
+                    return String(text).replace(/[&<>"']/g, function(c) {
+                        return "&#" + c.charCodeAt(0) + ";";
+                    });
+                };
+                return L.geoJSON(null, {
+                    pointToLayer: function(feature, latlng) {
+                        return L.circle(latlng, {renderer: renderer, radius: feature.properties.radius});
+                    },
+                    style: function(feature) {
+                        return {
+                            color: feature.properties.color,
+                            fill: true,
+                            fillColor: feature.properties.color,
+                            fillOpacity: 0.7,
+                            weight: 1,
+                            opacity: 0.8
+                        };
+                    }
+                }).bindTooltip(function(layer) {
+                    var p = layer.feature.properties;
+                    var population = String(p.population).replace(/\\B(?=(\\d{3})+(?!\\d))/g, ",");
+                    return '<div style="text-align: center;">'
+                        + "<strong>" + escape(p.commune) + "</strong><br>"
+                        + "Population: " + population + " habitants<br>"
+                        + "Équipements culturels: " + p.facilities + "<br>"
+                        + "Densité culturelle: " + p.density.toFixed(2) + " pour 1000 hab."
+                        + "</div>";
+                });
+            })();
+            {{ this.payload_loader() }}(function(data) {
+                {{ this.get_name() }}.addData(data);
+            });
+        {% endmacro %}
+        """
+    )
+
+    def __init__(self, feature_collection, name="Densité culturelle (cercles)", show=True):
+        super().__init__(name=name, overlay=True, control=True, show=show)
+        self._name = "DensityCircleLayer"
+        self.payload_js = to_js_payload(feature_collection)
+
+
+def build_accessibility_points(data, colormap, count_column):
+    """
+    Build the accessibility points of the communes as one GeoJSON FeatureCollection.
+
+    Args:
+        data (pd.DataFrame): Rows of the accessibility table for one type,
+            with the nom_commune, latitude and longitude of the communes
+        colormap (branca.colormap.LinearColormap): Color scale of the distance
+        count_column (str): Column of the number of equipments shown in the tooltip
+
+    Returns:
+        dict: FeatureCollection of points with color and tooltip fields
+    """
+    data = data.dropna(subset=["latitude", "longitude", "distance_km"])
+    distance = data["distance_km"].to_numpy(dtype="float64")
+    columns = zip(
+        encode_coordinates(data["longitude"]),
+        encode_coordinates(data["latitude"]),
+        colormap_hex(distance, colormap).tolist(),
+        data["nom_commune"].astype(str).tolist(),
+        np.round(distance, 1).tolist(),
+        data[count_column].astype("int64").tolist(),
+    )
+    return {
+        "type": "FeatureCollection",
+        "features": [
+            {
+                "type": "Feature",
+                "geometry": {"type": "Point", "coordinates": [lon, lat]},
+                "properties": {"color": color, "commune": commune, "distance": value, "count": count},
+            }
+            for lon, lat, color, commune, value, count in columns
+        ],
+    }
+
+
+class AccessibilityLayer(PayloadLayer):
+    """
+    Commune points colored by the distance to the nearest equipment of a type.
+
+    Args:
+        feature_collection (dict): FeatureCollection from build_accessibility_points
+        count_label (str): Tooltip label of the number of equipments
+        name (str): Layer name shown in the layer control
+        show (bool): Whether the layer is shown by default
+    """
+
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = (function() {
+                var renderer = L.canvas({padding: 0.5});
+                var escape = function(text) {
+                    return String(text).replace(/[&<>"']/g, function(c) {
+                        return "&#" + c.charCodeAt(0) + ";";
+                    });
+                };
+                return L.geoJSON(null, {
+                    pointToLayer: function(feature, latlng) {
+                        return L.circleMarker(latlng, {renderer: renderer, radius: 4});
+                    },
+                    style: function(feature) {
+                        return {
+                            color: feature.properties.color,
+                            fill: true,
+                            fillColor: feature.properties.color,
+                            fillOpacity: 0.8,
+                            weight: 0
+                        };
+                    }
+                }).bindTooltip(function(layer) {
+                    var p = layer.feature.properties;
+                    return '<div style="text-align: center;">'
+                        + "<strong>" + escape(p.commune) + "</strong><br>"
+                        + "Équipement le plus proche : " + p.distance.toFixed(1) + " km<br>"
+                        + {{ this.count_label|tojson }} + " : " + p.count
+                        + "</div>";
+                });
+            })();
+            {{ this.payload_loader() }}(function(data) {
+                {{ this.get_name() }}.addData(data);
+            });
+        {% endmacro %}
+        """
+    )
+
+    def __init__(self, feature_collection, count_label, name="Accessibilité", show=True):
+        super().__init__(name=name, overlay=True, control=True, show=show)
+        self._name = "AccessibilityLayer"
+        self.count_label = count_label
+        self.payload_js = to_js_payload(feature_collection)
+
+
+class RawElement(Element):
+    """Element rendering its text as is, without compiling it as a template."""
+
+    def __init__(self, text):
+        super().__init__()
+        self._name = "RawElement"
+        self.text = text
+
+    def render(self, **kwargs):
+        return self.text
+
+
+def prerender_children(m):
+    """
+    Render the children of a map into reusable fragments.
+
+    The map should have `PRERENDERED_MAP_ID` as id, so that references to it
+    in the rendered code can be pointed to another map later.
+
+    Args:
+        m (folium.Map): Map holding the elements to render
+
+    Returns:
+        list: One fragment per child, with the header, html and script code
+            its rendering added, the JavaScript and CSS links it needs and
+            the attributes the layer control needs
+    """
+    figure = m.get_root()
+    parts = {part: getattr(figure, part) for part in ("header", "html", "script")}
+    children = list(m._children.items())
+    m._children.clear()
+    figure.render()
+
+    fragments = []
+    for key, child in children:
+        m._children[key] = child
+        before = {part: set(element._children) for part, element in parts.items()}
+        child.render()
+        fragment = {
+            "name": child._name,
+            "id": child._id,
+            "layer_name": getattr(child, "layer_name", None),
+            "overlay": getattr(child, "overlay", True),
+            "control": isinstance(child, Layer) and child.control,
+            "show": getattr(child, "show", True),
+            "asset": getattr(child, "payload_asset", None),
+        }
+        for part, element in parts.items():
+            fragment[part] = [
+                (name, rendered.render())
+                for name, rendered in element._children.items()
+                if name not in before[part]
+            ]
+        links = [
+            (name, link)
+            for name, link in parts["header"]._children.items()
+            if name not in before["header"]
+        ]
+        fragment["js"] = [(name, link.url) for name, link in links if isinstance(link, JavascriptLink)]
+        fragment["css"] = [(name, link.url) for name, link in links if isinstance(link, CssLink)]
+        fragments.append(fragment)
+    return fragments
+
+
+class PrerenderedElement(JSCSSMixin, Layer):
+    """
+    Fragment from prerender_children, added to a map without rendering again.
+
+    The fragment keeps the name of its original element, so the layer
+    control refers to the JavaScript variable created by its code. Its
+    script is also exposed through the `script` macro and its links through
+    `default_js`/`default_css`, which is what streamlit-folium reads.
+
+    Args:
+        fragment (dict): Fragment from prerender_children
+    """
+
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+            {{ this.script_text() }}
+        {% endmacro %}
+        """
+    )
+
+    def __init__(self, fragment):
+        super().__init__(
+            name=fragment.get("layer_name") or fragment["name"],
+            overlay=fragment.get("overlay", True),
+            control=fragment.get("control", False),
+            show=fragment.get("show", True),
+        )
+        self._name = fragment["name"]
+        self._id = fragment.get("id", self._id)
+        self.fragment = fragment
+        self.default_js = fragment.get("js", [])
+        self.default_css = fragment.get("css", [])
+        self.payload_asset = fragment.get("asset")
+
+    def _texts(self, part):
+        map_name = self._parent.get_name()
+        prerendered_name = f"map_{PRERENDERED_MAP_ID}"
+        for name, text in self.fragment.get(part, []):
+            yield name, text.replace(prerendered_name, map_name)
+
+    def script_text(self):
+        """Get the script of the fragment, pointed to the parent map."""
+        return "\n".join(text for _, text in self._texts("script"))
+
+    def render(self, **kwargs):
+        figure = self.get_root()
+        for part in ("header", "html", "script"):
+            for name, text in self._texts(part):
+                getattr(figure, part).add_child(RawElement(text), name=name)
@@ -1,12 +1,43 @@
 """Map component functionality."""
 
+import os
+
 import folium
-from folium import plugins
-from streamlit_folium import folium_static
 import branca
-import numpy as np
-import pandas as pd
-from ..data.loader import load_heatmap_data
+import streamlit as st
+from ..config.settings import ACCESSIBILITY_CONFIG, CLUSTER_CONFIG, PAYLOAD_CONFIG, TILE_CONFIG
+from ..data.assets import write_asset
+from ..data.clustering import selected_groups
+from ..data.accessibility import count_column
+from ..data.loader import (
+    ACCESSIBILITY_PATH,
+    COMMUNES_PATH,
+    CULTURAL_DATA_PATH,
+    CULTURAL_DENSITY_PATH,
+    HEATMAP_DATA_PATH,
+    file_version,
+    load_accessibility,
+    load_communes,
+    load_density_rasters,
+    load_density_scores,
+    load_equipment_clusters,
+    static_base_url,
+)
+from .layers import (
+    PRERENDERED_MAP_ID,
+    AccessibilityLayer,
+    DensityCircleLayer,
+    DensityRasterLayer,
+    EquipmentLayer,
+    EquipmentTileLayer,
+    PrerenderedElement,
+    build_accessibility_points,
+    build_cluster_payload,
+    build_density_circles,
+    prerender_children,
+    to_js_payload,
+)
+from .payload import externalize_payloads
 
 # Define type-specific colors and icons with larger radius
 TYPE_STYLES = {
@@ -31,38 +62,28 @@ TYPE_STYLES = {
 # Default style for unknown types
 DEFAULT_STYLE = {"color": "#808080", "radius": 6}  # Gray
 
-# Add path to the new dataset
-CULTURAL_DENSITY_PATH = "data/results/Heatmap_Culture_with_score.csv"
-
-
-def sample_data_by_zoom(data, zoom_level):
-    """Sample data based on zoom level to reduce markers."""
-    # Progressive sampling rates from country to city level
-    if zoom_level >= 13:  # City level
-        return data  # 100%
-    elif zoom_level >= 11:  # Metropolitan area
-        return data.sample(frac=0.8, random_state=42)  # 80%
-    elif zoom_level >= 9:  # Department level
-        return data.sample(frac=0.6, random_state=42)  # 60%
-    elif zoom_level >= 7:  # Regional level
-        return data.sample(frac=0.4, random_state=42)  # 40%
-    elif zoom_level >= 6:  # Multi-region level
-        return data.sample(frac=0.2, random_state=42)  # 20%
-    else:  # Country level (zoom 5 and below)
-        return data.sample(frac=0.1, random_state=42)  # 10%
-
-
-def create_map(
-    data, selected_categories=None, selected_types=None, selected_commune=None
-):
+
+def visible_tile_types(cluster_index, selected_categories=None, selected_types=None):
+    """Get the infrastructure types matching the category and type filters."""
+    keep = selected_groups(cluster_index, selected_categories, selected_types)
+    return set(cluster_index["group_type"][keep].tolist())
+
+
+def create_map(data, selected_commune=None, filter_index=None, accessibility_type=None):
     """
-    Create an interactive map with cultural infrastructure markers and density heatmap.
+    Create the base map: tiles, density layers, legend and bounds.
+
+    Nothing in it depends on the category and type filters, so it stays the
+    same while they change and the page only swaps the equipment layers
+    from create_equipment_layers.
 
     Args:
         data (pd.DataFrame): DataFrame containing cultural infrastructure data
-        selected_categories (list): List of selected categories
-        selected_types (list): List of selected infrastructure types
-        selected_commune (str): Selected commune name
+        selected_commune (int): Selected commune key
+        filter_index (FilterIndex): Index over `data`, to find the rows of
+            the commune without scanning the table
+        accessibility_type (str): Infrastructure type to color the communes
+            by the distance to its nearest equipment, none if None
 
     Returns:
         folium.Map: The created map object
@@ -72,8 +93,14 @@ def create_map(
     ne = [51.2, 8.833]  # Northeast corner
 
     # Determine initial view and zoom
-    if selected_commune:
-        commune_data = data[data["nom_commune"] == selected_commune].iloc[0]
+    if not selected_commune:
+        commune_rows = data.iloc[:0]
+    elif filter_index is not None:
+        commune_rows = data.iloc[filter_index.commune_rows(selected_commune)]
+    else:
+        commune_rows = data[data["commune_key"] == selected_commune]
+    if len(commune_rows):
+        commune_data = commune_rows.iloc[0]
         initial_location = [commune_data["latitude"], commune_data["longitude"]]
         initial_zoom = 13
     else:
@@ -94,99 +121,124 @@ def create_map(
         prefer_canvas=True,
     )
 
-    # Filter data based on selections
-    filtered_data = data.copy()
-    if selected_categories:
-        filtered_data = filtered_data[
-            filtered_data["categorie"].isin(selected_categories)
-        ]
-    if selected_types:
-        filtered_data = filtered_data[
-            filtered_data["type_infrastructure"].isin(selected_types)
-        ]
-    if selected_commune:
-        filtered_data = filtered_data[filtered_data["nom_commune"] == selected_commune]
-
-    # Sample data based on initial zoom level
-    sampled_data = sample_data_by_zoom(filtered_data, initial_zoom)
-
-    # Create marker cluster layer
-    marker_cluster = plugins.MarkerCluster(
-        name="Équipements culturels",
-        overlay=True,
-        control=True,
-        icon_create_function=None,
+    # Filter-independent layers, built once per data version
+    data_version = file_version(HEATMAP_DATA_PATH, CULTURAL_DENSITY_PATH)
+    add_static_layers(m, build_static_layers(data_version))
+    if accessibility_type:
+        accessibility_version = file_version(ACCESSIBILITY_PATH, COMMUNES_PATH)
+        add_static_layers(m, build_accessibility_layers(accessibility_version, accessibility_type))
+
+    return m
+
+
+def create_equipment_layers(
+    data,
+    selected_categories=None,
+    selected_types=None,
+    selected_commune=None,
+    equipment_tiles=None,
+    previous=None,
+):
+    """
+    Create the equipment layers, grouped so that the page can swap them alone.
+
+    Args:
+        data (pd.DataFrame): Equipments matching the filters
+        selected_categories (list): List of selected categories
+        selected_types (list): List of selected infrastructure types
+        selected_commune (int): Selected commune key
+        equipment_tiles (dict): Tile "url" and "metadata" from
+            load_equipment_tiles; when given, individual equipments are drawn
+            from the tile pyramid instead of being embedded in the page
+        previous (dict): State of the equipment layer last shown in the page,
+            to only send the equipments added and removed since
+
+    Returns:
+        tuple: (folium.FeatureGroup holding the layers, state of the
+            equipment layer to pass on to the next update)
+    """
+    group = folium.FeatureGroup(name="Équipements culturels")
+
+    # Show exact clusters below city level and every equipment above it
+    data_version = file_version(CULTURAL_DATA_PATH)
+    cluster_index = None if selected_commune else load_equipment_clusters(data_version)
+    cluster_url = None
+    if cluster_index is not None:
+        cluster_url = build_cluster_asset(data_version)
+    if cluster_index is not None and equipment_tiles is not None:
+        EquipmentTileLayer(
+            equipment_tiles["url"],
+            equipment_tiles["metadata"],
+            TYPE_STYLES,
+            DEFAULT_STYLE,
+            visible_types=visible_tile_types(
+                cluster_index, selected_categories, selected_types
+            ),
+            min_zoom=TILE_CONFIG["DISPLAY_MIN_ZOOM"],
+        ).add_to(group)
+    equipment_layer = EquipmentLayer(
+        data,
+        TYPE_STYLES,
+        DEFAULT_STYLE,
+        cluster_index=cluster_index,
+        selected_categories=selected_categories,
+        selected_types=selected_types,
+        min_zoom=CLUSTER_CONFIG["MIN_ZOOM"],
+        disaggregate_zoom=CLUSTER_CONFIG["DISAGGREGATE_ZOOM"],
+        cluster_url=cluster_url,
+        previous=previous,
+    ).add_to(group)
+    return group, equipment_layer.state
+
+
+@st.cache_resource(show_spinner=False)
+def build_cluster_asset(data_version):
+    """
+    Write the unfiltered cluster payload as a static asset once per data version.
+
+    The equipment layer filters the clusters in the browser, so the asset
+    is fetched once and reused across filter changes.
+
+    Args:
+        data_version (tuple): Version of the source files, used as cache key
+
+    Returns:
+        str or None: URL of the asset, or None if assets are not served and
+            the payload has to be inlined
+    """
+    base_url = static_base_url()
+    if base_url is None:
+        return None
+    payload = build_cluster_payload(
+        load_equipment_clusters(data_version),
+        TYPE_STYLES,
+        DEFAULT_STYLE,
+        CLUSTER_CONFIG["MIN_ZOOM"],
+        CLUSTER_CONFIG["DISAGGREGATE_ZOOM"] - 1,
     )
+    asset = write_asset(to_js_payload(payload), os.path.join(PAYLOAD_CONFIG["ASSET_DIR"], "static"))
+    return f"{base_url}/{PAYLOAD_CONFIG['ASSET_URL_PATH']}/static/{asset['name']}"
 
-    # Add markers with type-specific styling and hover tooltips
-    for _, row in sampled_data.iterrows():
-        style = TYPE_STYLES.get(row["type_infrastructure"], DEFAULT_STYLE)
-
-        # Format population with thousands separator
-        population = f"{int(row['population']):,}".replace(",", " ")
-        density = f"{row['cultural_density']:.1f}"
-
-        # Create tooltip content with population and density info
-        tooltip_content = f"""
-        <div style="text-align: center;">
-            <strong>{row['nom_infrastructure']}</strong><br>
-            Type: {row['type_infrastructure']}<br>
-            Commune: {row['nom_commune']}<br>
-            Population: {population} habitants<br>
-            Équipements culturels pour 1000 hab.: {density}<br>
-            Code INSEE: {row['code_postal']}
-        </div>
-        """
 
-        # Create circle marker
-        folium.CircleMarker(
-            location=[row["latitude"], row["longitude"]],
-            radius=style["radius"],
-            color=style["color"],
-            fill=True,
-            fillColor=style["color"],
-            fillOpacity=0.6,
-            weight=1,
-            opacity=0.8,
-            tooltip=tooltip_content,
-        ).add_to(marker_cluster)
-
-    # Add marker cluster to map
-    marker_cluster.add_to(m)
-
-    # Load heatmap data
+def _add_density_layers(m):
+    """Add the cultural density heatmap, circles and color scale to a map."""
+    # Load density rasters
     try:
-        heatmap_data = load_heatmap_data()
-
-        # Create cultural density heatmap layer (original)
-        heatmap = plugins.HeatMap(
-            data=[
-                [row["latitude"], row["longitude"], row["cultural_density"]]
-                for _, row in heatmap_data.iterrows()
-            ],
-            name="Densité culturelle (heatmap)",
-            min_opacity=0.3,
-            max_opacity=0.8,
-            radius=25,
-            blur=15,
-            overlay=True,
-            control=True,
-            show=False,  # Hidden by default
-        )
-        heatmap.add_to(m)
+        rasters = load_density_rasters()
+
+        # Cultural density surface, rasterized offline per zoom level, only
+        # if its images are served
+        if rasters["url"] is not None:
+            DensityRasterLayer(
+                rasters["url"],
+                rasters["metadata"],
+                name="Densité culturelle (heatmap)",
+                show=False,  # Hidden by default
+            ).add_to(m)
 
         # Load and add cultural density scatter plot layer
         try:
-            cultural_density_data = pd.read_csv(CULTURAL_DENSITY_PATH, sep="\t")
-
-            # Create a feature group for the scatter plot
-            scatter_group = folium.FeatureGroup(
-                name="Densité culturelle (cercles)", show=False
-            )
-
-            # Calculate size range for better visualization
-            max_facilities = cultural_density_data["nbr_total_culturel"].max()
-            min_facilities = cultural_density_data["nbr_total_culturel"].min()
+            cultural_density_data = load_density_scores()
 
             # Calculate density range for color mapping
             max_density = cultural_density_data[
@@ -203,42 +255,12 @@ def create_map(
                 vmax=max_density,
             )
 
-            for _, row in cultural_density_data.iterrows():
-                facilities = row["nbr_total_culturel"]
-                density = row["Nbre culturels pour1000 habitants"]
-
-                # Scale radius using square root to emphasize differences in lower values
-                # Base size of 1000m for single facility, scaling up with square root
-                radius = 1000 + 300 * np.sqrt(facilities)
-
-                # Cap the maximum radius at 3000m to keep large cities reasonable
-                radius = min(radius, 5000)
-
-                # Format tooltip information
-                tooltip_content = f"""
-                <div style="text-align: center;">
-                    <strong>{row['Commune']}</strong><br>
-                    Population: {int(row['Population_Totale']):,} habitants<br>
-                    Équipements culturels: {int(facilities)}<br>
-                    Densité culturelle: {density:.2f} pour 1000 hab.
-                </div>
-                """
-
-                # Create circle with size based on total facilities and color based on density
-                folium.Circle(
-                    location=[row["latitude"], row["longitude"]],
-                    radius=radius,
-                    color=colormap(density),
-                    fill=True,
-                    fillColor=colormap(density),
-                    fillOpacity=0.7,
-                    weight=1,
-                    opacity=0.8,
-                    tooltip=tooltip_content,
-                ).add_to(scatter_group)
-
-            # Add the scatter group to the map
-            scatter_group.add_to(m)
+            # One FeatureCollection, sized and colored column-wise
+            DensityCircleLayer(
+                build_density_circles(cultural_density_data, colormap),
+                name="Densité culturelle (cercles)",
+                show=False,
+            ).add_to(m)
 
             # Add colormap to the map
             colormap.add_to(m)
@@ -248,12 +270,11 @@ def create_map(
             print(f"Error loading cultural density scatter data: {e}")
 
     except Exception as e:
-        print(f"Error loading heatmap data: {e}")
+        print(f"Error loading density rasters: {e}")
 
-    # Add layer control
-    folium.LayerControl().add_to(m)
 
-    # Add legend with larger dots
+def _legend_html():
+    """Build the legend of the infrastructure types and density layers."""
     legend_html = """
         <div style="position: fixed; bottom: 50px; right: 50px; z-index: 1000; background-color: white; 
                     padding: 10px; border-radius: 5px; border: 2px solid rgba(0,0,0,0.2); max-height: 300px; 
@@ -297,9 +318,15 @@ def create_map(
         </div>
     """
     legend_html += "</div>"
-    m.get_root().html.add_child(folium.Element(legend_html))
+    return legend_html
+
+
+def _bounds_script(map_name):
+    """Build the script keeping the map view inside metropolitan France."""
+    # Set bounds for France
+    sw = [41.333, -4.833]  # Southwest corner (adjusted for Corsica)
+    ne = [51.2, 8.833]  # Northeast corner
 
-    # Add bounds control
     bounds_script = f"""
         var southWest = L.latLng({sw[0]}, {sw[1]});
         var northEast = L.latLng({ne[0]}, {ne[1]});
@@ -336,11 +363,93 @@ def create_map(
                 map.setZoom(5);
             }}
         }});
+    """
+    return bounds_script.replace("map.", f"{map_name}.")
+
 
-        if ({selected_commune is not None}) {{
-            map.setZoom(13);
-        }}
+@st.cache_resource(show_spinner="Building map layers...")
+def build_static_layers(data_version):
     """
-    m.get_root().script.add_child(folium.Element(bounds_script))
+    Build the filter-independent layers once per data version.
 
-    return m
+    The density layers are rendered on a scratch map and kept as
+    pre-rendered fragments, together with the legend and the bounds script,
+    so that a rerun only pays for the equipment layers.
+
+    Args:
+        data_version (tuple): Version of the source files, used as cache key
+
+    Returns:
+        list: Pre-rendered fragments, in rendering order
+    """
+    scratch = folium.Map(tiles=None)
+    scratch._id = PRERENDERED_MAP_ID
+    _add_density_layers(scratch)
+    _externalize_static_payloads(scratch)
+    fragments = prerender_children(scratch)
+    fragments.append({"name": "Legend", "html": [("legend", _legend_html())]})
+    fragments.append(
+        {
+            "name": "BoundsControl",
+            "script": [("bounds_control", _bounds_script(scratch.get_name()))],
+        }
+    )
+    return fragments
+
+
+@st.cache_resource(show_spinner="Building accessibility layer...")
+def build_accessibility_layers(data_version, type_name):
+    """
+    Build the accessibility layer of an infrastructure type once per data version.
+
+    The communes are colored by the distance to the nearest equipment of
+    the type, and rendered like build_static_layers.
+
+    Args:
+        data_version (tuple): Version of the source files, used as cache key
+        type_name (str): Infrastructure type
+
+    Returns:
+        list: Pre-rendered fragments, in rendering order
+    """
+    table = load_accessibility(type_name)
+    if table is None or table.empty:
+        return []
+    communes = load_communes(file_version(CULTURAL_DATA_PATH, COMMUNES_PATH))
+    table = table.merge(communes[["commune_key", "nom_commune", "latitude", "longitude"]], on="commune_key")
+    # Near is green, far is red
+    colormap = branca.colormap.LinearColormap(
+        colors=["#1a9850", "#fee08b", "#d73027"], vmin=0, vmax=ACCESSIBILITY_CONFIG["MAX_DISTANCE_KM"]
+    )
+    colormap.caption = f"Distance au plus proche équipement « {type_name} » (km)"
+    radius_km = ACCESSIBILITY_CONFIG["RADII_KM"][0]
+    scratch = folium.Map(tiles=None)
+    scratch._id = PRERENDERED_MAP_ID
+    AccessibilityLayer(
+        build_accessibility_points(table, colormap, count_column(radius_km)),
+        count_label=f"Équipements à moins de {radius_km} km",
+        name=f"Accessibilité : {type_name}",
+    ).add_to(scratch)
+    colormap.add_to(scratch)
+    _externalize_static_payloads(scratch)
+    return prerender_children(scratch)
+
+
+def _externalize_static_payloads(scratch):
+    """Move the large payloads of a scratch map to assets, if assets are served."""
+    base_url = static_base_url()
+    if base_url is None:
+        return
+    # Never pruned, since the cached fragments keep referring to them
+    externalize_payloads(
+        scratch,
+        os.path.join(PAYLOAD_CONFIG["ASSET_DIR"], "static"),
+        f"{base_url}/{PAYLOAD_CONFIG['ASSET_URL_PATH']}/static",
+        PAYLOAD_CONFIG["EXTERNAL_MIN_BYTES"],
+    )
+
+
+def add_static_layers(m, fragments):
+    """Add pre-rendered fragments from build_static_layers to a map."""
+    for fragment in fragments:
+        PrerenderedElement(fragment).add_to(m)
@@ -0,0 +1,131 @@
+"""Size accounting and delivery of the map payload."""
+
+import contextlib
+import logging
+
+from folium import FeatureGroup
+
+from ..data.assets import write_asset
+from .layers import EquipmentLayer, PayloadLayer, PrerenderedElement
+
+logger = logging.getLogger(__name__)
+
+
+def externalize_payloads(m, out_dir, base_url, min_bytes, max_age=None):
+    """
+    Move the data of the large layers of a map to separately fetched assets.
+
+    Layers nested in feature groups are included. The full equipment list
+    an equipment update falls back on is always written as an asset.
+
+    Args:
+        m (folium.Map or folium.FeatureGroup): Map whose layers to externalize
+        out_dir (str): Asset directory, served at `base_url`
+        base_url (str): URL of the asset directory
+        min_bytes (int): Only externalize payloads at least this large
+        max_age (float): Seconds an asset of `out_dir` is kept after it was
+            last written
+    """
+    for child in m._children.values():
+        if isinstance(child, FeatureGroup):
+            externalize_payloads(child, out_dir, base_url, min_bytes, max_age)
+            continue
+        if not isinstance(child, PayloadLayer):
+            continue
+        if isinstance(child, EquipmentLayer) and child.snapshot_js and child.snapshot_url is None:
+            asset = write_asset(child.snapshot_js, out_dir, max_age=max_age)
+            child.snapshot_url = f"{base_url}/{asset['name']}"
+        if child.payload_url is not None or len(child.payload_js) < min_bytes:
+            continue
+        asset = write_asset(child.payload_js, out_dir, max_age=max_age)
+        child.payload_url = f"{base_url}/{asset['name']}"
+        child.payload_asset = asset
+
+
+def _script_size(element):
+    """Size of the script an element adds to the page, without its children."""
+    script = element._template.module.__dict__.get("script")
+    if script is None:
+        return 0
+    with contextlib.suppress(Exception):
+        return len(script(element, {}).encode("utf-8"))
+    return 0
+
+
+def _inline_size(element):
+    size = _script_size(element)
+    if isinstance(element, PrerenderedElement):
+        size += sum(
+            len(text.encode("utf-8"))
+            for part in ("header", "html")
+            for _, text in element.fragment.get(part, [])
+        )
+    return size + sum(_inline_size(child) for child in element._children.values())
+
+
+def _asset_size(element):
+    """Raw and compressed size of the assets of an element and its children."""
+    asset = getattr(element, "payload_asset", None) or {}
+    raw, compressed = asset.get("bytes", 0), asset.get("compressed_bytes", 0)
+    for child in element._children.values():
+        child_raw, child_compressed = _asset_size(child)
+        raw += child_raw
+        compressed += child_compressed
+    return raw, compressed
+
+
+def layer_sizes(m, feature_groups=()):
+    """
+    Measure the weight of each top-level element of a map.
+
+    Args:
+        m (folium.Map): Rendered map
+        feature_groups (list): Feature groups sent to the page separately
+
+    Returns:
+        list: One dict per element with its "layer" name, the "inline_bytes"
+            of its code in the page, and the raw and compressed size of its
+            fetched assets ("asset_bytes", "compressed_bytes")
+    """
+    sizes = [{"layer": "Carte", "inline_bytes": _script_size(m), "asset_bytes": 0, "compressed_bytes": 0}]
+    children = [child for child in m._children.values() if child not in feature_groups]
+    for child in children + list(feature_groups):
+        asset_bytes, compressed_bytes = _asset_size(child)
+        sizes.append(
+            {
+                "layer": getattr(child, "layer_name", None) or child._name,
+                "inline_bytes": _inline_size(child),
+                "asset_bytes": asset_bytes,
+                "compressed_bytes": compressed_bytes,
+            }
+        )
+    return sizes
+
+
+def check_payload_budget(sizes, budget_bytes):
+    """
+    Log the size of each layer and warn when the map exceeds its budget.
+
+    The transferred size counts the inline code and the compressed assets.
+
+    Args:
+        sizes (list): Layer sizes from layer_sizes
+        budget_bytes (int): Maximum transferred size
+
+    Returns:
+        int: Transferred size of the map in bytes
+    """
+    total = 0
+    for size in sizes:
+        transferred = size["inline_bytes"] + size["compressed_bytes"]
+        total += transferred
+        logger.info(
+            "Map layer %s: %d bytes inline, %d bytes asset (%d compressed)",
+            size["layer"],
+            size["inline_bytes"],
+            size["asset_bytes"],
+            size["compressed_bytes"],
+        )
+    if total > budget_bytes:
+        logger.warning("Map payload of %d bytes exceeds the %d bytes budget", total, budget_bytes)
+    return total
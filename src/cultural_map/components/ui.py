@@ -1,8 +1,22 @@
 """UI components for the cultural map application."""
 
+import folium
+import pandas as pd
 import streamlit as st
-from streamlit_folium import folium_static
+from streamlit_folium import folium_static, st_folium
 import plotly.graph_objects as go
+from ..config.settings import (
+    COMMUNE_SEARCH_CONFIG,
+    NEARBY_CONFIG,
+    PAYLOAD_CONFIG,
+    SCORE_CONFIG,
+    VIEWPORT_CONFIG,
+)
+from ..data.loader import get_unique_values, static_base_url
+from ..data.scoring import ScoreParameters
+from .payload import check_payload_budget, externalize_payloads, layer_sizes
+
+EQUIPMENT_STATE_KEY = "map_equipment"
 
 
 def setup_page():
@@ -267,10 +281,50 @@ def setup_page():
     )
 
 
+def commune_labels(communes, keys):
+    """
+    Get the label of each commune shown in the commune filter.
+
+    Communes sharing a name are told apart by their department.
+
+    Args:
+        communes (pd.DataFrame): Commune dimension
+        keys (array-like): Commune keys to label
+
+    Returns:
+        dict: Label per commune key, ordered by label
+    """
+    rows = communes[communes["commune_key"].isin(keys)]
+    names = rows["nom_commune"].astype(str)
+    homonyms = names.duplicated(keep=False)
+    labels = names.where(~homonyms, names + " (" + rows["departement"].astype(str) + ")")
+    labels = pd.Series(labels.to_numpy(), index=rows["commune_key"].tolist()).sort_values()
+    return labels.to_dict()
+
+
 def create_sidebar(
-    data, chat_placeholder, data_calculated_events=None, visualization_func=None
+    data,
+    chat_placeholder,
+    data_calculated_events=None,
+    visualization_func=None,
+    communes=None,
+    options=None,
+    commune_search=None,
 ):
-    """Create the sidebar with filters and visualization."""
+    """
+    Create the sidebar with filters and visualization.
+
+    The values of the filters are those of `options`, as returned by
+    loader.get_unique_values, or else are read from `data`. With a
+    `commune_search` index, the commune selector only lists the best
+    matches of a search box instead of every commune.
+
+    Returns:
+        tuple: Selected categories, selected types and selected commune key
+            (None for all communes)
+    """
+    if options is None:
+        options = get_unique_values(data)
     with st.sidebar:
         # Add custom CSS
         st.markdown(
@@ -343,7 +397,7 @@ def create_sidebar(
             with col1:
                 # Categories filter
                 # st.markdown('<div class="categories-filter">', unsafe_allow_html=True)
-                categories = sorted(data["categorie"].unique())
+                categories = options["categories"]
                 selected_categories = st.multiselect(
                     "Catégories",
                     options=categories,
@@ -355,7 +409,7 @@ def create_sidebar(
             with col2:
                 # Types filter with color coding
                 # st.markdown('<div class="types-filter">', unsafe_allow_html=True)
-                types = sorted(data["type_infrastructure"].unique())
+                types = options["types"]
                 selected_types = st.multiselect(
                     "Types d'infrastructure",
                     options=types,
@@ -366,11 +420,22 @@ def create_sidebar(
 
         # Commune filter (full width)
         # st.markdown('<div class="commune-filter">', unsafe_allow_html=True)
-        communes = sorted(data["nom_commune"].unique())
+        if commune_search is None or not COMMUNE_SEARCH_CONFIG["ENABLED"]:
+            query = ""
+            labels = commune_labels(communes, options["communes"])
+        else:
+            query = st.text_input(
+                "Rechercher une commune",
+                placeholder="Nom ou code INSEE",
+                help="Les accents, les tirets et les abréviations St/Ste sont ignorés",
+            )
+            labels = dict(commune_search.search(query, COMMUNE_SEARCH_CONFIG["LIMIT"])) if query else {}
         selected_commune = st.selectbox(
             "Commune",
-            options=[""] + communes,
-            format_func=lambda x: "Toutes les communes" if x == "" else x,
+            options=[None] + list(labels),
+            # The best match of a search is selected right away
+            index=1 if query and labels else 0,
+            format_func=lambda x: "Toutes les communes" if x is None else labels[x],
             help="Sélectionnez une commune spécifique",
         )
         # st.markdown("</div>", unsafe_allow_html=True)
@@ -391,7 +456,7 @@ def create_sidebar(
 
             # Generate and display the visualization
             try:
-                fig = visualization_func(data_calculated_events, selected_commune if selected_commune else None)
+                fig = visualization_func(data_calculated_events, selected_commune, communes)
                 if fig is not None:
                     st.plotly_chart(fig, use_container_width=True)
                 else:
@@ -404,7 +469,205 @@ def create_sidebar(
         return selected_categories, selected_types, selected_commune
 
 
-def show_map(map_object):
-    """Display the map in the main area."""
-    # Display the map with fixed dimensions
-    folium_static(map_object, width=1920, height=1080)
+def get_map_viewport(selected_commune=None):
+    """
+    Get the bounds and zoom last reported by the map component.
+
+    The viewport is dropped when the selected commune changes, so that the
+    map recenters on the new commune.
+
+    Args:
+        selected_commune (int): Currently selected commune key
+
+    Returns:
+        dict or None: "bounds" as (south, west, north, east), "center" and "zoom"
+    """
+    if st.session_state.get("map_commune") != selected_commune:
+        st.session_state["map_commune"] = selected_commune
+        return None
+
+    state = st.session_state.get(VIEWPORT_CONFIG["MAP_KEY"]) or {}
+    bounds, zoom = state.get("bounds"), state.get("zoom")
+    if not bounds or zoom is None:
+        return None
+    south_west, north_east = bounds["_southWest"], bounds["_northEast"]
+    if south_west.get("lat") is None or north_east.get("lat") is None:
+        return None
+    south, west = south_west["lat"], south_west["lng"]
+    north, east = north_east["lat"], north_east["lng"]
+    return {
+        "bounds": (south, west, north, east),
+        "center": ((south + north) / 2, (west + east) / 2),
+        "zoom": int(zoom),
+    }
+
+
+def show_payload_panel(sizes, total, budget_bytes):
+    """Show the size of each map layer in a sidebar debug panel."""
+    with st.sidebar.expander("Poids de la carte", expanded=False):
+        table = pd.DataFrame(sizes).set_index("layer") / 1000
+        table.columns = ["Inline (ko)", "Données (ko)", "Données compressées (ko)"]
+        st.dataframe(table.round(1))
+        st.write(f"Total transféré : {total / 1000:.0f} ko (budget : {budget_bytes / 1000:.0f} ko)")
+        if total > budget_bytes:
+            st.warning("La carte dépasse le budget de poids configuré.")
+
+
+def show_score_panel(engine, selected_commune=None):
+    """
+    Let the user tune the cultural score and show the resulting ranking.
+
+    Scores are recomputed from the statistics of the engine at each change,
+    without grouping the data again.
+
+    Args:
+        engine (ScoreEngine): Per-commune statistics from load_score_engine
+        selected_commune (int): Selected commune key
+    """
+    with st.sidebar.expander("Score culturel", expanded=False):
+        per_inhabitants = st.select_slider(
+            "Équipements pour N habitants",
+            options=SCORE_CONFIG["PER_INHABITANTS"],
+            value=SCORE_CONFIG["DEFAULT_PER_INHABITANTS"],
+        )
+        threshold = st.slider(
+            "Seuil du score", 1, SCORE_CONFIG["MAX_THRESHOLD"], SCORE_CONFIG["DEFAULT_THRESHOLD"]
+        )
+        weights = tuple(
+            (category, st.slider(f"Poids {category}", 0.0, SCORE_CONFIG["MAX_WEIGHT"], 1.0, 0.1))
+            for category in engine.groups["categorie"].unique()
+        )
+        scores = engine.score(ScoreParameters(per_inhabitants, threshold, weights))
+        table = engine.communes[["commune_key", "Commune"]].assign(score=scores).dropna()
+
+        if selected_commune:
+            row = table[table["commune_key"] == selected_commune]
+            if len(row):
+                st.metric(row["Commune"].iloc[0], f"{row['score'].iloc[0]:.2f}")
+        st.write(
+            f"Score moyen : {table['score'].mean():.2f}, "
+            f"{(table['score'] >= threshold).sum()} communes au seuil"
+        )
+        top = table.nlargest(SCORE_CONFIG["TOP_COMMUNES"], "score")
+        st.dataframe(top[["Commune", "score"]].round(2), hide_index=True)
+
+
+def select_accessibility_type(types):
+    """
+    Let the user color the communes by their access to an infrastructure type.
+
+    Returns:
+        str or None: Selected type, None for no coloring
+    """
+    return st.sidebar.selectbox(
+        "Accessibilité des communes",
+        options=[None] + list(types),
+        format_func=lambda x: "Aucune" if x is None else x,
+        help="Colore les communes selon la distance à l'équipement le plus proche du type choisi",
+    )
+
+
+def show_nearby_panel(spatial_index, data, communes, selected_commune=None):
+    """
+    Show the equipments within a chosen distance of the selected commune.
+
+    Args:
+        spatial_index (GridIndex): Index over the coordinates of `data`
+        data (pd.DataFrame): Equipments
+        communes (pd.DataFrame): Commune dimension
+        selected_commune (int): Selected commune key
+    """
+    with st.sidebar.expander("Équipements à proximité", expanded=False):
+        commune = communes[communes["commune_key"] == selected_commune] if selected_commune else communes.iloc[:0]
+        if commune.empty:
+            st.caption("Sélectionnez une commune")
+            return
+        radius = st.slider(
+            "Rayon (km)", 1, NEARBY_CONFIG["MAX_RADIUS_KM"], NEARBY_CONFIG["DEFAULT_RADIUS_KM"]
+        )
+        positions, _ = spatial_index.query_radius(
+            commune["latitude"].iloc[0], commune["longitude"].iloc[0], radius
+        )
+        st.metric(f"Équipements à moins de {radius} km", len(positions))
+        nearby = data.iloc[positions]
+        counts = nearby["type_infrastructure"].value_counts().rename_axis("Type").reset_index(name="Nombre")
+        st.dataframe(counts[counts["Nombre"] > 0], hide_index=True)
+
+
+def get_equipment_state(selected_commune=None):
+    """
+    Get the state of the equipment layer shown in the page, if it is still there.
+
+    Selecting another commune recenters and reloads the whole map, which
+    drops the equipments the page held.
+
+    Args:
+        selected_commune (int): Currently selected commune key
+
+    Returns:
+        dict or None: State returned by create_equipment_layers on the last run
+    """
+    state = st.session_state.get(EQUIPMENT_STATE_KEY)
+    if state is None or state["commune"] != selected_commune:
+        return None
+    return state["layer"]
+
+
+def save_equipment_state(state, selected_commune=None):
+    """Remember the state of the equipment layer sent to the page."""
+    st.session_state[EQUIPMENT_STATE_KEY] = {"commune": selected_commune, "layer": state}
+
+
+def show_map(map_object, viewport=None, equipment=None):
+    """
+    Display the map in the main area.
+
+    With viewport loading enabled the map reports its bounds and zoom back
+    to the app, and the last viewport is restored without reloading the map.
+    The equipment layers are then sent apart from the map, so that changing
+    the filters swaps them in the page while the rest of the map stays
+    loaded. Large layer data is fetched as compressed assets instead of
+    being inlined, when static_base_url serves them, and the size of each
+    layer is logged.
+
+    Args:
+        map_object (folium.Map): The map to display
+        viewport (dict): Viewport from get_map_viewport, if any
+        equipment (folium.FeatureGroup): Equipment layers from
+            create_equipment_layers, if any
+    """
+    feature_groups = [] if equipment is None else [equipment]
+    base_url = static_base_url()
+    if base_url is not None:
+        for element in [map_object] + feature_groups:
+            externalize_payloads(
+                element,
+                PAYLOAD_CONFIG["ASSET_DIR"],
+                f"{base_url}/{PAYLOAD_CONFIG['ASSET_URL_PATH']}",
+                PAYLOAD_CONFIG["EXTERNAL_MIN_BYTES"],
+                max_age=PAYLOAD_CONFIG["MAX_ASSET_AGE"],
+            )
+    if not VIEWPORT_CONFIG["ENABLED"]:
+        for group in feature_groups:
+            group.add_to(map_object)
+        folium.LayerControl().add_to(map_object)
+        # Display the map with fixed dimensions
+        folium_static(map_object, width=1920, height=1080)
+        feature_groups = []
+    else:
+        st_folium(
+            map_object,
+            key=VIEWPORT_CONFIG["MAP_KEY"],
+            width=1920,
+            height=1080,
+            returned_objects=["bounds", "zoom"],
+            center=viewport["center"] if viewport else None,
+            zoom=viewport["zoom"] if viewport else None,
+            feature_group_to_add=feature_groups or None,
+            layer_control=folium.LayerControl(),
+        )
+
+    sizes = layer_sizes(map_object, feature_groups)
+    total = check_payload_budget(sizes, PAYLOAD_CONFIG["BUDGET_BYTES"])
+    if PAYLOAD_CONFIG["DEBUG_PANEL"]:
+        show_payload_panel(sizes, total, PAYLOAD_CONFIG["BUDGET_BYTES"])
@@ -4,8 +4,17 @@ import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 
 
-def creating_visualisation(data: pd.DataFrame, nom_commune: str = None) -> go.Figure:
-    
+def total_commune_population(data: pd.DataFrame, communes: pd.DataFrame = None) -> int:
+    """Sum the population of the communes holding the equipments, counting each commune once."""
+    keys = data['commune_key'].unique()
+    if communes is not None:
+        return int(communes.loc[communes['commune_key'].isin(keys), 'population'].sum())
+    return int(data.drop_duplicates('commune_key')['population'].sum())
+
+
+def creating_visualisation(data: pd.DataFrame, commune_key: int = None, communes: pd.DataFrame = None) -> go.Figure:
+    """Chart the equipments of a commune, or of all communes, from CulturalDataset.type_counts."""
+
     # Define the TYPE_STYLES
     TYPE_STYLES = {
         "Monument": {"color": "#e41a1c", "radius": 8},  # Red
@@ -27,13 +36,15 @@ def creating_visualisation(data: pd.DataFrame, nom_commune: str = None) -> go.Fi
     }
     
     # Prepare data for visualization
-    if nom_commune:
-        df = data[data["nom_commune"] == nom_commune].copy()
+    if commune_key:
+        df = data[data["commune_key"] == commune_key]
     else:
-        df = data.copy()  # Use all data if no commune is selected
+        df = data  # Use all data if no commune is selected
     
     # Create a summary dataframe for visualization
-    viz_data = df.groupby(['categorie', 'type_infrastructure']).size().reset_index(name='count')
+    viz_data = df.groupby(['categorie', 'type_infrastructure'], observed=True)['count'].sum().reset_index()
+    # Plotly cannot build the sunburst hierarchy from categorical labels
+    viz_data[['categorie', 'type_infrastructure']] = viz_data[['categorie', 'type_infrastructure']].astype(str)
     
     type_colors = {key: TYPE_STYLES[key]["color"] for key in TYPE_STYLES}
     viz_data['color'] = viz_data['type_infrastructure'].map(type_colors)
@@ -53,7 +64,7 @@ def creating_visualisation(data: pd.DataFrame, nom_commune: str = None) -> go.Fi
     )
 
     # If a commune is selected, add a bar chart and detailed information
-    if nom_commune:
+    if commune_key:
         # Bar Chart
         fig_bar = px.bar(
             viz_data.sort_values(by=["count", "categorie"], ascending=[False, True]),
@@ -87,7 +98,8 @@ def creating_visualisation(data: pd.DataFrame, nom_commune: str = None) -> go.Fi
             fig.add_trace(trace, row=2, col=1)
 
         # Add Commune title annotation
-        commune_title = f"<b>Commune:</b> {df['nom_commune'].iloc[0]}"
+        commune = communes[communes['commune_key'] == commune_key].iloc[0] if communes is not None else df.iloc[0]
+        commune_title = f"<b>Commune:</b> {commune['nom_commune']}"
         fig.add_annotation(
             text=commune_title,  
             x=0.5,  
@@ -100,7 +112,7 @@ def creating_visualisation(data: pd.DataFrame, nom_commune: str = None) -> go.Fi
         )
 
         # Add Population annotation below the Commune title
-        population_number = int(df['population'].iloc[0]) 
+        population_number = int(commune['population']) if pd.notna(commune['population']) else 0
         fig.add_annotation(
             text=f"<b>Population:</b> {population_number:,}",  
             x=0.5,  
@@ -113,46 +125,6 @@ def creating_visualisation(data: pd.DataFrame, nom_commune: str = None) -> go.Fi
         )
     
     # If no specific commune is selected, show only the sunburst and summary for all communes
-    elif nom_commune == 'Toutes les communes':
-        fig = make_subplots(
-            rows=1,
-            cols=1,
-            row_heights=[1],  
-            vertical_spacing=0.1,
-            specs=[[{"type": "sunburst"}]],
-        )
-
-        # Add Sunburst trace
-        for trace in fig_sunburst.data:
-            fig.add_trace(trace, row=1, col=1)
-
-        # Add title for "Toute la France"
-        fig.add_annotation(
-            text="<b>Commune:</b> Toute la France",
-            x=0.5,
-            y=1.15,
-            showarrow=False,
-            font=dict(size=22, color="black", family="Arial"),
-            align="center",
-            xref="paper",
-            yref="paper"
-        )
-
-        # Sum the population across all communes
-        df_grouped = df.groupby('code_postal')['population'].unique().reset_index()
-        total_population = int(df_grouped['population'].apply(lambda x: x[0]).sum())
-
-        fig.add_annotation(
-            text=f"<b>Population:</b> {total_population:,}",  
-            x=0.5,  
-            y=1.09,  
-            showarrow=False,
-            font=dict(size=22, color="black", family="Arial"), 
-            align="center", 
-            xref="paper", 
-            yref="paper"  
-        )
-    
     else:
         fig = make_subplots(
             rows=1,
@@ -179,8 +151,7 @@ def creating_visualisation(data: pd.DataFrame, nom_commune: str = None) -> go.Fi
         )
 
         # Sum the population across all communes
-        df_grouped = df.groupby('code_postal')['population'].unique().reset_index()
-        total_population = int(df_grouped['population'].apply(lambda x: x[0]).sum())
+        total_population = total_commune_population(df, communes)
 
         fig.add_annotation(
             text=f"<b>Population:</b> {total_population:,}",  
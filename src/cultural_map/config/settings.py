@@ -18,6 +18,110 @@ MAP_CONFIG = {
     "MAX_ZOOM": 18
 }
 
+# Equipment clustering configuration
+CLUSTER_CONFIG = {
+    "INDEX_PATH": "data/cluster_index.npz",
+    "MIN_ZOOM": 5,
+    "MAX_ZOOM": 18,
+    "RADIUS_PX": 60,
+    "DISAGGREGATE_ZOOM": 13  # Individual equipments from this zoom on
+}
+
+# Viewport-driven marker loading
+VIEWPORT_CONFIG = {
+    "ENABLED": True,
+    "MAP_KEY": "map",
+    "MARGIN": 0.5,  # Fraction of the visible box added on each side
+    "SNAP": 0.25,  # Loaded box is snapped outward to this step in degrees
+    "CELL_SIZE": 0.05  # Spatial index cell size in degrees
+}
+
+# Pre-built map assets, fetched by the browser. By default Streamlit serves
+# them itself at app/static, on the origin of the page (the "static" folder
+# next to app.py, with server.enableStaticServing in .streamlit/config.toml)
+STATIC_SERVER_CONFIG = {
+    "ROOT": "static",
+    "PUBLIC_URL": None,  # Base URL of ROOT on another server (CDN, reverse proxy)
+    "HOST": "127.0.0.1",
+    "PORT": None  # Also serve ROOT from this process on this port
+}
+
+# Equipment tile pyramid, served from STATIC_SERVER_CONFIG["ROOT"]/tiles
+TILE_CONFIG = {
+    "ENABLED": True,  # Used only once the pyramid has been built
+    "DIR": "static/tiles",
+    "URL_PATH": "tiles",
+    "MIN_ZOOM": 5,
+    "MAX_ZOOM": 14,
+    "DISPLAY_MIN_ZOOM": 13  # Clusters are shown below this zoom
+}
+
+# Cultural density rasters, served from STATIC_SERVER_CONFIG["ROOT"]/density
+DENSITY_RASTER_CONFIG = {
+    "DIR": "static/density",
+    "URL_PATH": "density",
+    "MIN_ZOOM": 5,
+    "MAX_ZOOM": 9,  # Stretched when zooming further
+    "RADIUS_PX": 25,
+    "BLUR_PX": 15,
+    "MIN_OPACITY": 0.3,
+    "MAX_OPACITY": 0.8
+}
+
+# Map payload budget and delivery
+PAYLOAD_CONFIG = {
+    "BUDGET_BYTES": 2_000_000,  # Warn when the map weighs more than this
+    "EXTERNAL_MIN_BYTES": 100_000,  # Larger layer data is fetched as an asset
+    "ASSET_DIR": "static/assets",
+    "ASSET_URL_PATH": "assets",
+    "MAX_ASSET_AGE": 3600,  # Seconds a per-rerun asset is kept after it was last written
+    "DEBUG_PANEL": True
+}
+
+# Embedded equipment database, filtering in SQL (data/database.py)
+DATABASE_CONFIG = {
+    "ENABLED": True,  # Used only once the database has been built
+    "PATH": "data/cultural_data.sqlite",
+    "CELL_SIZE": 0.1,  # Spatial index cell size in degrees
+    "POOL_SIZE": 4  # Read-only connections shared by the sessions
+}
+
+# Cultural score panel (data/scoring.py)
+SCORE_CONFIG = {
+    "PER_INHABITANTS": [100, 1000, 10000],  # Choices of N in "elements per N inhabitants"
+    "DEFAULT_PER_INHABITANTS": 1000,
+    "MAX_THRESHOLD": 50,
+    "DEFAULT_THRESHOLD": 10,
+    "MAX_WEIGHT": 3.0,  # Largest category weight
+    "TOP_COMMUNES": 10  # Communes listed by the panel
+}
+
+# Commune search box of the sidebar
+COMMUNE_SEARCH_CONFIG = {
+    "ENABLED": True,  # Otherwise every commune is listed in the selector
+    "LIMIT": 10  # Suggestions shown for a search
+}
+
+# Equipments around the selected commune, in the sidebar
+NEARBY_CONFIG = {
+    "DEFAULT_RADIUS_KM": 15,
+    "MAX_RADIUS_KM": 50
+}
+
+# Accessibility of the equipments per commune (data/accessibility.py)
+ACCESSIBILITY_CONFIG = {
+    "RADII_KM": (5, 10, 20),  # Equipments of each type counted within these distances
+    "CELL_SIZE": 0.05,  # Spatial index cell size in degrees
+    "MAX_DISTANCE_KM": 30  # Top of the map color scale
+}
+
+# Data preparation (data/prepare_data.py)
+PREPARE_CONFIG = {
+    "CHUNK_ROWS": None,  # Rows read at once in streaming mode, None reads the inputs whole
+    "OSM_MAX_DISTANCE": 0.1,  # Degrees from an OpenStreetMap feature to its commune center
+    "OSM_DUPLICATE_DISTANCE_KM": 0.1,  # An equipment of the same type this close makes a feature a duplicate
+}
+
 # Category colors
 CATEGORY_COLORS = {
     "patrimoine": "blue",
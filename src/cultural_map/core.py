@@ -1,51 +1,110 @@
 """Core functionality for the cultural map application."""
 
-import pandas as pd
+import os
+
+import numpy as np
 import streamlit as st
-from .components.ui import setup_page, create_sidebar, show_map
-from .components.map import create_map
+from .components.ui import (
+    setup_page,
+    create_sidebar,
+    get_equipment_state,
+    get_map_viewport,
+    save_equipment_state,
+    select_accessibility_type,
+    show_map,
+    show_nearby_panel,
+    show_score_panel,
+)
+from .components.map import create_equipment_layers, create_map
 from .components.visualisation import creating_visualisation
-from .data.loader import load_cultural_data
+from .config.settings import CLUSTER_CONFIG, DATABASE_CONFIG, MAP_CONFIG, TILE_CONFIG, VIEWPORT_CONFIG
+from .data.database import select_rows
+from .data.loader import (
+    ACCESSIBILITY_PATH,
+    COMMUNES_PATH,
+    CULTURAL_DATA_PATH,
+    file_version,
+    load_database,
+    load_dataset,
+    load_equipment_tiles,
+    load_score_engine,
+    static_base_url,
+)
+from .data.spatial_index import expand_bounds, snap_bounds
 
 
-@st.cache_data(show_spinner="Loading cultural data...")
 def load_data():
-    """Load the preprocessed cultural data."""
-    return load_cultural_data()
+    """Get the equipments dataset shared by the sessions, reloaded when its files change."""
+    return load_dataset(file_version(CULTURAL_DATA_PATH, COMMUNES_PATH))
+
 
+def filter_data(
+    dataset, selected_categories=None, selected_types=None, selected_commune=None, rows=None
+):
+    """
+    Filter data based on selections, with the filter index.
 
-@st.cache_data
-def load_calculated_events_data():
-    """Load and cache the calculated events data."""
-    # Load the cultural data
-    df = load_cultural_data()
-    
-    # Group by commune and count infrastructures
-    result = df.groupby(['nom_commune', 'code_postal', 'latitude', 'longitude', 'population']).size().reset_index(name='nombre_equipements')
-    
-    # Calculate cultural density (equipments per 1000 inhabitants)
-    result['densite_culturelle'] = (result['nombre_equipements'] / result['population']) * 1000
-    
-    return result
+    The table is neither copied nor hashed: the index, built once over it,
+    gives the positions of the matching rows.
+
+    Args:
+        dataset (CulturalDataset): Equipments, as returned by load_data
+        selected_categories (list): Categories to keep, all if empty
+        selected_types (list): Infrastructure types to keep, all if empty
+        selected_commune (int): Commune key to keep, all if None
+        rows (np.ndarray): Sorted positions to filter, all if None
+
+    Returns:
+        pd.DataFrame: The matching rows, the whole table itself if nothing
+            is filtered
+    """
+    selected = dataset.filter_index.select(selected_categories, selected_types, selected_commune, rows)
+    return dataset.data if selected is None else dataset.data.iloc[selected]
 
 
 @st.cache_data(show_spinner=False)
-def filter_data(
-    data, selected_categories=None, selected_types=None, selected_commune=None
+def query_rows(
+    selected_categories=None, selected_types=None, selected_commune=None, bounds=None, version=None
 ):
-    """Filter data based on selections with caching."""
-    filtered_data = data.copy()
-    if selected_categories:
-        filtered_data = filtered_data[
-            filtered_data["categorie"].isin(selected_categories)
-        ]
-    if selected_types:
-        filtered_data = filtered_data[
-            filtered_data["type_infrastructure"].isin(selected_types)
-        ]
-    if selected_commune:
-        filtered_data = filtered_data[filtered_data["nom_commune"] == selected_commune]
-    return filtered_data
+    """Select the positions of the equipments in SQL with caching, `version` keying the files."""
+    return select_rows(load_database(version), selected_categories, selected_types, selected_commune, bounds)
+
+
+def visible_bounds(viewport):
+    """
+    Get the box of the equipments to load: the visible part of the map plus a margin.
+
+    Below the disaggregation zoom the map only shows clusters, so no
+    individual equipment is needed and None is returned.
+    """
+    if viewport["zoom"] < CLUSTER_CONFIG["DISAGGREGATE_ZOOM"]:
+        return None
+    bounds = expand_bounds(*viewport["bounds"], margin=VIEWPORT_CONFIG["MARGIN"])
+    return snap_bounds(*bounds, step=VIEWPORT_CONFIG["SNAP"])
+
+
+def initial_viewport():
+    """
+    Get the viewport of the map of France as created, before the page reports one.
+
+    Its zoom shows clusters only, so that no equipment is embedded in the
+    first page, nor after the commune selection changes or is cleared.
+    """
+    south, west = MAP_CONFIG["FRANCE_SW"]
+    north, east = MAP_CONFIG["FRANCE_NE"]
+    return {
+        "bounds": (south, west, north, east),
+        "center": MAP_CONFIG["FRANCE_CENTER"],
+        "zoom": MAP_CONFIG["DEFAULT_ZOOM"],
+    }
+
+
+def visible_rows(dataset, viewport):
+    """Get the sorted positions of the equipments in the box returned by visible_bounds."""
+    bounds = visible_bounds(viewport)
+    if bounds is None:
+        return np.empty(0, dtype="int64")
+    return dataset.spatial_index.query_bbox(*bounds)
 
 
 def main():
@@ -53,26 +112,86 @@ def main():
     # Setup the page
     setup_page()
 
-    # Load preprocessed data
-    data = load_data()  ## csv for the map
-    data_calculated_events = load_calculated_events_data()  ## csv for the visualisation
+    # Load preprocessed data, shared by the sessions with its derived views
+    dataset = load_data()
+    data = dataset.data
+
+    # With the database, the filters run in SQL on its indexes
+    version = file_version(CULTURAL_DATA_PATH, DATABASE_CONFIG["PATH"])
+    database = load_database(version)
 
     # Create sidebar with filters and visualization
     selected_categories, selected_types, selected_commune = create_sidebar(
         data,
         None,  # Placeholder parameter to maintain function signature
-        data,  # Pass the original data for visualization
+        dataset.type_counts,  # Equipment counts for the visualization
         creating_visualisation,  # Pass the visualization function
+        dataset.communes,
+        dataset.options,
+        dataset.commune_search,
     )
 
-    # Filter data with caching
-    filtered_data = filter_data(
-        data, selected_categories, selected_types, selected_commune
-    )
+    # Cultural score, recomputed for the parameters chosen in the sidebar
+    score_engine = load_score_engine()
+    if score_engine is not None:
+        show_score_panel(score_engine, selected_commune)
 
-    # Create and show map
-    m = create_map(filtered_data, selected_categories, selected_types, selected_commune)
-    show_map(m)
+    # Equipments around the selected commune, from the spatial index
+    show_nearby_panel(dataset.spatial_index, data, dataset.communes, selected_commune)
+
+    # Communes colored by the distance to the nearest equipment of a type
+    accessibility_type = None
+    if os.path.exists(ACCESSIBILITY_PATH):
+        accessibility_type = select_accessibility_type(dataset.options["types"])
+
+    # Only load the equipments around the last reported viewport, or none
+    # at all when they are served as tiles
+    equipment_tiles = load_equipment_tiles() if TILE_CONFIG["ENABLED"] else None
+    viewport = None
+    bounds = None
+    rows = None  # All the equipments
+    if VIEWPORT_CONFIG["ENABLED"]:
+        viewport = get_map_viewport(selected_commune)
+        # A selected commune restricts the equipments to its own
+        if not selected_commune:
+            shown = viewport or initial_viewport()
+            if database is None:
+                rows = visible_rows(dataset, shown)
+            else:
+                bounds = visible_bounds(shown)
+                if bounds is None:
+                    rows = np.empty(0, dtype="int64")
+    if equipment_tiles is not None and not selected_commune:
+        rows = np.empty(0, dtype="int64")
+
+    # Filter data in SQL, or with the filter index
+    if rows is not None and not len(rows):
+        filtered_data = data.iloc[:0]
+    elif database is not None:
+        filtered_data = data.iloc[
+            query_rows(selected_categories, selected_types, selected_commune, bounds, version)
+        ]
+    else:
+        filtered_data = filter_data(
+            dataset, selected_categories, selected_types, selected_commune, rows
+        )
+
+    # Create the map, and the equipment layers as a diff against the ones
+    # already in the page, which fall back on a snapshot fetched as an asset
+    m = create_map(data, selected_commune, dataset.filter_index, accessibility_type)
+    previous = None
+    if VIEWPORT_CONFIG["ENABLED"] and static_base_url() is not None:
+        previous = get_equipment_state(selected_commune)
+    equipment, equipment_state = create_equipment_layers(
+        filtered_data,
+        selected_categories,
+        selected_types,
+        selected_commune,
+        equipment_tiles=equipment_tiles,
+        previous=previous,
+    )
+    show_map(m, viewport, equipment)
+    save_equipment_state(equipment_state, selected_commune)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,213 @@
+"""Accessibility of the cultural equipments from every commune.
+
+For each commune center and each infrastructure type, the distance to the
+nearest equipment of that type and the number of equipments of that type
+within a few radii are computed with one spatial index per type. Communes
+are processed by department, in parallel worker processes that each hold
+the indexes.
+
+The result holds one row per (commune, type), keyed like cultural_data by
+communes.insee_keys.
+"""
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from ..config.settings import ACCESSIBILITY_CONFIG
+from .columnar import CULTURAL_SCHEMA, read_table, resolve_table, write_table
+from .manifest import (
+    MANIFEST_PATH,
+    is_up_to_date,
+    load_manifest,
+    record_step,
+    save_manifest,
+    step_signature,
+)
+from . import spatial_index
+
+CULTURAL_DATA_PATH = "data/cultural_data.parquet"
+COMMUNES_PATH = "data/communes.parquet"
+OUTPUT_PATH = "data/accessibility.parquet"
+
+STEP = "accessibility"
+
+# Spatial indexes of the worker process, one per infrastructure type
+_INDEXES = []
+
+
+def count_column(radius_km):
+    """Get the name of the column counting the equipments within a radius."""
+    return f"nombre_{radius_km:g}km"
+
+
+def accessibility_schema(radii_km):
+    """Get the columns and dtypes of the accessibility table."""
+    return {
+        "commune_key": "int32",
+        "type_infrastructure": "category",
+        "distance_km": "float32",
+        **{count_column(radius_km): "int32" for radius_km in radii_km},
+    }
+
+
+def _init_worker(latitude, longitude, type_codes, n_types, cell_size):
+    """Build the spatial index of each infrastructure type in a worker process."""
+    _INDEXES[:] = [
+        spatial_index.GridIndex(latitude[type_codes == code], longitude[type_codes == code], cell_size)
+        for code in range(n_types)
+    ]
+
+
+def measure_shard(latitude, longitude, radii_km):
+    """
+    Measure the accessibility of some communes, with the indexes of the worker.
+
+    Args:
+        latitude (np.ndarray): Latitudes of the commune centers
+        longitude (np.ndarray): Longitudes of the commune centers
+        radii_km (list): Radii of the counts, in km
+
+    Returns:
+        tuple: (distances of shape (communes, types), counts of shape
+            (communes, types, radii))
+    """
+    distances = np.full((len(latitude), len(_INDEXES)), np.nan, dtype="float32")
+    counts = np.zeros((len(latitude), len(_INDEXES), len(radii_km)), dtype="int32")
+    for code, index in enumerate(_INDEXES):
+        offsets, _, found = index.query_radius_batch(latitude, longitude, max(radii_km), sort=False)
+        centers = np.repeat(np.arange(len(latitude)), np.diff(offsets))
+        for i, radius_km in enumerate(radii_km):
+            counts[:, code, i] = np.bincount(centers[found <= radius_km], minlength=len(latitude))
+        # The nearest equipment is the closest one found, or is searched
+        # for beyond the largest radius
+        nearest = np.full(len(latitude), np.inf)
+        found_any = np.diff(offsets) > 0
+        if found_any.any():
+            nearest[found_any] = np.minimum.reduceat(found, offsets[:-1][found_any])
+        farther = np.flatnonzero(~found_any)
+        if len(farther):
+            nearest[farther] = index.query_nearest_batch(latitude[farther], longitude[farther], 1)[1][:, 0]
+        distances[:, code] = np.where(np.isinf(nearest), np.nan, nearest)
+    return distances, counts
+
+
+def compute_accessibility(equipments, communes, radii_km, jobs=None, cell_size=0.05):
+    """
+    Compute the accessibility table, one department at a time in parallel.
+
+    Args:
+        equipments (pd.DataFrame): latitude, longitude and type_infrastructure
+            of the equipments
+        communes (pd.DataFrame): commune_key, departement, latitude and
+            longitude of the commune centers
+        radii_km (list): Radii of the counts, in km
+        jobs (int): Number of worker processes, defaults to the CPU count
+        cell_size (float): Cell size of the spatial indexes, in degrees
+
+    Returns:
+        pd.DataFrame: One row per commune with a center and per type, with
+            the columns of accessibility_schema(radii_km)
+    """
+    jobs = jobs or os.cpu_count()
+    equipments = equipments.dropna(subset=["latitude", "longitude", "type_infrastructure"])
+    type_codes, types = pd.factorize(equipments["type_infrastructure"], sort=True)
+    communes = communes.dropna(subset=["latitude", "longitude"]).reset_index(drop=True)
+    latitude = communes["latitude"].to_numpy(dtype="float64")
+    longitude = communes["longitude"].to_numpy(dtype="float64")
+    shards = communes.groupby(communes["departement"].astype(str), sort=False).indices
+
+    distances = np.empty((len(communes), len(types)), dtype="float32")
+    counts = np.empty((len(communes), len(types), len(radii_km)), dtype="int32")
+    initargs = (
+        equipments["latitude"].to_numpy(dtype="float64"),
+        equipments["longitude"].to_numpy(dtype="float64"),
+        type_codes,
+        len(types),
+        cell_size,
+    )
+    with ProcessPoolExecutor(jobs, initializer=_init_worker, initargs=initargs) as pool:
+        futures = {
+            pool.submit(measure_shard, latitude[rows], longitude[rows], radii_km): rows
+            for rows in shards.values()
+        }
+        for future, rows in futures.items():
+            distances[rows], counts[rows] = future.result()
+
+    table = pd.DataFrame(
+        {
+            "commune_key": np.repeat(communes["commune_key"].to_numpy(), len(types)),
+            "type_infrastructure": np.tile(np.asarray(types, dtype=object), len(communes)),
+            "distance_km": distances.ravel(),
+        }
+    )
+    for i, radius_km in enumerate(radii_km):
+        table[count_column(radius_km)] = counts[:, :, i].ravel()
+    return table
+
+
+def build_accessibility(
+    source=CULTURAL_DATA_PATH,
+    communes_path=COMMUNES_PATH,
+    output_path=OUTPUT_PATH,
+    jobs=None,
+    force=False,
+    manifest_path=MANIFEST_PATH,
+):
+    """
+    Write the accessibility table of the communes.
+
+    The step is skipped when the manifest shows that its inputs did not change.
+
+    Args:
+        source (str): Path to the cultural_data table
+        communes_path (str): Path to the commune dimension
+        output_path (str): Output table
+        jobs (int): Number of worker processes, defaults to the CPU count
+        force (bool): Compute even if the output is up to date
+        manifest_path (str): Path of the data manifest
+
+    Returns:
+        dict: Number of "communes", "types" and "equipments", and whether
+            the step was "skipped"
+    """
+    source = resolve_table(source)
+    radii_km = list(ACCESSIBILITY_CONFIG["RADII_KM"])
+    manifest = load_manifest(manifest_path)
+    signature = step_signature(
+        manifest,
+        [source, communes_path],
+        params={"radii_km": radii_km, "cell_size": ACCESSIBILITY_CONFIG["CELL_SIZE"]},
+        code=[__file__, spatial_index.__file__],
+        manifest_path=manifest_path,
+    )
+    if not force and is_up_to_date(manifest, STEP, signature, [output_path], manifest_path=manifest_path):
+        save_manifest(manifest, manifest_path)
+        return dict(manifest["steps"][STEP]["stats"], skipped=True)
+
+    equipments = read_table(source, ["latitude", "longitude", "type_infrastructure"], CULTURAL_SCHEMA)
+    communes = read_table(communes_path, ["commune_key", "departement", "latitude", "longitude"])
+    table = compute_accessibility(equipments, communes, radii_km, jobs, ACCESSIBILITY_CONFIG["CELL_SIZE"])
+    write_table(table, output_path, accessibility_schema(radii_km))
+    stats = {
+        "communes": int(table["commune_key"].nunique()),
+        "types": int(table["type_infrastructure"].nunique()),
+        "equipments": len(equipments),
+    }
+    record_step(manifest, STEP, signature, [output_path], stats=stats, manifest_path=manifest_path)
+    save_manifest(manifest, manifest_path)
+    return dict(stats, skipped=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compute the accessibility of the equipments per commune.")
+    parser.add_argument("--jobs", type=int, help="Worker processes, the CPU count by default")
+    parser.add_argument("--force", action="store_true", help="Compute even if up to date")
+    args = parser.parse_args()
+    stats = build_accessibility(jobs=args.jobs, force=args.force)
+    if stats["skipped"]:
+        print("Accessibility table is up to date, nothing to do.")
+    print(f"Accessibility of {stats['types']} types from {stats['communes']} communes")
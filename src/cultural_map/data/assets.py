@@ -0,0 +1,59 @@
+"""Content-addressed, gzip-compressed assets served by the static endpoint."""
+
+import gzip
+import hashlib
+import os
+import time
+
+
+def write_asset(text, out_dir, extension="json", max_age=None):
+    """
+    Store a text asset under the hash of its content, gzip-compressed.
+
+    The file is written as ``<hash>.<extension>.gz`` and served as is by
+    any static file server, the page decompressing it. An asset already on
+    disk is only touched, so that pruning keeps it.
+
+    Args:
+        text (str): Asset content
+        out_dir (str): Asset directory
+        extension (str): Extension of the served file
+        max_age (float): Remove the assets of `out_dir` last written more
+            than this many seconds ago, or keep them all if None
+
+    Returns:
+        dict: Served file "name", raw "bytes" and "compressed_bytes"
+    """
+    data = text.encode("utf-8")
+    name = f"{hashlib.sha1(data).hexdigest()[:20]}.{extension}.gz"
+    path = os.path.join(out_dir, name)
+    if os.path.exists(path):
+        os.utime(path)
+    else:
+        os.makedirs(out_dir, exist_ok=True)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as f:
+            f.write(gzip.compress(data, compresslevel=6, mtime=0))
+        os.replace(temporary, path)
+        if max_age is not None:
+            prune_assets(out_dir, max_age)
+    return {"name": name, "bytes": len(data), "compressed_bytes": os.path.getsize(path)}
+
+
+def prune_assets(out_dir, max_age):
+    """
+    Remove the assets last written more than `max_age` seconds ago.
+
+    The directory is shared by all the sessions, so an asset is removed by
+    age rather than by count: a page still has `max_age` seconds to fetch
+    the assets written for it, whatever the other sessions write meanwhile.
+    """
+    oldest = time.time() - max_age
+    for entry in os.scandir(out_dir):
+        if not entry.is_file() or not entry.name.endswith(".gz"):
+            continue
+        try:
+            if entry.stat().st_mtime < oldest:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,183 @@
+"""Hierarchical grid clustering of equipments, precomputed per zoom level."""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+TILE_SIZE = 256
+
+
+def mercator_pixels(latitude, longitude, zoom):
+    """
+    Project coordinates to Web Mercator pixel coordinates at a zoom level.
+
+    Args:
+        latitude (np.ndarray): Latitudes in degrees
+        longitude (np.ndarray): Longitudes in degrees
+        zoom (int): Leaflet zoom level
+
+    Returns:
+        tuple: (x, y) pixel coordinates as float64 arrays
+    """
+    scale = TILE_SIZE * 2.0**zoom
+    lat = np.radians(np.clip(latitude, -85.05112878, 85.05112878))
+    x = (np.asarray(longitude, dtype="float64") + 180.0) / 360.0 * scale
+    y = (1.0 - np.log(np.tan(lat) + 1.0 / np.cos(lat)) / np.pi) / 2.0 * scale
+    return x, y
+
+
+def mercator_latlon(x, y, zoom):
+    """Inverse of mercator_pixels: coordinates of pixel positions at a zoom level."""
+    scale = TILE_SIZE * 2.0**zoom
+    longitude = np.asarray(x, dtype="float64") / scale * 360.0 - 180.0
+    latitude = np.degrees(np.arctan(np.sinh(np.pi * (1.0 - 2.0 * np.asarray(y) / scale))))
+    return latitude, longitude
+
+
+def build_cluster_index(data, min_zoom=5, max_zoom=18, radius=60):
+    """
+    Cluster equipments on a grid of `radius` pixels for every zoom level.
+
+    Grid cells at zoom z+1 nest exactly inside the cells at zoom z, so the
+    clusters form a hierarchy. Each cluster keeps its exact count and its
+    breakdown per (categorie, type_infrastructure) group, stored sparsely.
+
+    Args:
+        data (pd.DataFrame): Equipments with latitude, longitude, categorie
+            and type_infrastructure columns
+        min_zoom (int): First zoom level to index
+        max_zoom (int): Last zoom level to index
+        radius (int): Cluster cell size in screen pixels
+
+    Returns:
+        dict: Group labels and per-zoom cluster arrays
+    """
+    data = data.dropna(subset=["latitude", "longitude"])
+    latitude = data["latitude"].to_numpy(dtype="float64")
+    longitude = data["longitude"].to_numpy(dtype="float64")
+    group_codes, groups = pd.MultiIndex.from_arrays(
+        [data["categorie"].astype(str), data["type_infrastructure"].astype(str)]
+    ).factorize()
+    n_groups = len(groups)
+
+    index = {
+        "group_categorie": np.asarray(groups.get_level_values(0), dtype=str),
+        "group_type": np.asarray(groups.get_level_values(1), dtype=str),
+        "zooms": np.arange(min_zoom, max_zoom + 1),
+    }
+    for zoom in range(min_zoom, max_zoom + 1):
+        x, y = mercator_pixels(latitude, longitude, zoom)
+        cells = (x // radius).astype("int64") << 32 | (y // radius).astype("int64")
+        _, cluster_of_point = np.unique(cells, return_inverse=True)
+        n_clusters = cluster_of_point.max() + 1 if len(cells) else 0
+        count = np.bincount(cluster_of_point, minlength=n_clusters)
+
+        # Sparse per-group breakdown: one (cluster, group, count) triple per
+        # non-empty pair, sorted by cluster.
+        pairs, pair_count = np.unique(
+            cluster_of_point * n_groups + group_codes, return_counts=True
+        )
+        index[f"z{zoom}_latitude"] = (
+            np.bincount(cluster_of_point, latitude, n_clusters) / count
+        ).astype("float32")
+        index[f"z{zoom}_longitude"] = (
+            np.bincount(cluster_of_point, longitude, n_clusters) / count
+        ).astype("float32")
+        index[f"z{zoom}_count"] = count.astype("int32")
+        index[f"z{zoom}_pair_cluster"] = (pairs // n_groups).astype("int32")
+        index[f"z{zoom}_pair_group"] = (pairs % n_groups).astype("int16")
+        index[f"z{zoom}_pair_count"] = pair_count.astype("int32")
+    return index
+
+
+def save_cluster_index(index, path, source=None):
+    """Save a cluster index, tagged with the stat of its source file."""
+    stamp = np.array([0, 0], dtype="int64")
+    if source is not None:
+        stat = os.stat(source)
+        stamp = np.array([stat.st_mtime_ns, stat.st_size], dtype="int64")
+    np.savez(path, source_stamp=stamp, **index)
+
+
+def load_cluster_index(path, source=None):
+    """
+    Load a cluster index saved by save_cluster_index.
+
+    Returns:
+        dict or None: The index, or None if missing or older than `source`
+    """
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as saved:
+        index = {key: saved[key] for key in saved.files}
+    if source is not None:
+        stat = os.stat(source)
+        if list(index.pop("source_stamp")) != [stat.st_mtime_ns, stat.st_size]:
+            return None
+    else:
+        index.pop("source_stamp")
+    return index
+
+
+def selected_groups(index, selected_categories=None, selected_types=None):
+    """
+    Get which (categorie, type_infrastructure) groups of an index match the filters.
+
+    Args:
+        index (dict): Cluster index from build_cluster_index
+        selected_categories (list): Categories to keep, all if empty
+        selected_types (list): Infrastructure types to keep, all if empty
+
+    Returns:
+        np.ndarray: Boolean mask over the groups of the index
+    """
+    keep = np.ones(len(index["group_type"]), dtype=bool)
+    if selected_categories:
+        keep &= np.isin(index["group_categorie"], list(selected_categories))
+    if selected_types:
+        keep &= np.isin(index["group_type"], list(selected_types))
+    return keep
+
+
+def clusters_at_zoom(index, zoom, selected_categories=None, selected_types=None):
+    """
+    Get the clusters of a zoom level, restricted to the selected groups.
+
+    Args:
+        index (dict): Cluster index from build_cluster_index
+        zoom (int): Zoom level, clamped to the indexed range
+        selected_categories (list): Categories to keep, all if empty
+        selected_types (list): Infrastructure types to keep, all if empty
+
+    Returns:
+        dict: latitude, longitude and count arrays of the non-empty clusters,
+            plus their breakdown as CSR arrays (offsets, group, count)
+    """
+    zooms = index["zooms"]
+    zoom = int(np.clip(zoom, zooms[0], zooms[-1]))
+    keep = selected_groups(index, selected_categories, selected_types)
+
+    pair_cluster = index[f"z{zoom}_pair_cluster"]
+    pair_group = index[f"z{zoom}_pair_group"]
+    pair_count = index[f"z{zoom}_pair_count"]
+    pair_kept = keep[pair_group]
+    count = np.bincount(
+        pair_cluster[pair_kept],
+        pair_count[pair_kept],
+        minlength=len(index[f"z{zoom}_count"]),
+    ).astype("int64")
+
+    # Renumber the surviving clusters and their breakdown pairs
+    visible = count > 0
+    new_id = np.cumsum(visible) - 1
+    pair_cluster = new_id[pair_cluster[pair_kept]]
+    offsets = np.searchsorted(pair_cluster, np.arange(visible.sum() + 1))
+    return {
+        "latitude": index[f"z{zoom}_latitude"][visible],
+        "longitude": index[f"z{zoom}_longitude"][visible],
+        "count": count[visible],
+        "offsets": offsets,
+        "group": pair_group[pair_kept],
+        "group_count": pair_count[pair_kept],
+    }
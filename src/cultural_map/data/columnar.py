@@ -0,0 +1,241 @@
+"""Typed columnar storage of the pipeline outputs.
+
+Outputs are written as Parquet, or as Arrow IPC files for a ``.arrow`` or
+``.feather`` path, with an explicit schema: loading them needs no text
+parsing nor dtype inference, and readers only load the columns they ask
+for. Outputs still stored as CSV are read with the same schema.
+
+Coordinates are kept as float64: float32 would move equipments by up to
+half a meter and change their stable ids.
+"""
+
+import argparse
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# data/cultural_data, one row per equipment
+CULTURAL_SCHEMA = {
+    "commune_key": "int32",
+    "nom_commune": "category",
+    "code_postal": "category",
+    "type_infrastructure": "category",
+    "nom_infrastructure": "object",
+    "latitude": "float64",
+    "longitude": "float64",
+    "population": "float32",
+    "categorie": "category",
+    "cultural_density": "float32",
+}
+
+# data/heatmap_data, one row per commune
+HEATMAP_SCHEMA = {
+    "latitude": "float64",
+    "longitude": "float64",
+    "cultural_density": "float32",
+}
+
+# data/communes, the commune dimension keyed by communes.insee_keys
+COMMUNE_SCHEMA = {
+    "commune_key": "int32",
+    "code_insee": "object",
+    "nom_commune": "object",
+    "departement": "category",
+    "region": "category",
+    "population": "float32",
+    "latitude": "float64",
+    "longitude": "float64",
+    "pvd": "bool",
+    "nombre_structures": "float32",
+    "cultural_density": "float64",
+}
+
+# data/results/Heatmap_Culture_with_score, one row per commune
+DENSITY_SCORE_SCHEMA = {
+    "commune_key": "int32",
+    "code_insee": "category",
+    "Commune": "object",
+    "Region": "category",
+    "latitude": "float64",
+    "longitude": "float64",
+    "Population_Totale": "float32",
+    "Num_Region": "category",
+    "Num_Dep": "category",
+    "nbr_total_culturel": "int32",
+    "Nbre_culturels_N_habitants": "float32",
+    "Nbre culturels pour1000 habitants": "float32",
+}
+
+ARROW_EXTENSIONS = (".arrow", ".feather")
+
+
+def resolve_table(path):
+    """
+    Get the file holding a pipeline output.
+
+    Args:
+        path (str): Path of the columnar file
+
+    Returns:
+        str: `path`, or its ``.csv`` sibling if only that one exists
+    """
+    csv_path = os.path.splitext(path)[0] + ".csv"
+    if not os.path.exists(path) and os.path.exists(csv_path):
+        return csv_path
+    return path
+
+
+def write_table(data, path, schema):
+    """
+    Write the columns of a schema, with its dtypes, as Parquet or Arrow IPC.
+
+    The file is replaced atomically, so readers never see a partial file.
+
+    Args:
+        data (pd.DataFrame): Data holding at least the columns of `schema`
+        path (str): Output path, an Arrow IPC file for .arrow and .feather
+        schema (dict): dtype per column
+    """
+    table = data[list(schema)].astype(schema).reset_index(drop=True)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temporary = f"{path}.{os.getpid()}.tmp"
+    if path.endswith(ARROW_EXTENSIONS):
+        table.to_feather(temporary)
+    else:
+        table.to_parquet(temporary, index=False)
+    os.replace(temporary, path)
+
+
+def read_table(path, columns=None, schema=None, **csv_options):
+    """
+    Read some columns of a pipeline output.
+
+    Args:
+        path (str): Parquet, Arrow IPC or CSV file
+        columns (list): Columns to read, all if None
+        schema (dict): dtype per column, applied when reading a CSV file
+        **csv_options: Extra pd.read_csv arguments, such as `sep`
+
+    Returns:
+        pd.DataFrame: The requested columns
+    """
+    if path.endswith(ARROW_EXTENSIONS):
+        return pd.read_feather(path, columns=columns)
+    if not path.endswith(".csv"):
+        return pd.read_parquet(path, columns=columns)
+    dtype = None
+    if schema is not None:
+        dtype = {
+            column: kind
+            for column, kind in schema.items()
+            if columns is None or column in columns
+        }
+    return pd.read_csv(path, usecols=columns, dtype=dtype, **csv_options)
+
+
+def arrow_schema(schema):
+    """
+    Get the Arrow schema of a dtype schema, identical for every chunk of a table.
+
+    Categories are stored as string dictionaries with 32-bit indices, whatever
+    their number in each chunk.
+    """
+    fields = []
+    for column, kind in schema.items():
+        if kind == "category":
+            kind = pa.dictionary(pa.int32(), pa.string())
+        elif kind == "object":
+            kind = pa.string()
+        else:
+            kind = pa.from_numpy_dtype(kind)
+        fields.append(pa.field(column, kind))
+    return pa.schema(fields)
+
+
+class TableWriter:
+    """
+    Write a Parquet table chunk by chunk.
+
+    Chunks are written as row groups as they come, so memory use does not
+    grow with the table. The file is replaced atomically once closed, and
+    left untouched if writing fails.
+    """
+
+    def __init__(self, path, schema):
+        self.path = path
+        self.schema = schema
+        self.arrow_schema = arrow_schema(schema)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.temporary = f"{path}.{os.getpid()}.tmp"
+        self.writer = pq.ParquetWriter(self.temporary, self.arrow_schema)
+
+    def write(self, data):
+        """Append the columns of the schema of a chunk."""
+        # Casting in Arrow avoids building pandas categories for every chunk
+        table = pa.Table.from_pandas(data[list(self.schema)], preserve_index=False)
+        self.writer.write_table(table.cast(self.arrow_schema))
+
+    def append_file(self, path, batch_rows=None):
+        """Append the rows of a Parquet file written with the same schema, by batches."""
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_rows or 65_536):
+            self.writer.write_batch(batch)
+
+    def close(self):
+        self.writer.close()
+        os.replace(self.temporary, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        if error_type is None:
+            self.close()
+        else:
+            self.writer.close()
+            os.remove(self.temporary)
+
+
+def convert_csv(csv_path, path, schema, key_column=None, **csv_options):
+    """
+    Convert an output written as CSV to its columnar file.
+
+    Args:
+        csv_path (str): CSV file
+        path (str): Columnar file to write
+        schema (dict): dtype per column
+        key_column (str): Column of INSEE codes the commune key is derived
+            from, when the CSV predates it
+        **csv_options: Extra pd.read_csv arguments, such as `sep`
+    """
+    data = read_table(csv_path, schema=schema, **csv_options)
+    if key_column is not None and "commune_key" not in data:
+        from .communes import insee_keys
+
+        data["commune_key"] = insee_keys(data[key_column])
+    write_table(data, path, schema)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert the pipeline outputs written as CSV to Parquet."
+    )
+    parser.add_argument("--data-dir", default="data")
+    args = parser.parse_args()
+    outputs = [
+        ("cultural_data", CULTURAL_SCHEMA, "code_postal", {}),
+        ("heatmap_data", HEATMAP_SCHEMA, None, {}),
+        ("results/Heatmap_Culture_with_score", DENSITY_SCORE_SCHEMA, "code_insee", {"sep": "\t"}),
+    ]
+    for name, schema, key_column, csv_options in outputs:
+        csv_path = os.path.join(args.data_dir, f"{name}.csv")
+        if os.path.exists(csv_path):
+            convert_csv(
+                csv_path,
+                os.path.join(args.data_dir, f"{name}.parquet"),
+                schema,
+                key_column,
+                **csv_options,
+            )
+            print(f"Converted {csv_path}")
@@ -0,0 +1,112 @@
+"""Search index of the communes, for the commune selector.
+
+Names are normalized (no accents nor punctuation, lower case, "St"/"Ste"
+spelled out) and indexed from their start and from each of their words,
+along with the INSEE codes, in one sorted list of keys: the keys starting
+with a query are a single range found by bisection. Matches are ranked
+by population, names starting with the query before words inside names.
+"""
+
+import re
+import unicodedata
+from bisect import bisect_left, bisect_right
+
+import numpy as np
+import pandas as pd
+
+ABBREVIATIONS = {"st": "saint", "ste": "sainte", "sts": "saints", "stes": "saintes"}
+
+# Bonus of the matches on the start of the name, and on the whole name,
+# above any population
+PREFIX_BONUS = 1e9
+EXACT_BONUS = 1e10
+
+
+def normalize(text, expand_last=True):
+    """
+    Normalize a commune name or a query.
+
+    Args:
+        text (str): Name or query
+        expand_last (bool): Spell out an abbreviation in the last word too,
+            which in a query may be the start of a longer word
+
+    Returns:
+        str: Lower case ASCII words separated by single spaces
+    """
+    text = str(text).lower().replace("œ", "oe").replace("æ", "ae")
+    text = unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode("ascii")
+    words = re.findall(r"[a-z0-9]+", text)
+    last = len(words) - 1
+    return " ".join(
+        ABBREVIATIONS.get(word, word) if expand_last or i < last else word for i, word in enumerate(words)
+    )
+
+
+class CommuneSearchIndex:
+    """
+    Prefix index over the names and INSEE codes of the communes.
+
+    Args:
+        communes (pd.DataFrame): Commune dimension, with commune_key,
+            nom_commune, code_insee, departement and population columns
+    """
+
+    def __init__(self, communes):
+        names = communes["nom_commune"].fillna(communes["code_insee"]).astype(str)
+        # Communes sharing a name are told apart by their department
+        homonyms = names.duplicated(keep=False).to_numpy()
+        departments = communes["departement"].astype(str).to_numpy()
+        self.labels = {
+            int(key): f"{name} ({department})" if homonym else name
+            for key, name, department, homonym in zip(communes["commune_key"], names, departments, homonyms)
+        }
+        population = communes["population"].fillna(0).to_numpy(dtype="float64")
+
+        entries = []
+        for row, (name, code) in enumerate(zip(names, communes["code_insee"].astype(str))):
+            words = normalize(name).split(" ")
+            entries.append((" ".join(words), row, PREFIX_BONUS))
+            for start in range(1, len(words)):
+                entries.append((" ".join(words[start:]), row, 0.0))
+            entries.append((code.lower(), row, 0.0))
+        entries.sort()
+        self.keys = [key for key, _, _ in entries]
+        self.communes = communes["commune_key"].to_numpy(dtype="int64")[[row for _, row, _ in entries]]
+        self.scores = population[[row for _, row, _ in entries]] + [bonus for _, _, bonus in entries]
+        self.prefix = np.array([bonus > 0 for _, _, bonus in entries])
+        # Entries of a commune, which bounds the candidates needed for `limit` communes
+        self.max_entries = int(pd.Series(self.communes).value_counts().max()) if entries else 0
+
+    def search(self, query, limit=10):
+        """
+        Suggest the communes matching a query.
+
+        Args:
+            query (str): Start of a name, of a word of a name, or of an INSEE code
+            limit (int): Number of suggestions
+
+        Returns:
+            list: (commune_key, label) pairs, best first
+        """
+        scores, communes = [], []
+        for text in {normalize(query), normalize(query, expand_last=False)}:
+            if not text:
+                continue
+            # Keys only hold [a-z0-9 ], all sorting before "~"
+            start = bisect_left(self.keys, text)
+            stop = bisect_left(self.keys, text + "~", start)
+            exact = bisect_right(self.keys, text, start, stop)
+            range_scores = self.scores[start:stop].copy()
+            range_scores[: exact - start] += np.where(self.prefix[start:exact], EXACT_BONUS, 0)
+            scores.append(range_scores)
+            communes.append(self.communes[start:stop])
+        if not scores:
+            return []
+        scores, communes = np.concatenate(scores), np.concatenate(communes)
+        candidates = min(len(scores), limit * self.max_entries * 2)
+        if candidates < len(scores):
+            top = np.argpartition(-scores, candidates - 1)[:candidates]
+            scores, communes = scores[top], communes[top]
+        order = np.argsort(-scores, kind="stable")
+        return [(int(key), self.labels[int(key)]) for key in pd.unique(communes[order])[:limit]]
@@ -0,0 +1,169 @@
+"""Commune code and location helpers."""
+
+import numpy as np
+import pandas as pd
+
+
+def normalize_insee_codes(codes):
+    """
+    Normalize INSEE commune codes to their 5-character form.
+
+    Codes read as floats ("1001.0") or stripped of their leading zero ("1001")
+    become "01001"; Corsican codes ("2A004") are kept as is.
+
+    Args:
+        codes (pd.Series): Raw INSEE codes
+
+    Returns:
+        pd.Series: Normalized codes, <NA> where missing
+    """
+    return _normalize_codes(codes, 5)
+
+
+def normalize_area_codes(codes, width=2):
+    """
+    Normalize department or region codes to strings.
+
+    Codes read as numbers ("1", "84.0") are zero-padded to `width`
+    characters ("01", "84"); Corsican departments ("2A", "2B") are kept.
+
+    Args:
+        codes (pd.Series): Raw department or region codes
+        width (int): Length of the numeric codes
+
+    Returns:
+        pd.Series: Normalized codes, <NA> where missing
+    """
+    return _normalize_codes(codes, width)
+
+
+def _normalize_codes(codes, width):
+    codes = codes.astype("string").str.strip().str.upper()
+    codes = codes.str.replace(r"\.0+$", "", regex=True)
+    return codes.str.zfill(width).mask(codes.isna() | (codes == ""))
+
+
+def department_codes(codes):
+    """
+    Get the department of normalized INSEE codes.
+
+    Overseas departments use three characters (971-976), the others two.
+
+    Args:
+        codes (pd.Series): Normalized INSEE codes
+
+    Returns:
+        pd.Series: Department codes
+    """
+    overseas = codes.str.startswith("97")
+    return codes.str[:2].where(~overseas, codes.str[:3])
+
+
+# Corsican codes ("2A004", "2B033") are keyed above every numeric code
+CORSICA_KEY_OFFSETS = {"2A": 200_000, "2B": 210_000}
+MISSING_KEY = -1
+
+
+def insee_keys(codes):
+    """
+    Encode INSEE commune codes as compact integer keys.
+
+    Numeric codes are keyed by their value ("01001" -> 1001); Corsican codes
+    by an offset above every numeric code plus their commune number
+    ("2A004" -> 200004), so that keys never collide. Each distinct code is
+    only parsed once.
+
+    Args:
+        codes (pd.Series): Raw or normalized INSEE codes
+
+    Returns:
+        np.ndarray: int32 keys, MISSING_KEY where the code is missing or invalid
+    """
+    positions, uniques = pd.factorize(pd.Series(codes).astype("string"))
+    codes = normalize_insee_codes(pd.Series(uniques))
+    keys = pd.to_numeric(codes, errors="coerce")
+    for prefix, offset in CORSICA_KEY_OFFSETS.items():
+        corsica = codes.str.startswith(prefix).fillna(False)
+        keys = keys.mask(corsica, offset + pd.to_numeric(codes.str[2:], errors="coerce"))
+    keys = np.append(keys.fillna(MISSING_KEY).to_numpy(dtype="int32"), np.int32(MISSING_KEY))
+    # Missing codes get position -1, the MISSING_KEY appended last
+    return keys[positions]
+
+
+def insee_codes(keys):
+    """
+    Decode integer keys into 5-character INSEE codes.
+
+    Args:
+        keys (array-like): Keys from insee_keys
+
+    Returns:
+        pd.Series: INSEE codes, <NA> for MISSING_KEY
+    """
+    keys = pd.Series(np.asarray(keys, dtype="int64"))
+    codes = keys.astype("string").str.zfill(5)
+    for prefix, offset in CORSICA_KEY_OFFSETS.items():
+        corsica = (keys >= offset) & (keys < offset + 1000)
+        codes = codes.mask(corsica, prefix + (keys - offset).astype("string").str.zfill(3))
+    return codes.mask(keys == MISSING_KEY)
+
+
+def nearest_communes(latitude, longitude, communes, max_distance=0.1):
+    """
+    Find the commune whose center is the closest to each point.
+
+    Distances are measured in degrees, longitudes scaled by the cosine of
+    the latitude, which is accurate enough at the scale of a commune.
+    Centers are bucketed on a grid of cells `max_distance` high, and wide
+    enough at the northernmost center, so each point is only compared with
+    the centers of the 9 cells around it.
+
+    Args:
+        latitude (array-like): Latitudes of the points
+        longitude (array-like): Longitudes of the points
+        communes (pd.DataFrame): Commune dimension, with commune_key,
+            latitude and longitude columns
+        max_distance (float): Largest distance to a center, in degrees
+
+    Returns:
+        np.ndarray: int32 commune keys, MISSING_KEY where no center is close enough
+    """
+    latitude = np.asarray(latitude, dtype="float64")
+    longitude = np.asarray(longitude, dtype="float64")
+    centers = communes.dropna(subset=["latitude", "longitude"])
+    center_lat = centers["latitude"].to_numpy(dtype="float64")
+    center_lon = centers["longitude"].to_numpy(dtype="float64")
+    center_keys = centers["commune_key"].to_numpy(dtype="int32")
+
+    cell_width = max_distance / np.cos(np.radians(min(np.abs(center_lat).max(initial=0), 89)))
+
+    def cells(lat, lon):
+        rows = np.floor(lat / max_distance).astype("int64")
+        return rows, np.floor(lon / cell_width).astype("int64")
+
+    row, col = cells(center_lat, center_lon)
+    order = np.argsort(row << 20 | (col & 0xFFFFF), kind="stable")
+    sorted_cells = (row << 20 | (col & 0xFFFFF))[order]
+
+    valid = np.flatnonzero(~(np.isnan(latitude) | np.isnan(longitude)))
+    lat, lon = latitude[valid], longitude[valid]
+    scale = np.cos(np.radians(lat))
+    best = np.full(len(valid), max_distance**2)
+    keys = np.full(len(latitude), MISSING_KEY, dtype="int32")
+    row, col = cells(lat, lon)
+    for row_shift in (-1, 0, 1):
+        for col_shift in (-1, 0, 1):
+            target = (row + row_shift) << 20 | ((col + col_shift) & 0xFFFFF)
+            starts = np.searchsorted(sorted_cells, target, "left")
+            counts = np.searchsorted(sorted_cells, target, "right") - starts
+            # One pass per rank of the centers within their cell
+            for rank in range(counts.max(initial=0)):
+                points = np.flatnonzero(counts > rank)
+                center = order[starts[points] + rank]
+                distance = (lat[points] - center_lat[center]) ** 2 + (
+                    (lon[points] - center_lon[center]) * scale[points]
+                ) ** 2
+                closer = distance < best[points]
+                best[points[closer]] = distance[closer]
+                keys[valid[points[closer]]] = center_keys[center[closer]]
+    return keys
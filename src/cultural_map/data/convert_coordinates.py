@@ -1,36 +1,160 @@
-import pandas as pd
-import numpy as np
-
-def convert_coordinates():
-    # Read the CSV file with semicolon separator and low_memory=False to avoid dtype warnings
-    df = pd.read_csv('/home/didamer/Projects/Campus/Dataforgood/data/results/Equipements_Communes.csv', 
-                     sep=';',
-                     low_memory=False)
-    
-    # Function to safely convert to float
-    def safe_float_convert(x):
-        try:
-            return float(str(x).replace(',', '.'))
-        except (ValueError, TypeError):
-            return np.nan
-    
-    # Convert coordinates and count invalid values
-    df['Equipement_latitude'] = df['Equipement_latitude'].apply(safe_float_convert)
-    df['Equipement_longitude'] = df['Equipement_longitude'].apply(safe_float_convert)
-    
-    # Report invalid coordinates
-    invalid_coords = df[df['Equipement_latitude'].isna() | df['Equipement_longitude'].isna()]
-    print(f"\nFound {len(invalid_coords)} rows with invalid coordinates")
-    if len(invalid_coords) > 0:
-        print("\nSample of rows with invalid coordinates:")
-        print(invalid_coords[['Nom_commune', 'Type', 'Nom_equipement', 'Equipement_latitude', 'Equipement_longitude']].head())
-    
-    # Save the modified DataFrame back to CSV
-    df.to_csv('/home/didamer/Projects/Campus/Dataforgood/data/results/Equipements_Communes.csv', 
-              sep=';', 
-              index=False)
-    
-    print("\nFile has been updated successfully!")
+"""Normalization of the equipment coordinates written with decimal commas.
+
+The file is streamed by blocks with the Arrow CSV reader and rewritten
+through a temporary file, so memory use does not depend on its size and
+readers never see a partial file. Values are parsed with vectorized Arrow
+string kernels; columns other than the coordinates are written back as
+text, unchanged.
+"""
+
+import argparse
+import csv
+import os
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pcsv
+
+from .manifest import is_up_to_date, load_manifest, record_step, save_manifest, step_signature
+
+COORDINATE_COLUMNS = ("Equipement_latitude", "Equipement_longitude")
+SAMPLE_COLUMNS = ["Nom_commune", "Type", "Nom_equipement"]
+
+# Plain decimal number, once the decimal comma is replaced
+NUMBER_PATTERN = r"^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$"
+
+STEP = "convert_coordinates"
+
+
+def parse_decimal(values):
+    """
+    Parse numbers written with a decimal point or comma.
+
+    Args:
+        values (pa.ChunkedArray): Raw values as strings
+
+    Returns:
+        tuple: float64 values, null where missing or invalid, and the mask
+            of the values that are not empty but could not be parsed
+    """
+    text = pc.replace_substring(pc.utf8_trim_whitespace(values), ",", ".")
+    valid = pc.match_substring_regex(text, NUMBER_PATTERN)
+    invalid = pc.and_(pc.invert(valid), pc.not_equal(text, ""))
+    return pc.cast(pc.if_else(valid, text, None), pa.float64()), invalid
+
+
+def convert_coordinates(
+    path="data/results/Equipements_Communes.csv",
+    output_path=None,
+    columns=COORDINATE_COLUMNS,
+    sep=";",
+    block_bytes=16 << 20,
+    sample_rows=5,
+    force=False,
+    manifest_path="data/manifest.json",
+):
+    """
+    Convert coordinate columns to plain floats.
+
+    The step is skipped when the manifest shows that its output is still
+    the file it wrote from the same input.
+
+    Args:
+        path (str): CSV file to normalize
+        output_path (str): Output CSV file, `path` itself if None
+        columns (tuple): Coordinate columns
+        sep (str): Column separator
+        block_bytes (int): Bytes of the file processed at once
+        sample_rows (int): Number of invalid rows reported
+        force (bool): Convert even if the output is up to date
+        manifest_path (str): Path of the data manifest
+
+    Returns:
+        dict: Number of "rows", of rows with an "invalid" (unparseable)
+            coordinate and of the other rows with a "missing" one, invalid
+            values per column ("invalid_by_column"), the first invalid rows
+            with their raw coordinates ("samples") and whether the step was
+            "skipped"
+    """
+    output_path = path if output_path is None else output_path
+    manifest = load_manifest(manifest_path)
+    signature = step_signature(
+        manifest,
+        [] if output_path == path else [path],
+        params={"columns": list(columns), "sep": sep},
+        code=[__file__],
+        manifest_path=manifest_path,
+    )
+    if not force and is_up_to_date(manifest, STEP, signature, [output_path], manifest_path=manifest_path):
+        return dict(manifest["steps"][STEP]["stats"], skipped=True)
+
+    stats = {
+        "rows": 0,
+        "missing": 0,
+        "invalid": 0,
+        "invalid_by_column": {column: 0 for column in columns},
+        "samples": [],
+        "skipped": False,
+    }
+    with open(path, encoding="utf-8", newline="") as f:
+        header = next(csv.reader(f, delimiter=sep))
+    # Every column is read as text, so the other columns are written back as is
+    reader = pcsv.open_csv(
+        path,
+        read_options=pcsv.ReadOptions(block_size=block_bytes),
+        parse_options=pcsv.ParseOptions(delimiter=sep),
+        convert_options=pcsv.ConvertOptions(column_types={column: pa.string() for column in header}),
+    )
+    sample_columns = [column for column in SAMPLE_COLUMNS if column in header] + list(columns)
+    temporary = f"{output_path}.{os.getpid()}.tmp"
+    writer = None
+    try:
+        for batch in reader:
+            table = pa.Table.from_batches([batch])
+            raw = table
+            missing = pa.repeat(False, len(table))
+            invalid = pa.repeat(False, len(table))
+            for column in columns:
+                values, unparsed = parse_decimal(table[column])
+                stats["invalid_by_column"][column] += pc.sum(unparsed).as_py() or 0
+                missing = pc.or_(missing, pc.and_(pc.is_null(values), pc.invert(unparsed)))
+                invalid = pc.or_(invalid, unparsed)
+                table = table.set_column(table.schema.get_field_index(column), column, values)
+            stats["rows"] += len(table)
+            stats["missing"] += pc.sum(pc.and_(missing, pc.invert(invalid))).as_py() or 0
+            stats["invalid"] += pc.sum(invalid).as_py() or 0
+            if len(stats["samples"]) < sample_rows:
+                samples = raw.select(sample_columns).filter(invalid)
+                stats["samples"] += samples.slice(0, sample_rows - len(stats["samples"])).to_pylist()
+            if writer is None:
+                writer = pcsv.CSVWriter(
+                    temporary, table.schema, write_options=pcsv.WriteOptions(delimiter=sep)
+                )
+            writer.write_table(table)
+        if writer is not None:
+            writer.close()
+            writer = None
+            os.replace(temporary, output_path)
+    finally:
+        if writer is not None:
+            writer.close()
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+    record_step(manifest, STEP, signature, [output_path], stats=stats, manifest_path=manifest_path)
+    save_manifest(manifest, manifest_path)
+    return stats
+
 
 if __name__ == "__main__":
-    convert_coordinates()
+    parser = argparse.ArgumentParser(description="Normalize the equipment coordinates.")
+    parser.add_argument("--path", default="data/results/Equipements_Communes.csv")
+    parser.add_argument("--output", default=None, help="Output file, the input file if omitted")
+    parser.add_argument("--block-mb", type=int, default=16, help="Megabytes processed at once")
+    args = parser.parse_args()
+    stats = convert_coordinates(args.path, args.output, block_bytes=args.block_mb << 20)
+    if stats["skipped"]:
+        print("Coordinates are already converted, nothing to do.")
+    print(f"{stats['rows']} rows, {stats['missing']} with missing and {stats['invalid']} with invalid coordinates")
+    for sample in stats["samples"]:
+        print(sample)
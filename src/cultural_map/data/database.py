@@ -0,0 +1,241 @@
+"""Embedded SQLite database of the equipments, for filtering in SQL.
+
+The filter columns of the cultural_data table are copied into a single
+table, in the same order (the rowid is the position plus one), with an
+index on the category, the type, the commune key and a grid cell of the
+coordinates. Queries return the positions of the matching rows, so the
+application keeps its table in memory and only delegates the filtering.
+"""
+
+import contextlib
+import math
+import os
+import queue
+import sqlite3
+from urllib.parse import quote
+
+import numpy as np
+
+from .columnar import CULTURAL_SCHEMA, read_table, resolve_table
+
+TABLE = "equipments"
+COLUMNS = ["commune_key", "categorie", "type_infrastructure", "latitude", "longitude"]
+INDEXED_COLUMNS = ["categorie", "type_infrastructure", "commune_key", "cell"]
+
+
+def _cell_columns(cell_size):
+    return math.ceil(360 / cell_size) + 1
+
+
+def grid_cells(latitude, longitude, cell_size):
+    """
+    Number the grid cells holding points, row by row from the south-west.
+
+    Returns:
+        np.ndarray: Cell numbers, -1 for points without coordinates
+    """
+    latitude = np.asarray(latitude, dtype="float64")
+    longitude = np.asarray(longitude, dtype="float64")
+    rows = np.floor((latitude + 90) / cell_size)
+    cols = np.floor((longitude + 180) / cell_size)
+    cells = rows * _cell_columns(cell_size) + cols
+    return np.where(np.isnan(cells), -1, cells).astype("int64")
+
+
+def _source_stamp(source):
+    stat = os.stat(source)
+    return f"{stat.st_mtime_ns}:{stat.st_size}"
+
+
+def build_database(source, path, cell_size=0.1, batch_rows=500_000):
+    """
+    Build the equipment database from the cultural_data table.
+
+    The file is replaced atomically, so readers never see a partial database.
+
+    Args:
+        source (str): Path to the cultural_data table
+        path (str): Output SQLite file
+        cell_size (float): Size of the grid cells, in degrees
+        batch_rows (int): Rows inserted at once
+    """
+    source = resolve_table(source)
+    data = read_table(source, COLUMNS, CULTURAL_SCHEMA)
+    cells = grid_cells(data["latitude"], data["longitude"], cell_size)
+    temporary = f"{path}.{os.getpid()}.tmp"
+    if os.path.exists(temporary):
+        os.remove(temporary)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    connection = sqlite3.connect(temporary)
+    try:
+        connection.execute("PRAGMA journal_mode = OFF")
+        connection.execute("PRAGMA synchronous = OFF")
+        connection.execute(
+            f"CREATE TABLE {TABLE} (commune_key INTEGER, categorie TEXT, type_infrastructure TEXT,"
+            " latitude REAL, longitude REAL, cell INTEGER)"
+        )
+        connection.execute("CREATE TABLE metadata (key TEXT PRIMARY KEY, value TEXT)")
+        columns = [
+            data["commune_key"].to_numpy(dtype="int64").tolist(),
+            data["categorie"].astype(object).tolist(),
+            data["type_infrastructure"].astype(object).tolist(),
+            # SQLite stores NaN as NULL
+            data["latitude"].to_numpy(dtype="float64").tolist(),
+            data["longitude"].to_numpy(dtype="float64").tolist(),
+            [None if cell < 0 else cell for cell in cells.tolist()],
+        ]
+        for start in range(0, len(data), batch_rows):
+            rows = zip(*(column[start : start + batch_rows] for column in columns))
+            connection.executemany(f"INSERT INTO {TABLE} VALUES (?, ?, ?, ?, ?, ?)", rows)
+        for column in INDEXED_COLUMNS:
+            connection.execute(f"CREATE INDEX {TABLE}_{column} ON {TABLE} ({column})")
+        connection.executemany(
+            "INSERT INTO metadata VALUES (?, ?)",
+            [("source_stamp", _source_stamp(source)), ("cell_size", repr(cell_size))],
+        )
+        connection.execute("ANALYZE")
+        connection.commit()
+    finally:
+        connection.close()
+    os.replace(temporary, path)
+
+
+class ConnectionPool:
+    """
+    Fixed pool of read-only connections to a database file.
+
+    Connections are shared between the threads of the server, each query
+    borrowing one for its duration. Once the pool is closed, borrowed
+    connections are closed when given back.
+
+    Args:
+        path (str): SQLite file
+        size (int): Number of connections
+    """
+
+    def __init__(self, path, size=4):
+        self.path = path
+        self.closed = False
+        self._idle = queue.LifoQueue()
+        uri = f"file:{quote(os.path.abspath(path))}?mode=ro"
+        for _ in range(size):
+            connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            connection.execute("PRAGMA mmap_size = 268435456")
+            self._idle.put(connection)
+        with self.connection() as connection:
+            metadata = dict(connection.execute("SELECT key, value FROM metadata"))
+        self.source_stamp = metadata["source_stamp"]
+        self.cell_size = float(metadata["cell_size"])
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Borrow a connection, waiting for one to be free."""
+        connection = None
+        while connection is None:
+            if self.closed:
+                raise RuntimeError(f"The connections to {self.path} are closed")
+            try:
+                connection = self._idle.get(timeout=1)
+            except queue.Empty:
+                pass
+        try:
+            yield connection
+        finally:
+            self._idle.put(connection)
+            if self.closed:
+                self.close()
+
+    def close(self):
+        """Close the idle connections, and the borrowed ones when given back."""
+        self.closed = True
+        while not self._idle.empty():
+            self._idle.get().close()
+
+
+def open_database(path, source=None, size=4):
+    """
+    Open a pool of connections to the equipment database.
+
+    Args:
+        path (str): SQLite file
+        source (str): cultural_data table the database must have been built from
+        size (int): Number of connections
+
+    Returns:
+        ConnectionPool or None: The pool, or None if the database is missing
+            or older than `source`
+    """
+    if not os.path.exists(path):
+        return None
+    pool = ConnectionPool(path, size)
+    if source is not None and pool.source_stamp != _source_stamp(resolve_table(source)):
+        pool.close()
+        return None
+    return pool
+
+
+def select_rows(pool, categories=None, types=None, commune=None, bounds=None):
+    """
+    Find the equipments matching the filters.
+
+    Args:
+        pool (ConnectionPool): Equipment database
+        categories (list): Categories to keep, all if empty
+        types (list): Infrastructure types to keep, all if empty
+        commune (int): Commune key to keep, all if None
+        bounds (tuple): (south, west, north, east) box to keep, all if None
+
+    Returns:
+        np.ndarray: Sorted positions of the matching rows in the cultural_data table
+    """
+    conditions, parameters = [], []
+    # The category and type indexes are only worth it without a more
+    # selective filter; a unary + keeps SQLite from using them
+    prefix = "+" if commune or bounds is not None else ""
+    for column, values in (("categorie", categories), ("type_infrastructure", types)):
+        if values:
+            conditions.append(f"{prefix}{column} IN ({', '.join('?' * len(values))})")
+            parameters += list(values)
+    if commune:
+        conditions.append("commune_key = ?")
+        parameters.append(int(commune))
+    if bounds is not None:
+        south, west, north, east = bounds
+        # One range of cells per grid row, then the exact box
+        first = grid_cells([south, north], [west, west], pool.cell_size)
+        width = int(grid_cells([south], [east], pool.cell_size)[0] - first[0])
+        ranges = range(first[0], first[1] + 1, _cell_columns(pool.cell_size))
+        conditions.append(f"({' OR '.join(['cell BETWEEN ? AND ?'] * len(ranges))})")
+        parameters += [value for start in ranges for value in (start, start + width)]
+        conditions.append("latitude BETWEEN ? AND ? AND longitude BETWEEN ? AND ?")
+        parameters += [south, north, west, east]
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    with pool.connection() as connection:
+        # A single concatenated value, as fetching rows one by one costs more than the query
+        (rows,) = connection.execute(f"SELECT group_concat(rowid) FROM {TABLE}{where}", parameters).fetchone()
+    if rows is None:
+        return np.empty(0, dtype="int64")
+    return np.sort(np.fromstring(rows, dtype="int64", sep=",")) - 1
+
+
+def unique_values(pool):
+    """
+    Get the values of the filters, read from the indexes.
+
+    Returns:
+        dict: Sorted "communes", "categories" and "types"
+    """
+    with pool.connection() as connection:
+        return {
+            key: [
+                value
+                for value, in connection.execute(
+                    f"SELECT DISTINCT {column} FROM {TABLE} WHERE {column} IS NOT NULL ORDER BY {column}"
+                )
+            ]
+            for key, column in (
+                ("communes", "commune_key"),
+                ("categories", "categorie"),
+                ("types", "type_infrastructure"),
+            )
+        }
@@ -0,0 +1,72 @@
+"""Equipments table shared by the application, with its derived views."""
+
+from functools import cached_property
+
+from ..config.settings import VIEWPORT_CONFIG
+from .commune_search import CommuneSearchIndex
+from .filter_index import FilterIndex
+from .spatial_index import GridIndex
+
+
+class CulturalDataset:
+    """
+    The equipments, loaded once per process, and the views derived from them.
+
+    The tables are shared by all sessions and must not be modified. Each
+    view is computed on first access and then kept on the object; when the
+    files change, loader.load_dataset builds a new dataset, so all the views
+    are dropped together.
+
+    Args:
+        data (pd.DataFrame): One row per equipment
+        communes (pd.DataFrame): Commune dimension
+        version (tuple): Version of the files, as returned by loader.file_version
+    """
+
+    def __init__(self, data, communes, version=None):
+        self.data = data
+        self.communes = communes
+        self.version = version
+
+    @cached_property
+    def options(self):
+        """Sorted "communes", "categories" and "types" of the filters."""
+        return {
+            "communes": sorted(self.data["commune_key"].unique().tolist()),
+            "categories": sorted(self.data["categorie"].dropna().unique()),
+            "types": sorted(self.data["type_infrastructure"].dropna().unique()),
+        }
+
+    @cached_property
+    def commune_search(self):
+        """CommuneSearchIndex over the communes holding equipments."""
+        return CommuneSearchIndex(self.communes[self.communes["commune_key"].isin(self.options["communes"])])
+
+    @cached_property
+    def type_counts(self):
+        """Number of equipments per commune_key, categorie and type_infrastructure."""
+        return (
+            self.data.groupby(["commune_key", "categorie", "type_infrastructure"], observed=True)
+            .size()
+            .reset_index(name="count")
+        )
+
+    @cached_property
+    def density(self):
+        """Number of equipments and cultural density (per 1000 inhabitants) of each commune."""
+        counts = self.data.groupby("commune_key").size().reset_index(name="nombre_equipements")
+        communes = self.communes[["commune_key", "nom_commune", "code_insee", "latitude", "longitude", "population"]]
+        result = counts.merge(communes, on="commune_key", how="left")
+        result = result.rename(columns={"code_insee": "code_postal"})
+        result["densite_culturelle"] = (result["nombre_equipements"] / result["population"]) * 1000
+        return result
+
+    @cached_property
+    def filter_index(self):
+        """FilterIndex over the category, type and commune of the equipments."""
+        return FilterIndex(self.data)
+
+    @cached_property
+    def spatial_index(self):
+        """GridIndex over the coordinates of the equipments."""
+        return GridIndex(self.data["latitude"], self.data["longitude"], VIEWPORT_CONFIG["CELL_SIZE"])
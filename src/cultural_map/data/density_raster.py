@@ -0,0 +1,279 @@
+"""Offline rasterization of the cultural density surface.
+
+The density is computed on the Web Mercator pixel grid of each zoom level,
+with a gaussian kernel of a fixed size in screen pixels (as Leaflet.heat
+does in the browser), then colormapped and written as a pyramid of PNG
+tiles laid out as ``{z}/{x}/{y}.png``. Only the tiles holding some density
+are written.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import struct
+import zlib
+
+import numpy as np
+
+from .clustering import TILE_SIZE, mercator_pixels
+from .columnar import HEATMAP_SCHEMA, read_table, resolve_table
+
+METADATA_FILE = "metadata.json"
+
+# Leaflet.heat default gradient
+GRADIENT = {0.4: "#0000ff", 0.6: "#00ffff", 0.7: "#00ff00", 0.8: "#ffff00", 1.0: "#ff0000"}
+
+
+def write_png(path, rgba):
+    """
+    Write an RGBA image as a PNG file with the standard library only.
+
+    Args:
+        path (str): Output path
+        rgba (np.ndarray): (height, width, 4) uint8 image
+    """
+    height, width, _ = rgba.shape
+    # "Up" filter (type 2): each scanline is stored as its difference with the
+    # previous one, which smooth surfaces compress much better
+    scanlines = rgba.reshape(height, -1)
+    up = np.diff(scanlines, axis=0, prepend=np.zeros((1, width * 4), dtype="uint8"))
+    rows = np.concatenate([np.full((height, 1), 2, dtype="uint8"), up], axis=1)
+
+    def chunk(kind, payload):
+        body = kind + payload
+        return struct.pack(">I", len(payload)) + body + struct.pack(">I", zlib.crc32(body))
+
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)))
+        f.write(chunk(b"IDAT", zlib.compress(rows.tobytes(), 6)))
+        f.write(chunk(b"IEND", b""))
+
+
+def _gaussian_blur(grid, sigma, half_width):
+    """Blur a 2D grid with a separable gaussian kernel, through FFTs."""
+    offsets = np.arange(-half_width, half_width + 1)
+    kernel = np.exp(-(offsets**2) / (2.0 * sigma**2))
+    for axis in (0, 1):
+        n = grid.shape[axis] + len(kernel) - 1
+        spectrum = np.fft.rfft(grid, n, axis=axis)
+        shape = [1, 1]
+        shape[axis] = -1
+        spectrum *= np.fft.rfft(kernel, n).reshape(shape)
+        full = np.fft.irfft(spectrum, n, axis=axis)
+        grid = np.take(full, np.arange(half_width, half_width + grid.shape[axis]), axis=axis)
+    return np.maximum(grid, 0.0)
+
+
+def colormap(values, min_opacity=0.3, max_opacity=0.8, gradient=None):
+    """
+    Map normalized densities to RGBA colors.
+
+    Args:
+        values (np.ndarray): Densities in [0, 1]
+        min_opacity (float): Opacity of the lowest non-zero density
+        max_opacity (float): Opacity of the highest density
+        gradient (dict): Color stops, defaults to the Leaflet.heat gradient
+
+    Returns:
+        np.ndarray: uint8 RGBA array, transparent where the density is zero
+    """
+    gradient = GRADIENT if gradient is None else gradient
+    stops = np.array(sorted(gradient))
+    colors = np.array(
+        [[int(gradient[stop][i:i + 2], 16) for i in (1, 3, 5)] for stop in stops]
+    )
+    rgba = np.empty(values.shape + (4,), dtype="uint8")
+    for channel in range(3):
+        rgba[..., channel] = np.interp(values, stops, colors[:, channel])
+    alpha = min_opacity + (max_opacity - min_opacity) * values
+    rgba[..., 3] = np.where(values > 1e-3, alpha * 255, 0)
+    return rgba
+
+
+def density_tiles(latitude, longitude, weights, zoom, bounds, radius=25, blur=15):
+    """
+    Compute the density surface of weighted points at a zoom level, tile by tile.
+
+    Each tile is blurred on its own, with a margin of the kernel width
+    holding the points around it, so memory does not grow with the area.
+
+    Args:
+        latitude (np.ndarray): Latitudes in degrees
+        longitude (np.ndarray): Longitudes in degrees
+        weights (np.ndarray): Weight of each point
+        zoom (int): Zoom level giving the pixel grid
+        bounds (tuple): ((south, west), (north, east)) area to rasterize
+        radius (int): Kernel radius in screen pixels
+        blur (int): Extra kernel fade-out in screen pixels
+
+    Yields:
+        tuple: (tile x, tile y, (TILE_SIZE, TILE_SIZE) array of densities)
+            for each tile of `bounds` within reach of a point
+    """
+    half_width = radius + blur
+    (south, west), (north, east) = bounds
+    left, top = mercator_pixels(north, west, zoom)
+    right, bottom = mercator_pixels(south, east, zoom)
+    first_tile = int(left // TILE_SIZE), int(top // TILE_SIZE)
+    last_tile = int(right // TILE_SIZE), int(bottom // TILE_SIZE)
+
+    x, y = mercator_pixels(latitude, longitude, zoom)
+    x, y = np.floor(x).astype("int64"), np.floor(y).astype("int64")
+    # Tiles reached by the kernel of each point
+    first_x = np.maximum((x - half_width) // TILE_SIZE, first_tile[0])
+    first_y = np.maximum((y - half_width) // TILE_SIZE, first_tile[1])
+    last_x = np.minimum((x + half_width) // TILE_SIZE, last_tile[0])
+    last_y = np.minimum((y + half_width) // TILE_SIZE, last_tile[1])
+    span = 2 * half_width // TILE_SIZE + 2
+    points, keys = [], []
+    for dx in range(span):
+        for dy in range(span):
+            reached = np.flatnonzero((first_x + dx <= last_x) & (first_y + dy <= last_y))
+            points.append(reached)
+            keys.append((first_x[reached] + dx) << 32 | (first_y[reached] + dy))
+    points, keys = np.concatenate(points), np.concatenate(keys)
+    order = np.argsort(keys, kind="stable")
+    tiles, starts = np.unique(keys[order], return_index=True)
+    stops = np.append(starts[1:], len(order))
+
+    size = TILE_SIZE + 2 * half_width
+    for key, start, stop in zip(tiles.tolist(), starts, stops):
+        tile_x, tile_y = key >> 32, key & 0xFFFFFFFF
+        rows = points[order[start:stop]]
+        col = x[rows] - (tile_x * TILE_SIZE - half_width)
+        row = y[rows] - (tile_y * TILE_SIZE - half_width)
+        grid = np.bincount(row * size + col, weights[rows], minlength=size * size).reshape(size, size)
+        grid = _gaussian_blur(grid, sigma=radius / 2.0, half_width=half_width)
+        inner = slice(half_width, half_width + TILE_SIZE)
+        yield tile_x, tile_y, grid[inner, inner]
+
+
+def density_scale(tiles, quantile=0.99, step=4):
+    """
+    Get the density mapped to 1: a quantile of the non-zero densities.
+
+    The surface is smooth at the scale of the kernel, so the quantile is
+    taken over one pixel out of `step` in each direction.
+
+    Args:
+        tiles (iterable): Tiles from density_tiles
+        quantile (float): Quantile of the non-zero densities mapped to 1
+        step (int): Sampling step in pixels
+
+    Returns:
+        float: Density scale
+    """
+    samples = [grid[::step, ::step].ravel() for _, _, grid in tiles]
+    samples = np.concatenate(samples) if samples else np.empty(0)
+    positive = samples[samples > 0]
+    return float(np.quantile(positive, quantile)) if len(positive) else 1.0
+
+
+def _source_stamp(source):
+    stat = os.stat(source)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def build_density_rasters(
+    source="data/heatmap_data.parquet",
+    out_dir="static/density",
+    bounds=((41.333, -4.833), (51.2, 9.833)),
+    min_zoom=5,
+    max_zoom=9,
+    radius=25,
+    blur=15,
+    min_opacity=0.3,
+    max_opacity=0.8,
+):
+    """
+    Write the colormapped density tiles of each zoom level and their metadata.
+
+    Densities are normalized per zoom level. The tiles are computed twice,
+    once for the scale and once to write them, so that they are never all
+    held in memory.
+
+    Args:
+        source (str): Table with latitude, longitude and cultural_density columns
+        out_dir (str): Output directory
+        bounds (tuple): ((south, west), (north, east)) area to rasterize
+        min_zoom (int): First zoom level
+        max_zoom (int): Last zoom level, stretched when zooming further
+        radius (int): Kernel radius in screen pixels
+        blur (int): Extra kernel fade-out in screen pixels
+        min_opacity (float): Opacity of the lowest non-zero density
+        max_opacity (float): Opacity of the highest density
+
+    Returns:
+        dict: Metadata listing the tiles written at each zoom level
+    """
+    data = read_table(source, ["latitude", "longitude", "cultural_density"], HEATMAP_SCHEMA)
+    data = data[np.isfinite(data).all(axis=1)]
+    columns = (
+        data["latitude"].to_numpy(),
+        data["longitude"].to_numpy(),
+        data["cultural_density"].to_numpy(dtype="float64"),
+    )
+    os.makedirs(out_dir, exist_ok=True)
+
+    levels = []
+    for zoom in range(min_zoom, max_zoom + 1):
+        shutil.rmtree(os.path.join(out_dir, str(zoom)), ignore_errors=True)
+        scale = density_scale(density_tiles(*columns, zoom, bounds, radius=radius, blur=blur))
+        written = []
+        for tile_x, tile_y, grid in density_tiles(*columns, zoom, bounds, radius=radius, blur=blur):
+            values = np.clip(grid / scale, 0.0, 1.0)
+            if not (values > 1e-3).any():
+                continue
+            path = os.path.join(out_dir, str(zoom), str(tile_x), f"{tile_y}.png")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write_png(path, colormap(values, min_opacity, max_opacity))
+            written.append([tile_x, tile_y])
+        levels.append({"zoom": zoom, "tiles": written})
+
+    (south, west), (north, east) = bounds
+    metadata = {
+        "source_stamp": _source_stamp(source),
+        "tile_size": TILE_SIZE,
+        "bounds": [[south, west], [north, east]],
+        "min_zoom": min_zoom,
+        "max_zoom": max_zoom,
+        "levels": levels,
+    }
+    with open(os.path.join(out_dir, METADATA_FILE), "w", encoding="utf-8") as f:
+        json.dump(metadata, f)
+    return metadata
+
+
+def load_density_metadata(out_dir="static/density", source=None):
+    """
+    Load the metadata of built density rasters.
+
+    Returns:
+        dict or None: The metadata, or None if missing, older than `source`
+            or written before the rasters were cut into tiles
+    """
+    path = os.path.join(out_dir, METADATA_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        metadata = json.load(f)
+    if source is not None and metadata.get("source_stamp") != _source_stamp(source):
+        return None
+    if metadata.get("tile_size") != TILE_SIZE:
+        return None
+    return metadata
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the cultural density rasters.")
+    parser.add_argument("--source", default="data/heatmap_data.parquet")
+    parser.add_argument("--out-dir", default="static/density")
+    parser.add_argument("--min-zoom", type=int, default=5)
+    parser.add_argument("--max-zoom", type=int, default=9)
+    args = parser.parse_args()
+    build_density_rasters(
+        resolve_table(args.source), args.out_dir, min_zoom=args.min_zoom, max_zoom=args.max_zoom
+    )
+    print(f"Density rasters written to {args.out_dir}")
@@ -0,0 +1,99 @@
+"""In-memory index of the equipments by category, type and commune."""
+
+import numpy as np
+import pandas as pd
+
+BITMAP_COLUMNS = ["categorie", "type_infrastructure"]
+
+
+class FilterIndex:
+    """
+    Row sets of the filter values, built once over the equipment table.
+
+    Categories and types have few values, so each value gets a packed bitmap
+    of its rows (one bit per row): a selection is the OR of the bitmaps of
+    its values, and selections on both columns are ANDed. Communes have
+    many values with few rows each, so rows are sorted by commune key and
+    each commune stores the offset of its first row (CSR layout, like
+    GridIndex), its rows being one contiguous slice.
+
+    Args:
+        data (pd.DataFrame): Equipments, with categorie, type_infrastructure
+            and commune_key columns
+    """
+
+    def __init__(self, data):
+        self.size = len(data)
+        self.bitmaps = {}
+        # Columns without missing values, where selecting every value selects every row
+        self.complete = {}
+        for column in BITMAP_COLUMNS:
+            codes, values = pd.factorize(data[column])
+            self.bitmaps[column] = {value: np.packbits(codes == code) for code, value in enumerate(values)}
+            self.complete[column] = bool((codes >= 0).all())
+        keys = data["commune_key"].to_numpy()
+        self.positions = np.argsort(keys, kind="stable")
+        self.communes, starts = np.unique(keys[self.positions], return_index=True)
+        self.starts = np.append(starts, self.size)
+
+    def commune_rows(self, commune):
+        """Get the sorted positions of the rows of a commune."""
+        slot = np.searchsorted(self.communes, commune)
+        if slot == len(self.communes) or self.communes[slot] != commune:
+            return np.empty(0, dtype="int64")
+        return self.positions[self.starts[slot] : self.starts[slot + 1]]
+
+    def bitmap(self, column, values):
+        """
+        Packed bitmap of the rows holding one of the values of a column.
+
+        Rows with a missing value never match, as with pandas isin.
+
+        Returns:
+            np.ndarray or None: The bitmap, or None if the values do not
+                restrict the rows (none given, or all of them in a column
+                without missing values)
+        """
+        bitmaps = self.bitmaps[column]
+        if not values or (self.complete[column] and set(bitmaps) <= set(values)):
+            return None
+        mask = np.zeros((self.size + 7) // 8, dtype="uint8")
+        for value in values:
+            if value in bitmaps:
+                mask |= bitmaps[value]
+        return mask
+
+    def select(self, categories=None, types=None, commune=None, rows=None):
+        """
+        Find the rows matching the filters.
+
+        Args:
+            categories (list): Categories to keep, all if empty
+            types (list): Infrastructure types to keep, all if empty
+            commune (int): Commune key to keep, all if None
+            rows (np.ndarray): Sorted positions to select from, all if None
+
+        Returns:
+            np.ndarray or None: Sorted positions of the matching rows, or
+                None if nothing restricts the rows
+        """
+        masks = [
+            mask
+            for mask in (self.bitmap("categorie", categories), self.bitmap("type_infrastructure", types))
+            if mask is not None
+        ]
+        if commune:
+            selected = self.commune_rows(commune)
+            rows = selected if rows is None else np.intersect1d(rows, selected, assume_unique=True)
+        if rows is None:
+            if not masks:
+                return None
+            # Whole bitmaps are combined a byte at a time
+            mask = masks[0] if len(masks) == 1 else np.bitwise_and.reduce(masks)
+            return np.flatnonzero(np.unpackbits(mask, count=self.size))
+        # Only the bits of the candidate rows are tested
+        bytes_, bits = rows >> 3, (7 - (rows & 7)).astype("uint8")
+        keep = np.ones(len(rows), dtype=bool)
+        for mask in masks:
+            keep &= ((mask[bytes_] >> bits) & 1).astype(bool)
+        return rows[keep]
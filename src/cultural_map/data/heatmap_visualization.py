@@ -1,54 +1,119 @@
+"""Score culturel des communes et carte des scores.
+
+À lancer depuis la racine du dépôt: python -m cultural_map.data.heatmap_visualization
+"""
+
+import os
+
 import pandas as pd
-import numpy as np
 import plotly.express as px
+from . import columnar, communes, scoring
+from .columnar import DENSITY_SCORE_SCHEMA, read_table, write_table
+from .communes import department_codes, normalize_insee_codes
+from .manifest import (
+    MANIFEST_PATH,
+    changed_partitions,
+    is_up_to_date,
+    load_manifest,
+    partition_digests,
+    previous_partitions,
+    record_step,
+    save_manifest,
+    step_signature,
+)
+from .scoring import ScoreEngine, ScoreParameters
 
-# path to the file
-path_data='../../../data/results/'
+# path to the file, from the root of the repository
+path_data='data/results/'
 name_file_lieux_equipements_culturels = 'Heatmap_Culture.csv'
-
-
-# load data
-df_synthese=pd.read_csv(path_data+name_file_lieux_equipements_culturels, sep='\t', on_bad_lines='skip' ,encoding='utf-8',low_memory=False)
-df_synthese.head()
+path_synthese = path_data+name_file_lieux_equipements_culturels
+path_score = path_data+'Heatmap_Culture_with_score.parquet'
 
 # variables
 Nbre_habitants = 1000# nbre de habitant par commune pour le calcul du score
 seuil = 10
 
-# calcul de score
-# somme du nbre de culturel par commune ((nbre patrimoine+nbre vivant)=sum(count par commune))
-nbre_culturel = df_synthese.groupby(['code_insee','Commune','Region','latitude','longitude','Population_Totale','Num_Region','Num_Dep'])['Nombre_categorie'].sum() # create Série avec MultiIndex
-# Convertir la Série avec MultiIndex en DataFrame
-df_nbre_culturel = nbre_culturel.reset_index(name='nbr_total_culturel')
 
-# Calcul du score par commune = (nbre patrimoine+ nbre vivant)/population
-# score par commune pour 50 habitants = score par commune * 50
-df_nbre_culturel['Nbre_culturels_N_habitants'] = (df_nbre_culturel['nbr_total_culturel'] / df_nbre_culturel['Population_Totale'])*Nbre_habitants
+def calcul_score(df_synthese, parametres=None):
+    """
+    Calcule le score culturel des communes de df_synthese.
+
+    score = (nbre patrimoine + nbre vivant) / population * Nbre_habitants,
+    seuillé à `seuil` pour l'affichage; les communes sans population sont
+    retirées. Voir cultural_map.data.scoring pour d'autres paramètres.
+    """
+    if parametres is None:
+        parametres = ScoreParameters(per_inhabitants=Nbre_habitants, threshold=seuil)
+    return ScoreEngine(df_synthese).score_table(parametres)
+
+
+def departements(codes_insee):
+    """Département de chaque code INSEE, '' si inconnu."""
+    return department_codes(normalize_insee_codes(codes_insee)).fillna('')
+
+
+def scores_communes(path_synthese=path_synthese, path_score=path_score, force=False, path_manifest=MANIFEST_PATH):
+    """
+    Calcule et enregistre le score culturel des communes.
+
+    Étape du manifeste: sautée si l'entrée, les paramètres et le code n'ont pas changé,
+    sinon seuls les départements modifiés sont recalculés.
+
+    Args:
+        path_synthese (str): fichier Heatmap_Culture.csv
+        path_score (str): fichier Parquet des scores
+        force (bool): tout recalculer, même si à jour
+        path_manifest (str): chemin du manifeste
 
+    Returns:
+        pd.DataFrame: score par commune
+    """
+    manifest = load_manifest(path_manifest)
+    signature = step_signature(
+        manifest,
+        [path_synthese],
+        params={'Nbre_habitants': Nbre_habitants, 'seuil': seuil},
+        code=[__file__, columnar.__file__, communes.__file__, scoring.__file__],
+        manifest_path=path_manifest,
+    )
+    if not force and is_up_to_date(manifest, 'heatmap_score', signature, [path_score], manifest_path=path_manifest):
+        save_manifest(manifest, path_manifest)
+        print('Scores à jour, rien à recalculer')
+        return read_table(path_score)
 
-# seuillage du score, nécessaire pour l'affichage: si le score>1, score=1
-df_nbre_culturel['Nbre_culturels_N_habitants_seuillee'] = df_nbre_culturel['Nbre_culturels_N_habitants'] 
-df_nbre_culturel.loc[df_nbre_culturel['Nbre_culturels_N_habitants_seuillee']>seuil,'Nbre_culturels_N_habitants_seuillee']=seuil
+    # load data
+    df_synthese=pd.read_csv(path_synthese, sep='\t', on_bad_lines='skip' ,encoding='utf-8',low_memory=False)
+    dep_synthese = departements(df_synthese['code_insee'])
+    partitions = {'synthese': partition_digests(df_synthese, dep_synthese)}
 
+    precedent = None if force else previous_partitions(manifest, 'heatmap_score', signature)
+    if precedent is None or not os.path.exists(path_score):
+        modifies = set(partitions['synthese'])
+        df_conserve = None
+    else:
+        modifies = changed_partitions(precedent.get('synthese'), partitions['synthese'])
+        df_conserve = read_table(path_score)
+        df_conserve = df_conserve[~departements(df_conserve['code_insee']).isin(modifies)]
+    print(f'Recalcul de {len(modifies)} départements sur {len(partitions["synthese"])}')
 
-# suprimer les score=Inf dues à une population=0
-# Remplacer les valeurs Inf par NaN
-df_nbre_culturel.replace([np.inf, -np.inf], np.nan, inplace=True)
-# Supprimer les lignes contenant des NaN
-df_nbre_culturel = df_nbre_culturel.dropna()
+    # le score d'une commune ne dépend que des lignes de son département
+    df_nbre_culturel = calcul_score(df_synthese[dep_synthese.isin(modifies)])
+    if df_conserve is not None:
+        df_nbre_culturel = pd.concat([df_conserve, df_nbre_culturel], ignore_index=True)
 
-# heatmap visu
-# rename column for visu
-df_nbre_culturel = df_nbre_culturel.rename(columns={'Nbre_culturels_N_habitants_seuillee':'Nbre culturels pour'+str(Nbre_habitants)+' habitants'})
-df_nbre_culturel.head()
+    # save to a typed Parquet file
+    write_table(df_nbre_culturel, path_score, DENSITY_SCORE_SCHEMA)
+    record_step(manifest, 'heatmap_score', signature, [path_score], partitions, manifest_path=path_manifest)
+    save_manifest(manifest, path_manifest)
+    return df_nbre_culturel
 
-fig = px.scatter_map(df_nbre_culturel, lat="latitude", lon="longitude", color='Nbre culturels pour'+str(Nbre_habitants)+' habitants', size="nbr_total_culturel",
-                 # color_continuous_scale=px.colors.cyclical.IceFire,
-                  color_discrete_sequence=px.colors.qualitative.Pastel,
-                  #px.colors.cyclical.IceFire, #'PuBu',#
-                    size_max=15, zoom=10,
-                  map_style="carto-positron")
-fig.show()
 
-# save to cv files
-df_nbre_culturel.to_csv(path_data+'Heatmap_Culture_with_score.csv', sep='\t', index=False)  
\ No newline at end of file
+if __name__ == "__main__":
+    df_nbre_culturel = scores_communes()
+    fig = px.scatter_map(df_nbre_culturel, lat="latitude", lon="longitude", color='Nbre culturels pour'+str(Nbre_habitants)+' habitants', size="nbr_total_culturel",
+                     # color_continuous_scale=px.colors.cyclical.IceFire,
+                      color_discrete_sequence=px.colors.qualitative.Pastel,
+                      #px.colors.cyclical.IceFire, #'PuBu',#
+                        size_max=15, zoom=10,
+                      map_style="carto-positron")
+    fig.show()
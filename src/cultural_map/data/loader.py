@@ -1,19 +1,341 @@
 """Data loading and processing functionality."""
 
+import os
+
 import pandas as pd
 import streamlit as st
+from ..config.settings import (
+    CLUSTER_CONFIG,
+    DATABASE_CONFIG,
+    DENSITY_RASTER_CONFIG,
+    MAP_CONFIG,
+    STATIC_SERVER_CONFIG,
+    TILE_CONFIG,
+)
+from .clustering import build_cluster_index, load_cluster_index, save_cluster_index
+from .columnar import (
+    COMMUNE_SCHEMA,
+    CULTURAL_SCHEMA,
+    DENSITY_SCORE_SCHEMA,
+    HEATMAP_SCHEMA,
+    read_table,
+    resolve_table,
+)
+from .communes import department_codes, insee_codes, insee_keys
+from .database import open_database, select_rows, unique_values
+from .dataset import CulturalDataset
+from .density_raster import build_density_rasters, load_density_metadata
+from .scoring import ScoreEngine
+from .tiles import load_tile_metadata, start_static_server
+
+CULTURAL_DATA_PATH = "data/cultural_data.parquet"
+HEATMAP_DATA_PATH = "data/heatmap_data.parquet"
+CULTURAL_DENSITY_PATH = "data/results/Heatmap_Culture_with_score.parquet"
+HEATMAP_SOURCE_PATH = "data/results/Heatmap_Culture.csv"
+COMMUNES_PATH = "data/communes.parquet"
+ACCESSIBILITY_PATH = "data/accessibility.parquet"
+
+# Columns read by each consumer of the equipments
+MAP_COLUMNS = list(CULTURAL_SCHEMA)
+VISUALISATION_COLUMNS = ["commune_key"]
+DENSITY_CIRCLE_COLUMNS = [
+    "Commune",
+    "latitude",
+    "longitude",
+    "Population_Totale",
+    "nbr_total_culturel",
+    "Nbre culturels pour1000 habitants",
+]
+
+
+def file_version(*paths):
+    """
+    Get a cache key changing whenever one of the files is modified.
+
+    Pipeline outputs only available as CSV are versioned by their CSV file.
+    """
+    version = []
+    for path in map(resolve_table, paths):
+        if os.path.exists(path):
+            stat = os.stat(path)
+            version.append((path, stat.st_mtime_ns, stat.st_size))
+        else:
+            version.append((path, None, None))
+    return tuple(version)
+
+
+def read_cultural_data(columns=None):
+    """
+    Read the cultural infrastructure data.
+
+    Args:
+        columns (list): Columns to load, all if None
+
+    Returns:
+        pd.DataFrame: One row per equipment, with categorical labels
+    """
+    path = resolve_table(CULTURAL_DATA_PATH)
+    if not path.endswith(".csv"):
+        return read_table(path, columns, CULTURAL_SCHEMA)
+    # CSV outputs written before the commune key get it from their INSEE code
+    data = read_table(path, schema=CULTURAL_SCHEMA)
+    if "commune_key" not in data:
+        data["commune_key"] = insee_keys(data["code_postal"])
+    return data if columns is None else data[columns]
+
+
+@st.cache_data(max_entries=1)
+def load_cultural_data(columns=None, version=None):
+    """
+    Load and cache the cultural infrastructure data, see read_cultural_data.
+
+    Args:
+        columns (list): Columns to load, all if None
+        version (tuple): Version of the equipment file, from file_version,
+            reloading the data when it changes
+    """
+    return read_cultural_data(columns)
+
+
+@st.cache_resource(max_entries=1, show_spinner="Loading cultural data...")
+def load_dataset(version=None):
+    """
+    Load the equipments shared by all sessions, once per version of the files.
+
+    Unlike st.cache_data, the dataset is neither copied nor hashed on each
+    rerun.
+
+    Args:
+        version (tuple): Version of the equipment and commune files, from
+            file_version, replacing the dataset and its views when it changes
+
+    Returns:
+        CulturalDataset: The equipments with MAP_COLUMNS, and the communes
+    """
+    return CulturalDataset(read_cultural_data(MAP_COLUMNS), load_communes(version), version)
+
+
+@st.cache_data(max_entries=1)
+def load_communes(version=None):
+    """
+    Load and cache the commune dimension.
+
+    Without the table written by prepare_data, a reduced dimension is
+    derived from the equipments: no region nor PVD membership.
+
+    Args:
+        version (tuple): Version of the equipment and commune files, from
+            file_version, the same as load_dataset's so that both reload
+            together
+
+    Returns:
+        pd.DataFrame: One row per commune with the columns of COMMUNE_SCHEMA
+    """
+    if os.path.exists(COMMUNES_PATH):
+        return read_table(COMMUNES_PATH)
+    data = read_cultural_data(["commune_key", "nom_commune", "latitude", "longitude", "population"])
+    communes = data.groupby("commune_key", observed=True).agg(
+        nom_commune=("nom_commune", "first"),
+        population=("population", "first"),
+        latitude=("latitude", "first"),
+        longitude=("longitude", "first"),
+        nombre_structures=("commune_key", "size"),
+    )
+    communes = communes.reset_index()
+    communes["code_insee"] = insee_codes(communes["commune_key"])
+    communes["departement"] = department_codes(communes["code_insee"])
+    communes["region"] = None
+    communes["pvd"] = False
+    communes["cultural_density"] = communes["nombre_structures"] * 1000 / communes["population"]
+    communes["nom_commune"] = communes["nom_commune"].astype(str)
+    return communes[list(COMMUNE_SCHEMA)].astype(COMMUNE_SCHEMA)
+
+
+@st.cache_resource(max_entries=1, show_spinner="Loading cluster index...")
+def load_equipment_clusters(version=None):
+    """
+    Load the per-zoom cluster index, building it once if missing or stale.
+
+    Args:
+        version (tuple): Version of the equipment file, from file_version,
+            reloading the index when it changes
+    """
+    source = resolve_table(CULTURAL_DATA_PATH)
+    index = load_cluster_index(CLUSTER_CONFIG["INDEX_PATH"], source=source)
+    if index is None:
+        index = build_cluster_index(
+            read_cultural_data(),
+            min_zoom=CLUSTER_CONFIG["MIN_ZOOM"],
+            max_zoom=CLUSTER_CONFIG["MAX_ZOOM"],
+            radius=CLUSTER_CONFIG["RADIUS_PX"],
+        )
+        save_cluster_index(index, CLUSTER_CONFIG["INDEX_PATH"], source=source)
+    return index
+
+
+# Pool returned by load_database, closed once a new version replaces it
+_database_pools = []
+
+
+@st.cache_resource(max_entries=1)
+def load_database(version=None):
+    """
+    Open the pool of read-only connections to the equipment database, once per version of the files.
+
+    The pool of the previous version is closed: rebuilding the database
+    replaces its file, which the old connections would keep reading.
+
+    Args:
+        version (tuple): Version of the equipment table and database files,
+            from file_version
+
+    Returns:
+        ConnectionPool or None: The pool, or None if disabled, not built or
+            older than the equipments
+    """
+    while _database_pools:
+        _database_pools.pop().close()
+    if not DATABASE_CONFIG["ENABLED"]:
+        return None
+    pool = open_database(
+        DATABASE_CONFIG["PATH"], source=CULTURAL_DATA_PATH, size=DATABASE_CONFIG["POOL_SIZE"]
+    )
+    if pool is not None:
+        _database_pools.append(pool)
+    return pool
+
+
+@st.cache_resource
+def load_static_server():
+    """Start the endpoint serving the pre-built map assets on STATIC_SERVER_CONFIG["PORT"], once per process."""
+    return start_static_server(
+        STATIC_SERVER_CONFIG["ROOT"], STATIC_SERVER_CONFIG["HOST"], STATIC_SERVER_CONFIG["PORT"]
+    )
+
+
+def static_base_url():
+    """
+    Get the URL the browser fetches the files of STATIC_SERVER_CONFIG["ROOT"] from.
+
+    In order: the configured PUBLIC_URL, the endpoint started on PORT, or
+    Streamlit's own static serving (server.enableStaticServing) as a path
+    on the origin of the page, which works from any host and over HTTPS.
+
+    Returns:
+        str or None: Base URL, or None if nothing serves the files, layer
+            data then being inlined in the page
+    """
+    local_url = load_static_server() if STATIC_SERVER_CONFIG["PORT"] else None
+    if STATIC_SERVER_CONFIG["PUBLIC_URL"]:
+        return STATIC_SERVER_CONFIG["PUBLIC_URL"].rstrip("/")
+    if local_url is not None:
+        return local_url
+    if st.get_option("server.enableStaticServing"):
+        base_path = (st.get_option("server.baseUrlPath") or "").strip("/")
+        return "/" + "/".join(filter(None, [base_path, "app", "static"]))
+    return None
+
+
+@st.cache_resource
+def load_equipment_tiles():
+    """
+    Get the equipment tile pyramid served to the browser.
+
+    Returns:
+        dict or None: Tile "url" and pyramid "metadata", or None if the
+            pyramid has not been built or is not served
+    """
+    metadata = load_tile_metadata(TILE_CONFIG["DIR"])
+    base_url = static_base_url()
+    if metadata is None or base_url is None:
+        return None
+    return {"url": f"{base_url}/{TILE_CONFIG['URL_PATH']}", "metadata": metadata}
+
+
+@st.cache_resource(show_spinner="Building density rasters...")
+def load_density_rasters():
+    """
+    Serve the cultural density rasters, building them once if missing or stale.
+
+    Returns:
+        dict: Raster "url" and "metadata" (image file and bounds per zoom
+            level), the url being None if the rasters are not served
+    """
+    source = resolve_table(HEATMAP_DATA_PATH)
+    metadata = load_density_metadata(DENSITY_RASTER_CONFIG["DIR"], source=source)
+    if metadata is None:
+        metadata = build_density_rasters(
+            source,
+            DENSITY_RASTER_CONFIG["DIR"],
+            bounds=(MAP_CONFIG["FRANCE_SW"], MAP_CONFIG["FRANCE_NE"]),
+            min_zoom=DENSITY_RASTER_CONFIG["MIN_ZOOM"],
+            max_zoom=DENSITY_RASTER_CONFIG["MAX_ZOOM"],
+            radius=DENSITY_RASTER_CONFIG["RADIUS_PX"],
+            blur=DENSITY_RASTER_CONFIG["BLUR_PX"],
+            min_opacity=DENSITY_RASTER_CONFIG["MIN_OPACITY"],
+            max_opacity=DENSITY_RASTER_CONFIG["MAX_OPACITY"],
+        )
+    base_url = static_base_url()
+    return {
+        "url": None if base_url is None else f"{base_url}/{DENSITY_RASTER_CONFIG['URL_PATH']}",
+        "metadata": metadata,
+    }
 
-@st.cache_data
-def load_cultural_data():
-    """Load and cache the cultural infrastructure data."""
-    return pd.read_csv("data/cultural_data.csv")
 
 @st.cache_data
 def load_heatmap_data():
     """Load and cache the heatmap data."""
-    return pd.read_csv("data/heatmap_data.csv")
+    return read_table(resolve_table(HEATMAP_DATA_PATH), schema=HEATMAP_SCHEMA)
+
+
+@st.cache_resource(show_spinner="Computing commune statistics...")
+def load_score_engine():
+    """
+    Count the cultural elements of each commune once per process, for the score panel.
+
+    Returns:
+        ScoreEngine or None: The engine, or None without Heatmap_Culture.csv
+    """
+    if not os.path.exists(HEATMAP_SOURCE_PATH):
+        return None
+    return ScoreEngine(pd.read_csv(HEATMAP_SOURCE_PATH, sep="\t", low_memory=False))
+
+
+def load_accessibility(type_name=None):
+    """
+    Load the accessibility table written by data/accessibility.py.
+
+    Args:
+        type_name (str): Infrastructure type to keep, all if None
 
-def filter_data(df, selected_categories=None, selected_types=None, selected_commune=None):
+    Returns:
+        pd.DataFrame or None: One row per commune and type, or None if the
+            table has not been built
+    """
+    if not os.path.exists(ACCESSIBILITY_PATH):
+        return None
+    filters = None if type_name is None else [("type_infrastructure", "==", type_name)]
+    return pd.read_parquet(ACCESSIBILITY_PATH, filters=filters)
+
+
+def load_density_scores(columns=DENSITY_CIRCLE_COLUMNS):
+    """
+    Load the per-commune cultural density scores.
+
+    Args:
+        columns (list): Columns to load, those of the density circles by default
+
+    Returns:
+        pd.DataFrame: One row per commune
+    """
+    return read_table(
+        resolve_table(CULTURAL_DENSITY_PATH), columns, DENSITY_SCORE_SCHEMA, sep="\t"
+    )
+
+
+def filter_data(
+    df, selected_categories=None, selected_types=None, selected_commune=None, database=None
+):
     """
     Filter the dataframe based on selected criteria.
     
@@ -21,11 +343,15 @@ def filter_data(df, selected_categories=None, selected_types=None, selected_comm
         df (pd.DataFrame): The input dataframe
         selected_categories (list): List of selected categories
         selected_types (list): List of selected infrastructure types
-        selected_commune (str): Selected commune name
+        selected_commune (int): Selected commune key
+        database (ConnectionPool): Equipment database to filter in SQL,
+            `df` then being the whole cultural_data table
         
     Returns:
         pd.DataFrame: Filtered dataframe
     """
+    if database is not None:
+        return df.iloc[select_rows(database, selected_categories, selected_types, selected_commune)]
     filtered_df = df.copy()
     
     if selected_categories:
@@ -33,14 +359,17 @@ def filter_data(df, selected_categories=None, selected_types=None, selected_comm
     if selected_types:
         filtered_df = filtered_df[filtered_df["type_infrastructure"].isin(selected_types)]
     if selected_commune:
-        filtered_df = filtered_df[filtered_df["nom_commune"] == selected_commune]
+        filtered_df = filtered_df[filtered_df["commune_key"] == selected_commune]
         
     return filtered_df
 
-def get_unique_values(df):
-    """Get unique values for filtering options."""
+
+def get_unique_values(df, database=None):
+    """Get unique values for filtering options, from the database indexes if given."""
+    if database is not None:
+        return unique_values(database)
     return {
-        "communes": sorted(df["nom_commune"].unique()),
+        "communes": sorted(df["commune_key"].unique().tolist()),
         "categories": sorted(df["categorie"].unique()),
         "types": sorted(df["type_infrastructure"].unique())
     }
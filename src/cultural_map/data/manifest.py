@@ -0,0 +1,254 @@
+"""Content-hashed manifest of the data preparation steps.
+
+Each step records the hashes of its input files, parameters and code, the
+hashes of the outputs it wrote and, for partitioned steps, one hash per
+partition of its inputs. A step whose record still matches is skipped; a
+partitioned step only recomputes the partitions whose hash changed.
+
+File paths are stored relative to the manifest, so that scripts run from
+other directories share the same records. Steps running in parallel merge
+their records into the file under a lock.
+"""
+
+import contextlib
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+try:
+    import fcntl
+except ImportError:  # Windows: steps must not run in parallel
+    fcntl = None
+
+MANIFEST_PATH = "data/manifest.json"
+
+_CHUNK_BYTES = 1 << 20
+
+# Steps recorded since the manifest was loaded, not written to the file
+_RECORDED = "_recorded"
+
+
+def load_manifest(path=MANIFEST_PATH):
+    """Load the manifest, or an empty one if missing or unreadable."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {"files": {}, "steps": {}}
+    manifest.setdefault("files", {})
+    manifest.setdefault("steps", {})
+    return manifest
+
+
+@contextlib.contextmanager
+def _locked(path):
+    with open(f"{path}.lock", "a") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def save_manifest(manifest, path=MANIFEST_PATH):
+    """
+    Write the manifest atomically.
+
+    The file is merged with the records other steps saved since it was
+    loaded: the file hashes of both are kept and only the steps recorded
+    through `manifest` replace theirs.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with _locked(path):
+        current = load_manifest(path)
+        current["files"].update(manifest["files"])
+        for step in manifest.pop(_RECORDED, ()):
+            current["steps"][step] = manifest["steps"][step]
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            json.dump(current, f, indent=1, sort_keys=True)
+        os.replace(temporary, path)
+    manifest.update(current)
+
+
+def _key(path, manifest_path):
+    return os.path.relpath(os.path.abspath(path), os.path.dirname(os.path.abspath(manifest_path)))
+
+
+def file_digest(path, manifest=None, manifest_path=MANIFEST_PATH):
+    """
+    Hash the content of a file.
+
+    The hash is reused from the manifest while the file keeps the same
+    modification time and size, so unchanged inputs are not read again.
+
+    Args:
+        path (str): File to hash
+        manifest (dict): Manifest caching the file hashes
+        manifest_path (str): Path of the manifest
+
+    Returns:
+        str or None: SHA-1 of the content, None if the file is missing
+    """
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    stamp = [stat.st_mtime_ns, stat.st_size]
+    files = manifest["files"] if manifest is not None else {}
+    key = _key(path, manifest_path)
+    cached = files.get(key)
+    if cached is not None and cached["stamp"] == stamp:
+        return cached["sha1"]
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_CHUNK_BYTES), b""):
+            digest.update(chunk)
+    files[key] = {"stamp": stamp, "sha1": digest.hexdigest()}
+    return files[key]["sha1"]
+
+
+def value_digest(value):
+    """Hash a JSON-serializable value, such as the parameters of a step."""
+    text = json.dumps(value, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def step_signature(manifest, inputs, params=None, code=(), manifest_path=MANIFEST_PATH):
+    """
+    Describe what a step depends on.
+
+    Args:
+        manifest (dict): Manifest caching the file hashes
+        inputs (list): Input files
+        params (dict): Parameters of the step
+        code (list): Source files of the step, its code version
+        manifest_path (str): Path of the manifest
+
+    Returns:
+        dict: Hashes of the "inputs", "params" and "code"
+    """
+    return {
+        "inputs": {_key(path, manifest_path): file_digest(path, manifest, manifest_path) for path in inputs},
+        "params": value_digest(params or {}),
+        "code": value_digest([file_digest(path, manifest, manifest_path) for path in code]),
+    }
+
+
+def is_up_to_date(manifest, step, signature, outputs, manifest_path=MANIFEST_PATH):
+    """
+    Check whether a step can be skipped.
+
+    Args:
+        manifest (dict): Manifest
+        step (str): Step name
+        signature (dict): Current signature from step_signature
+        outputs (list): Output files of the step
+        manifest_path (str): Path of the manifest
+
+    Returns:
+        bool: True if the step ran with the same signature and its outputs
+            are still the files it wrote
+    """
+    record = manifest["steps"].get(step)
+    if record is None or record["signature"] != signature:
+        return False
+    return all(
+        record["outputs"].get(_key(path, manifest_path)) == file_digest(path, manifest, manifest_path)
+        for path in outputs
+    )
+
+
+def record_step(
+    manifest, step, signature, outputs, partitions=None, stats=None, manifest_path=MANIFEST_PATH
+):
+    """
+    Record a completed step.
+
+    Args:
+        manifest (dict): Manifest, updated in place
+        step (str): Step name
+        signature (dict): Signature the step ran with
+        outputs (list): Output files the step wrote
+        partitions (dict): Partition hashes of each partitioned input
+        stats (dict): JSON-serializable statistics of the run, kept for
+            the runs that skip the step
+        manifest_path (str): Path of the manifest
+    """
+    manifest["steps"][step] = {
+        "signature": signature,
+        "outputs": {_key(path, manifest_path): file_digest(path, manifest, manifest_path) for path in outputs},
+        "partitions": partitions or {},
+        "stats": stats or {},
+    }
+    manifest.setdefault(_RECORDED, []).append(step)
+
+
+def previous_partitions(manifest, step, signature):
+    """
+    Get the partition hashes a step recorded with the same code and parameters.
+
+    Returns:
+        dict or None: Partition hashes per input, None when the step must
+            recompute everything
+    """
+    record = manifest["steps"].get(step)
+    if record is None:
+        return None
+    same_code = all(record["signature"][part] == signature[part] for part in ("params", "code"))
+    return record["partitions"] if same_code else None
+
+
+def update_partition_hashes(hashers, data, keys):
+    """
+    Feed the rows of a table, or of a chunk of it, to running partition hashes.
+
+    Feeding the chunks of a table in order gives the hashes of the whole
+    table, so partitions can be hashed without loading it at once.
+
+    Args:
+        hashers (dict): Running SHA-1 per partition, updated in place
+        data (pd.DataFrame): Table or chunk
+        keys (pd.Series): Partition of each row
+
+    Returns:
+        dict: `hashers`
+    """
+    row_hashes = pd.util.hash_pandas_object(data, index=False).to_numpy()
+    keys = keys.fillna("").astype(str).to_numpy()
+    order = np.argsort(keys, kind="stable")
+    names, starts = np.unique(keys[order], return_index=True)
+    groups = np.split(row_hashes[order], starts[1:])
+    for name, group in zip(names.tolist(), groups):
+        hashers.setdefault(name, hashlib.sha1()).update(group.tobytes())
+    return hashers
+
+
+def hexdigests(hashers):
+    """Get the digests of running partition hashes."""
+    return {name: hasher.hexdigest() for name, hasher in hashers.items()}
+
+
+def partition_digests(data, keys):
+    """
+    Hash the rows of a table per partition.
+
+    Args:
+        data (pd.DataFrame): Table
+        keys (pd.Series): Partition of each row
+
+    Returns:
+        dict: SHA-1 of the rows of each partition, in table order
+    """
+    return hexdigests(update_partition_hashes({}, data, keys))
+
+
+def changed_partitions(previous, current):
+    """Get the partitions added, removed or modified between two hash sets."""
+    if previous is None:
+        return set(current)
+    return {
+        name
+        for name in set(previous) | set(current)
+        if previous.get(name) != current.get(name)
+    }
@@ -0,0 +1,100 @@
+"""Merge of the number of cultural elements per category into the commune list."""
+
+import argparse
+
+import pandas as pd
+
+from .communes import MISSING_KEY, insee_keys
+from .manifest import (
+    MANIFEST_PATH,
+    is_up_to_date,
+    load_manifest,
+    record_step,
+    save_manifest,
+    step_signature,
+)
+
+COMMUNES_PATH = "data/20230823-communes-departement-region.csv"
+CATEGORIES_PATH = "data/nbre_categorie_parcommuneetcodepostal.csv"
+OUTPUT_PATH = "data/communes_with_categories.csv"
+
+STEP = "merge_categories"
+
+
+def merge_categories(
+    communes_path=COMMUNES_PATH,
+    categories_path=CATEGORIES_PATH,
+    output_path=OUTPUT_PATH,
+    force=False,
+    manifest_path=MANIFEST_PATH,
+):
+    """
+    Add the number of elements of each category to the communes, joined on their INSEE key.
+
+    The step is skipped when the manifest shows that its inputs did not change.
+
+    Args:
+        communes_path (str): Communes, departments and regions CSV file
+        categories_path (str): Number of elements per commune and category
+        output_path (str): Output CSV file
+        force (bool): Merge even if the output is up to date
+        manifest_path (str): Path of the data manifest
+
+    Returns:
+        dict: Number of communes "merged", of categorized codes without a
+            commune ("unmatched") and whether the step was "skipped"
+    """
+    manifest = load_manifest(manifest_path)
+    signature = step_signature(
+        manifest, [communes_path, categories_path], code=[__file__], manifest_path=manifest_path
+    )
+    if not force and is_up_to_date(manifest, STEP, signature, [output_path], manifest_path=manifest_path):
+        save_manifest(manifest, manifest_path)
+        return dict(manifest["steps"][STEP]["stats"], skipped=True)
+
+    # Read the CSV files
+    communes_df = pd.read_csv(communes_path, dtype={'code_commune_INSEE': str})
+    categories_df = pd.read_csv(categories_path, delimiter='\t', dtype={'code_insee': str})
+
+    # Key both files by their INSEE code
+    communes_df['commune_key'] = insee_keys(communes_df['code_commune_INSEE'])
+    categories_df['commune_key'] = insee_keys(categories_df['code_insee'])
+
+    # Create a pivot table to get categories and counts side by side
+    categories_pivot = categories_df[categories_df['commune_key'] != MISSING_KEY].pivot_table(
+        index='commune_key',
+        columns='categorie',
+        values='Nombre d\'éléments',
+        aggfunc='sum',
+        fill_value=0
+    ).reset_index()
+
+    # Rename columns to be more descriptive
+    for col in categories_pivot.columns:
+        if col != 'commune_key':
+            categories_pivot.rename(columns={col: f'nombre_{col}'}, inplace=True)
+
+    # Merge with the communes file
+    result = communes_df.merge(
+        categories_pivot,
+        on='commune_key',
+        how='inner'  # Changed from 'left' to 'inner' to keep only matching communes
+    )
+
+    # Save the result
+    result.to_csv(output_path, index=False)
+    unmatched = ~categories_pivot['commune_key'].isin(communes_df['commune_key'])
+    stats = {"merged": len(result), "unmatched": int(unmatched.sum())}
+    record_step(manifest, STEP, signature, [output_path], stats=stats, manifest_path=manifest_path)
+    save_manifest(manifest, manifest_path)
+    return dict(stats, skipped=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge the category counts into the communes.")
+    parser.add_argument("--force", action="store_true", help="Merge even if up to date")
+    args = parser.parse_args()
+    stats = merge_categories(force=args.force)
+    if stats["skipped"]:
+        print("Categories already merged, nothing to do.")
+    print(f"{stats['merged']} communes merged, {stats['unmatched']} categorized codes without a commune")
@@ -0,0 +1,380 @@
+"""Cultural points of interest from OpenStreetMap extracts and diffs.
+
+Extracts (.osm XML, optionally gzip or bzip2 compressed, or .pbf with the
+optional pyosmium package) are streamed: parsed elements are cleared as
+soon as they are read, so memory depends on the number of cultural
+features and not on the size of the extract. Nodes and ways with a
+cultural tag are kept, ways at the mean position of their nodes; relations
+are ignored.
+
+The features are stored in data/osm with the coordinates of the nodes of
+their ways, so that .osc diff files can then be applied without reading
+the extract again.
+"""
+
+import argparse
+import bz2
+import glob
+import gzip
+import os
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import pandas as pd
+
+from .columnar import read_table, write_table
+from .manifest import (
+    MANIFEST_PATH,
+    file_digest,
+    is_up_to_date,
+    load_manifest,
+    record_step,
+    save_manifest,
+    step_signature,
+)
+
+try:
+    import osmium
+except ImportError:  # Only needed for .pbf extracts
+    osmium = None
+
+EXTRACT_PATH = "data/osm/france-latest.osm.pbf"
+DIFF_DIR = "data/osm/diffs"
+FEATURES_PATH = "data/osm/osm_equipments.parquet"
+WAY_NODES_PATH = "data/osm/osm_way_nodes.parquet"
+
+# OSM tag -> (type_infrastructure, categorie), the first matching tag wins
+CULTURAL_TAGS = {
+    ("tourism", "museum"): ("Musée", "vivant"),
+    ("tourism", "gallery"): ("Centre d'art", "vivant"),
+    ("amenity", "theatre"): ("Théâtre", "vivant"),
+    ("amenity", "cinema"): ("Cinéma", "vivant"),
+    ("amenity", "library"): ("Bibliothèque", "vivant"),
+    ("amenity", "arts_centre"): ("Centre culturel", "vivant"),
+    ("amenity", "music_school"): ("Conservatoire", "vivant"),
+    ("shop", "books"): ("Librairie", "vivant"),
+    ("historic", "monument"): ("Monument", "patrimoine"),
+    ("historic", "castle"): ("Monument", "patrimoine"),
+    ("historic", "church"): ("Monument", "patrimoine"),
+    ("historic", "memorial"): ("Lieu de mémoire", "patrimoine"),
+    ("historic", "archaeological_site"): ("Lieu archéologique", "patrimoine"),
+}
+
+FEATURE_SCHEMA = {
+    "osm_type": "category",
+    "osm_id": "int64",
+    "nom_infrastructure": "object",
+    "type_infrastructure": "category",
+    "categorie": "category",
+    "latitude": "float64",
+    "longitude": "float64",
+}
+WAY_NODES_SCHEMA = {
+    "way_id": "int64",
+    "node_id": "int64",
+    "latitude": "float64",
+    "longitude": "float64",
+}
+
+STEP = "osm"
+
+
+def classify(tags):
+    """
+    Map OSM tags to our equipment vocabulary.
+
+    Args:
+        tags (dict): Tags of an element
+
+    Returns:
+        tuple or None: (type_infrastructure, categorie), None if the
+            element is not cultural
+    """
+    for (key, value), kind in CULTURAL_TAGS.items():
+        if tags.get(key) == value:
+            return kind
+    return None
+
+
+def _feature(osm_type, osm_id, tags, kind, latitude, longitude):
+    return {
+        "osm_type": osm_type,
+        "osm_id": osm_id,
+        "nom_infrastructure": tags.get("name", kind[0]),
+        "type_infrastructure": kind[0],
+        "categorie": kind[1],
+        "latitude": latitude,
+        "longitude": longitude,
+    }
+
+
+def _open(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    if path.endswith(".bz2"):
+        return bz2.open(path, "rb")
+    return open(path, "rb")
+
+
+def iter_elements(path, kinds=("node", "way")):
+    """
+    Stream the nodes and ways of an OSM XML file, extract or diff.
+
+    Args:
+        path (str): .osm or .osc file, optionally .gz or .bz2 compressed
+        kinds (tuple): Element kinds to yield
+
+    Yields:
+        dict: "kind", "id", "action" ("create", "modify" or "delete" in a
+            diff, None in an extract), "tags", "lat" and "lon" for nodes
+            and "refs" for ways
+    """
+    action = None
+    with _open(path) as f:
+        context = ET.iterparse(f, events=("start", "end"))
+        _, root = next(context)
+        for event, element in context:
+            if element.tag in ("create", "modify", "delete"):
+                action = element.tag if event == "start" else None
+                if event == "end":
+                    root.clear()
+                continue
+            if event != "end" or element.tag not in ("node", "way", "relation"):
+                continue
+            if element.tag in kinds:
+                item = {
+                    "kind": element.tag,
+                    "id": int(element.get("id")),
+                    "action": action,
+                    "tags": {tag.get("k"): tag.get("v") for tag in element.iter("tag")},
+                }
+                if element.tag == "node":
+                    lat, lon = element.get("lat"), element.get("lon")
+                    item["lat"] = float(lat) if lat is not None else np.nan
+                    item["lon"] = float(lon) if lon is not None else np.nan
+                else:
+                    item["refs"] = [int(nd.get("ref")) for nd in element.iter("nd")]
+                yield item
+            # Drop the parsed elements, keeping memory bounded
+            element.clear()
+            if action is None:
+                root.clear()
+
+
+def _read_xml_extract(path):
+    """Read the cultural features of an XML extract, in two streaming passes."""
+    features, ways = [], {}
+    for item in iter_elements(path):
+        kind = classify(item["tags"])
+        if kind is None:
+            continue
+        if item["kind"] == "node":
+            features.append(_feature("node", item["id"], item["tags"], kind, item["lat"], item["lon"]))
+        else:
+            ways[item["id"]] = (item["tags"], kind, item["refs"])
+
+    # Nodes come before ways: find the nodes of the cultural ways in a
+    # second pass, stopped once they are all found or the ways begin
+    needed = {ref for _, _, refs in ways.values() for ref in refs}
+    locations = {}
+    if needed:
+        for item in iter_elements(path, kinds=("node", "way")):
+            if item["kind"] != "node":
+                break
+            if item["id"] in needed:
+                locations[item["id"]] = (item["lat"], item["lon"])
+                if len(locations) == len(needed):
+                    break
+    way_nodes = [
+        (way_id, ref) + locations[ref]
+        for way_id, (_, _, refs) in ways.items()
+        for ref in refs
+        if ref in locations
+    ]
+    return features, ways, way_nodes
+
+
+def _read_pbf_extract(path):
+    """Read the cultural features of a PBF extract with pyosmium, in one pass."""
+    if osmium is None:
+        raise ImportError("Reading .pbf extracts needs the pyosmium package")
+    features, ways, way_nodes = [], {}, []
+    processor = osmium.FileProcessor(path, osmium.osm.NODE | osmium.osm.WAY).with_locations()
+    for element in processor:
+        tags = {tag.k: tag.v for tag in element.tags}
+        kind = classify(tags)
+        if kind is None:
+            continue
+        if element.is_node():
+            location = element.location
+            features.append(_feature("node", element.id, tags, kind, location.lat, location.lon))
+        else:
+            refs = []
+            for node in element.nodes:
+                refs.append(node.ref)
+                if node.location.valid():
+                    way_nodes.append((element.id, node.ref, node.location.lat, node.location.lon))
+            ways[element.id] = (tags, kind, refs)
+    return features, ways, way_nodes
+
+
+def _way_features(ways, way_nodes):
+    """Place the cultural ways at the mean position of their nodes."""
+    if not ways:
+        return pd.DataFrame(columns=list(FEATURE_SCHEMA))
+    centers = way_nodes.groupby("way_id")[["latitude", "longitude"]].mean()
+    rows = [
+        _feature("way", way_id, tags, kind, *centers.loc[way_id])
+        for way_id, (tags, kind, _) in ways.items()
+        if way_id in centers.index
+    ]
+    return pd.DataFrame(rows, columns=list(FEATURE_SCHEMA))
+
+
+def read_extract(path):
+    """
+    Read the cultural features of an OSM extract.
+
+    Args:
+        path (str): .osm(.gz/.bz2) or .pbf extract
+
+    Returns:
+        tuple: (features with the columns of FEATURE_SCHEMA, coordinates of
+            the nodes of the cultural ways with those of WAY_NODES_SCHEMA)
+    """
+    reader = _read_pbf_extract if path.endswith(".pbf") else _read_xml_extract
+    features, ways, way_nodes = reader(path)
+    way_nodes = pd.DataFrame(way_nodes, columns=list(WAY_NODES_SCHEMA))
+    features = pd.DataFrame(features, columns=list(FEATURE_SCHEMA))
+    features = pd.concat([features, _way_features(ways, way_nodes)], ignore_index=True)
+    return features, way_nodes
+
+
+def apply_diff(features, way_nodes, path):
+    """
+    Apply an .osc diff file to the stored features.
+
+    Nodes of a way that are not in the diff keep their stored coordinates;
+    a cultural way none of whose nodes are known is dropped.
+
+    Args:
+        features (pd.DataFrame): Stored features
+        way_nodes (pd.DataFrame): Stored coordinates of the nodes of the ways
+        path (str): .osc file, optionally .gz or .bz2 compressed
+
+    Returns:
+        tuple: Updated (features, way_nodes)
+    """
+    # Later versions of an element replace earlier ones
+    nodes, ways = {}, {}
+    for item in iter_elements(path):
+        (nodes if item["kind"] == "node" else ways)[item["id"]] = item
+    moves = pd.DataFrame(
+        [(node_id, node["lat"], node["lon"]) for node_id, node in nodes.items() if node["action"] != "delete"],
+        columns=["node_id", "latitude", "longitude"],
+    ).set_index("node_id")
+
+    # Move the stored way nodes, and the stored ways holding them
+    way_nodes = way_nodes[~way_nodes["way_id"].isin(ways)].copy()
+    moved = way_nodes["node_id"].isin(moves.index)
+    way_nodes.loc[moved, ["latitude", "longitude"]] = moves.loc[way_nodes.loc[moved, "node_id"]].to_numpy()
+    touched = way_nodes[way_nodes["way_id"].isin(way_nodes.loc[moved, "way_id"])]
+    centers = touched.groupby("way_id")[["latitude", "longitude"]].mean()
+    placed = (features["osm_type"] == "way") & features["osm_id"].isin(centers.index)
+    features = features.copy()
+    features.loc[placed, ["latitude", "longitude"]] = centers.loc[features.loc[placed, "osm_id"]].to_numpy()
+
+    # Replace the elements of the diff
+    locations = dict(zip(way_nodes["node_id"], zip(way_nodes["latitude"], way_nodes["longitude"])))
+    locations.update(zip(moves.index, zip(moves["latitude"], moves["longitude"])))
+    rows, new_way_nodes = [], []
+    for node_id, node in nodes.items():
+        kind = None if node["action"] == "delete" else classify(node["tags"])
+        if kind is not None:
+            rows.append(_feature("node", node_id, node["tags"], kind, node["lat"], node["lon"]))
+    for way_id, way in ways.items():
+        kind = None if way["action"] == "delete" else classify(way["tags"])
+        known = [(way_id, ref) + locations[ref] for ref in way["refs"] if ref in locations]
+        if kind is None or not known:
+            continue
+        new_way_nodes += known
+        latitude, longitude = np.mean([node[2:] for node in known], axis=0)
+        rows.append(_feature("way", way_id, way["tags"], kind, latitude, longitude))
+
+    replaced = ((features["osm_type"] == "node") & features["osm_id"].isin(nodes)) | (
+        (features["osm_type"] == "way") & features["osm_id"].isin(ways)
+    )
+    features = pd.concat(
+        [features[~replaced], pd.DataFrame(rows, columns=list(FEATURE_SCHEMA))], ignore_index=True
+    )
+    way_nodes = pd.concat(
+        [way_nodes, pd.DataFrame(new_way_nodes, columns=list(WAY_NODES_SCHEMA))], ignore_index=True
+    )
+    return features, way_nodes
+
+
+def update_osm(
+    extract_path=EXTRACT_PATH,
+    diff_dir=DIFF_DIR,
+    features_path=FEATURES_PATH,
+    way_nodes_path=WAY_NODES_PATH,
+    force=False,
+    manifest_path=MANIFEST_PATH,
+):
+    """
+    Update the cultural features from an extract and the diffs applied since.
+
+    The extract is only read again when it changed; diff files (.osc,
+    .osc.gz) are then applied in name order, each one once.
+
+    Args:
+        extract_path (str): OSM extract
+        diff_dir (str): Directory of the diff files
+        features_path (str): Output table of the features
+        way_nodes_path (str): Output table of the coordinates of the way nodes
+        force (bool): Read the extract again even if unchanged
+        manifest_path (str): Path of the data manifest
+
+    Returns:
+        dict: Number of "features", whether the extract was "read" and the
+            "diffs" applied so far
+    """
+    manifest = load_manifest(manifest_path)
+    outputs = [features_path, way_nodes_path]
+    signature = step_signature(manifest, [extract_path], code=[__file__], manifest_path=manifest_path)
+    read = force or not is_up_to_date(manifest, STEP, signature, outputs, manifest_path=manifest_path)
+    if read:
+        print(f"Reading {extract_path}...")
+        features, way_nodes = read_extract(extract_path)
+        applied = []
+    else:
+        features = read_table(features_path)
+        way_nodes = read_table(way_nodes_path)
+        applied = list(manifest["steps"][STEP]["stats"]["diffs"])
+
+    diffs = sorted(glob.glob(os.path.join(diff_dir, "*.osc")) + glob.glob(os.path.join(diff_dir, "*.osc.gz")))
+    for path in diffs:
+        digest = file_digest(path, manifest, manifest_path)
+        if digest in applied:
+            continue
+        print(f"Applying {path}...")
+        features, way_nodes = apply_diff(features, way_nodes, path)
+        applied.append(digest)
+
+    if read or applied != manifest["steps"][STEP]["stats"]["diffs"]:
+        write_table(features, features_path, FEATURE_SCHEMA)
+        write_table(way_nodes, way_nodes_path, WAY_NODES_SCHEMA)
+        stats = {"features": len(features), "diffs": applied}
+        record_step(manifest, STEP, signature, outputs, stats=stats, manifest_path=manifest_path)
+    save_manifest(manifest, manifest_path)
+    return {"features": len(features), "read": read, "diffs": applied}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest the cultural features of an OSM extract and its diffs.")
+    parser.add_argument("--extract", default=EXTRACT_PATH)
+    parser.add_argument("--diff-dir", default=DIFF_DIR)
+    parser.add_argument("--force", action="store_true", help="Read the extract again even if unchanged")
+    args = parser.parse_args()
+    stats = update_osm(args.extract, args.diff_dir, force=args.force)
+    print(f"{stats['features']} cultural features, {len(stats['diffs'])} diffs applied")
@@ -1,70 +1,202 @@
-"""Script to prepare and save the cultural data in CSV format."""
+"""Script to prepare and save the cultural data in Parquet format.
 
+The equipments are transformed per department partition, recorded in the
+data manifest: a rerun skips the step when its inputs and code did not
+change, and otherwise only recomputes the departments whose rows changed
+or which hold a commune whose cultural density changed.
+
+With a chunk size, the inputs are streamed in two passes, so that memory
+use depends on the chunk size and the number of communes but not on the
+number of equipments: the commune aggregates are accumulated first, then
+the equipments are transformed and appended to their partition.
+
+The cultural points of interest ingested from OpenStreetMap (see
+cultural_map.data.osm), when present, are added to the equipments in the
+commune with the nearest center, unless an equipment of the same type
+already stands next to them.
+"""
+
+import argparse
+import contextlib
+import glob
+import os
+
+import numpy as np
 import pandas as pd
 
+from . import columnar, communes, osm, spatial_index
+from ..config.settings import PREPARE_CONFIG
+from .columnar import (
+    COMMUNE_SCHEMA,
+    CULTURAL_SCHEMA,
+    HEATMAP_SCHEMA,
+    TableWriter,
+    read_table,
+    write_table,
+)
+from .communes import (
+    MISSING_KEY,
+    department_codes,
+    insee_codes,
+    insee_keys,
+    nearest_communes,
+    normalize_insee_codes,
+)
+from .manifest import (
+    changed_partitions,
+    hexdigests,
+    is_up_to_date,
+    load_manifest,
+    previous_partitions,
+    record_step,
+    save_manifest,
+    step_signature,
+    update_partition_hashes,
+)
 
-def transform_data():
-    """Transform the CSV data and save as CSV."""
-    # Load the CSV files
-    print("Loading CSV files...")
-    equipements = pd.read_csv(
-        "data/results/Equipements_Communes.csv",
-        sep=";",  # Semicolon separated
-        encoding="utf-8",
-        dtype={
-            "Nom_commune": str,
-            "Code_insee": str,
-            "Type": str,
-            "Nom_equipement": str,
-            "Population_totale": float,
-            "Commune_latitude": float,
-            "Commune_longitude": float,
-            "Equipement_latitude": float,
-            "Equipement_longitude": float,
-            "Categorie": str,
-        },
-    )
+EQUIPMENTS_PATH = "data/results/Equipements_Communes.csv"
+HEATMAP_SOURCE_PATH = "data/results/Heatmap_Culture.csv"
+CULTURAL_OUTPUT_PATH = "data/cultural_data.parquet"
+HEATMAP_OUTPUT_PATH = "data/heatmap_data.parquet"
 
-    heatmap = pd.read_csv(
-        "data/results/Heatmap_Culture.csv",
-        sep="\t",  # Tab separated
-        encoding="utf-8",
-        dtype={
-            "Commune": str,
-            "code_insee": str,
-            "Type_equipement": str,
-            "Population_Totale": float,
-            "latitude": float,
-            "longitude": float,
-            "Nombre_categorie": int,
-            "categorie": str,
-        },
+# Columns read from the inputs, with their dtypes
+EQUIPMENT_COLUMNS = {
+    "Nom_commune": str,
+    "Code_insee": str,
+    "Type": str,
+    "Nom_equipement": str,
+    "Population_totale": float,
+    "Equipement_latitude": float,
+    "Equipement_longitude": float,
+    "Categorie": str,
+}
+HEATMAP_COLUMNS = {
+    "Commune": str,
+    "code_insee": str,
+    "Region": str,
+    "Population_Totale": float,
+    "latitude": float,
+    "longitude": float,
+    "Nombre_categorie": int,
+}
+
+# Optional list of the Petites Villes de Demain communes, and its INSEE code column
+PVD_PATH = "data/programme-petites-villes-de-demain-liste-des-villes-beneficiaires.csv"
+PVD_CODE_COLUMNS = ("insee_com", "code_insee", "INSEE_COM", "codgeo")
+
+# Optional cultural points of interest from OpenStreetMap
+OSM_EQUIPMENTS_PATH = osm.FEATURES_PATH
+
+# Commune dimension, keyed by communes.insee_keys
+COMMUNES_PATH = "data/communes.parquet"
+
+# Intermediate results kept between runs
+PARTITION_DIR = "data/partitions/cultural_data"
+
+STEP = "transform_data"
+
+
+def read_pvd_keys(path=PVD_PATH):
+    """
+    Read the keys of the communes of the Petites Villes de Demain programme.
+
+    Returns:
+        np.ndarray: Commune keys, empty if the list is missing
+    """
+    if not os.path.exists(path):
+        return np.array([], dtype="int32")
+    pvd = pd.read_csv(path, sep=None, engine="python", dtype=str)
+    column = next((column for column in PVD_CODE_COLUMNS if column in pvd), None)
+    if column is None:
+        print(f"Warning: no INSEE code column in {path}, PVD membership left empty")
+        return np.array([], dtype="int32")
+    keys = insee_keys(pvd[column])
+    return keys[keys != MISSING_KEY]
+
+
+def aggregate_communes(heatmap, totals=None):
+    """
+    Aggregate Heatmap_Culture rows per commune, keyed by INSEE code.
+
+    Rows without a valid INSEE code are left out.
+
+    Args:
+        heatmap (pd.DataFrame): Heatmap_Culture rows, one per commune and
+            category, or a chunk of them
+        totals (pd.DataFrame): Aggregates of the previous chunks to fold
+            the rows into
+
+    Returns:
+        pd.DataFrame: Total cultural structures and first name, region,
+            population and coordinates per commune, indexed by commune key
+    """
+    keys = pd.Series(insee_keys(heatmap["code_insee"]), index=heatmap.index, name="commune_key")
+    aggregates = heatmap[keys != MISSING_KEY].groupby(keys[keys != MISSING_KEY]).agg(
+        {
+            "Commune": "first",
+            "Region": "first",
+            "Nombre_categorie": "sum",  # Total cultural structures
+            "Population_Totale": "first",  # Population
+            "latitude": "first",  # Coordinates
+            "longitude": "first",
+        }
     )
+    if totals is None:
+        return aggregates
+    # Values of earlier chunks come first; structures add up
+    combined = totals.combine_first(aggregates)
+    combined["Nombre_categorie"] = totals["Nombre_categorie"].add(
+        aggregates["Nombre_categorie"], fill_value=0
+    )
+    return combined
 
-    print("Transforming data...")
 
-    # Calculate cultural density per commune from heatmap data
-    commune_stats = (
-        heatmap.groupby("Commune")
-        .agg(
-            {
-                "Nombre_categorie": "sum",  # Total cultural structures
-                "Population_Totale": "first",  # Population
-                "latitude": "first",  # Coordinates
-                "longitude": "first",
-            }
-        )
-        .reset_index()
+def build_commune_dimension(aggregates, pvd_keys=()):
+    """
+    Build the commune dimension table.
+
+    Args:
+        aggregates (pd.DataFrame): Commune aggregates from aggregate_communes
+        pvd_keys (array-like): Keys of the Petites Villes de Demain communes
+
+    Returns:
+        pd.DataFrame: One row per commune with the columns of COMMUNE_SCHEMA
+    """
+    communes = aggregates.reset_index()
+    codes = insee_codes(communes["commune_key"])
+    return pd.DataFrame(
+        {
+            "commune_key": communes["commune_key"].astype("int32"),
+            "code_insee": codes,
+            "nom_commune": communes["Commune"],
+            "departement": department_codes(codes),
+            "region": communes["Region"],
+            "population": communes["Population_Totale"],
+            "latitude": communes["latitude"],
+            "longitude": communes["longitude"],
+            "pvd": communes["commune_key"].isin(pvd_keys),
+            "nombre_structures": communes["Nombre_categorie"],
+            # Calculate cultural density (structures per 1000 inhabitants)
+            "cultural_density": (communes["Nombre_categorie"] * 1000) / communes["Population_Totale"],
+        }
     )
 
-    # Calculate cultural density (structures per 1000 inhabitants)
-    commune_stats["cultural_density"] = (commune_stats["Nombre_categorie"] * 1000) / commune_stats[
-        "Population_Totale"
-    ]
 
+def transform_equipments(equipements, communes):
+    """
+    Build the cultural data rows of some equipments.
+
+    Args:
+        equipements (pd.DataFrame): Equipements_Communes rows
+        communes (pd.DataFrame): Commune dimension from build_commune_dimension
+
+    Returns:
+        pd.DataFrame: Rows with the columns of CULTURAL_SCHEMA
+    """
     # Create main DataFrame with required structure from equipements data
     transformed_data = pd.DataFrame(
         {
+            "commune_key": insee_keys(equipements["Code_insee"]),
             "nom_commune": equipements["Nom_commune"].astype(str),
             "code_postal": equipements["Code_insee"].astype(str),
             "type_infrastructure": equipements["Type"].astype(str),
@@ -73,16 +205,13 @@ def transform_data():
             "longitude": pd.to_numeric(equipements["Equipement_longitude"], errors="coerce"),
             "population": pd.to_numeric(equipements["Population_totale"], errors="coerce"),
             "categorie": equipements["Categorie"].astype(str),
-        }
+        },
+        index=equipements.index,
     )
 
-    # Merge cultural density data
-    transformed_data = transformed_data.merge(
-        commune_stats[["Commune", "cultural_density"]],
-        left_on="nom_commune",
-        right_on="Commune",
-        how="left"
-    ).drop("Commune", axis=1)
+    # Add the cultural density of each commune by its integer key
+    densities = communes.set_index("commune_key")["cultural_density"]
+    transformed_data["cultural_density"] = transformed_data["commune_key"].map(densities)
 
     # Drop rows with missing coordinates
     transformed_data = transformed_data.dropna(subset=["latitude", "longitude"])
@@ -90,19 +219,319 @@ def transform_data():
     # Fill any remaining NaN values
     transformed_data["population"] = transformed_data["population"].fillna(0)
     transformed_data["cultural_density"] = transformed_data["cultural_density"].fillna(0)
+    return transformed_data
+
+
+def osm_equipments(communes, path=OSM_EQUIPMENTS_PATH):
+    """
+    Shape the OpenStreetMap cultural features as Equipements_Communes rows.
+
+    Each feature is placed in the commune with the nearest center, features
+    farther than PREPARE_CONFIG["OSM_MAX_DISTANCE"] degrees from any center
+    are dropped. See drop_known_equipments for the features also present
+    in Equipements_Communes.
+
+    Args:
+        communes (pd.DataFrame): Commune dimension from build_commune_dimension
+        path (str): Features written by cultural_map.data.osm
+
+    Returns:
+        pd.DataFrame: Equipment rows, None if there are no features
+    """
+    if not os.path.exists(path):
+        return None
+    features = read_table(path)
+    keys = nearest_communes(
+        features["latitude"], features["longitude"], communes, PREPARE_CONFIG["OSM_MAX_DISTANCE"]
+    )
+    placed = keys != MISSING_KEY
+    if not placed.all():
+        print(f"Warning: {np.count_nonzero(~placed)} OpenStreetMap features outside of any commune")
+    features = features[placed]
+    dimension = communes.set_index("commune_key").loc[keys[placed]]
+    return pd.DataFrame(
+        {
+            "Nom_commune": dimension["nom_commune"].to_numpy(),
+            "Code_insee": dimension["code_insee"].to_numpy(),
+            "Type": features["type_infrastructure"].astype(str).to_numpy(),
+            "Nom_equipement": features["nom_infrastructure"].to_numpy(),
+            "Population_totale": dimension["population"].to_numpy(dtype="float64"),
+            "Equipement_latitude": features["latitude"].to_numpy(),
+            "Equipement_longitude": features["longitude"].to_numpy(),
+            "Categorie": features["categorie"].astype(str).to_numpy(),
+        }
+    )
+
+
+def drop_known_equipments(features, chunks, radius_km=PREPARE_CONFIG["OSM_DUPLICATE_DISTANCE_KM"]):
+    """
+    Drop the OpenStreetMap features already among the equipments.
+
+    A feature is a duplicate when an equipment of the same type stands
+    within `radius_km` of it. The features of each type are indexed and the
+    equipments are streamed against them, so the equipments are never all
+    held in memory.
+
+    Args:
+        features (pd.DataFrame): Equipment rows from osm_equipments
+        chunks (iterable): Equipements_Communes chunks, with the Type and
+            coordinate columns
+        radius_km (float): Distance under which a feature is a duplicate
+
+    Returns:
+        pd.DataFrame: The features without such an equipment
+    """
+    types = features["Type"].to_numpy()
+    indexes = {}
+    for name in np.unique(types):
+        positions = np.flatnonzero(types == name)
+        indexes[name] = positions, spatial_index.GridIndex(
+            features["Equipement_latitude"].to_numpy()[positions],
+            features["Equipement_longitude"].to_numpy()[positions],
+        )
+    known = np.zeros(len(features), dtype=bool)
+    for chunk in chunks:
+        chunk_types = chunk["Type"].astype(str).to_numpy()
+        latitude = pd.to_numeric(chunk["Equipement_latitude"], errors="coerce").to_numpy(dtype="float64")
+        longitude = pd.to_numeric(chunk["Equipement_longitude"], errors="coerce").to_numpy(dtype="float64")
+        for name, (positions, index) in indexes.items():
+            rows = chunk_types == name
+            if rows.any():
+                _, found, _ = index.query_radius_batch(latitude[rows], longitude[rows], radius_km, sort=False)
+                known[positions[found]] = True
+    print(f"{np.count_nonzero(known)} of {len(features)} OpenStreetMap features already among the equipments")
+    return features[~known].reset_index(drop=True)
+
+
+def changed_communes(previous_communes, communes):
+    """Get the keys of the communes whose cultural density was added, removed or modified."""
+    merged = previous_communes[["commune_key", "cultural_density"]].merge(
+        communes[["commune_key", "cultural_density"]], on="commune_key", how="outer"
+    )
+    before, after = merged["cultural_density_x"], merged["cultural_density_y"]
+    # A missing density and a missing commune both give a density of 0
+    same = (before == after) | (before.isna() & after.isna())
+    return set(merged["commune_key"][~same].tolist())
+
+
+def join_report(keys, communes):
+    """
+    Count the equipments matched by the commune dimension.
+
+    Args:
+        keys (pd.Series): Commune key of each equipment
+        communes (pd.DataFrame): Commune dimension
+
+    Returns:
+        dict: Number of "matched" equipments, of equipments "without_key"
+            (no valid INSEE code) and of "unmatched" ones (a code missing
+            from the dimension)
+    """
+    known = keys.isin(communes["commune_key"])
+    without_key = keys == MISSING_KEY
+    return {
+        "matched": int(known.sum()),
+        "without_key": int(without_key.sum()),
+        "unmatched": int((~known & ~without_key).sum()),
+    }
+
+
+def _partition_path(department):
+    return os.path.join(PARTITION_DIR, f"{department or '_'}.parquet")
+
+
+def _departments(codes):
+    return department_codes(normalize_insee_codes(codes)).fillna("")
+
+
+def read_chunks(path, chunk_rows=None, **options):
+    """Read a CSV file by chunks of rows, or as a single chunk if chunk_rows is None."""
+    if chunk_rows is None:
+        yield pd.read_csv(path, **options)
+    else:
+        yield from pd.read_csv(path, chunksize=chunk_rows, **options)
+
+
+def write_partitions(chunks, communes, departments=None, hashers=None, buffer_rows=None):
+    """
+    Transform equipment chunks and write each department to its partition.
+
+    Transformed rows are buffered per department and the largest buffers
+    written once more than `buffer_rows` rows are waiting, so partitions
+    get large row groups whatever the chunk size.
+
+    Args:
+        chunks (iterable): Equipements_Communes chunks
+        communes (pd.DataFrame): Commune dimension from build_commune_dimension
+        departments (set): Departments to write, all if None; those without
+            equipments left have their partition removed
+        hashers (dict): Running partition hashes to feed the chunks to
+        buffer_rows (int): Maximum number of buffered rows, unbounded if None
+    """
+    with contextlib.ExitStack() as stack:
+        writers, buffers, buffered = {}, {}, {}
+
+        def flush(department):
+            frames = buffers.pop(department)
+            buffered.pop(department)
+            writers[department].write(frames[0] if len(frames) == 1 else pd.concat(frames))
+
+        for chunk in chunks:
+            keys = _departments(chunk["Code_insee"])
+            if hashers is not None:
+                update_partition_hashes(hashers, chunk, keys)
+            if departments is not None:
+                selected = keys.isin(departments)
+                chunk, keys = chunk[selected], keys[selected]
+            for department in keys.unique():
+                if department not in writers:
+                    writers[department] = stack.enter_context(
+                        TableWriter(_partition_path(department), CULTURAL_SCHEMA)
+                    )
+            transformed = transform_equipments(chunk, communes)
+            for department, rows in transformed.groupby(keys[transformed.index], sort=False):
+                buffers.setdefault(department, []).append(rows)
+                buffered[department] = buffered.get(department, 0) + len(rows)
+            while buffer_rows is not None and sum(buffered.values()) > buffer_rows:
+                flush(max(buffered, key=buffered.get))
+        for department in list(buffers):
+            flush(department)
+    for department in departments or ():
+        if department not in writers and os.path.exists(_partition_path(department)):
+            os.remove(_partition_path(department))
+
+
+def transform_data(force=False, chunk_rows=PREPARE_CONFIG["CHUNK_ROWS"]):
+    """
+    Transform the CSV data and save it as typed Parquet tables.
+
+    Args:
+        force (bool): Recompute every partition, even if up to date
+        chunk_rows (int): Rows read at once, None to read the inputs whole
+    """
+    manifest = load_manifest()
+    outputs = [CULTURAL_OUTPUT_PATH, HEATMAP_OUTPUT_PATH, COMMUNES_PATH]
+    signature = step_signature(
+        manifest,
+        [EQUIPMENTS_PATH, HEATMAP_SOURCE_PATH, PVD_PATH, OSM_EQUIPMENTS_PATH],
+        params={
+            "osm_max_distance": PREPARE_CONFIG["OSM_MAX_DISTANCE"],
+            "osm_duplicate_distance_km": PREPARE_CONFIG["OSM_DUPLICATE_DISTANCE_KM"],
+        },
+        code=[__file__, columnar.__file__, communes.__file__, spatial_index.__file__],
+    )
+    if not force and is_up_to_date(manifest, STEP, signature, outputs):
+        save_manifest(manifest)
+        print("Data is up to date, nothing to transform.")
+        return
+
+    equipment_options = {
+        "sep": ";",  # Semicolon separated
+        "encoding": "utf-8",
+        "usecols": list(EQUIPMENT_COLUMNS),
+        "dtype": EQUIPMENT_COLUMNS,
+    }
+    heatmap_options = {
+        "sep": "\t",  # Tab separated
+        "encoding": "utf-8",
+        "usecols": list(HEATMAP_COLUMNS),
+        "dtype": HEATMAP_COLUMNS,
+    }
+
+    # First pass: commune aggregates
+    print("Aggregating communes...")
+    aggregates = None
+    heatmap_hashes = {}
+    unkeyed = 0
+    for chunk in read_chunks(HEATMAP_SOURCE_PATH, chunk_rows, **heatmap_options):
+        aggregates = aggregate_communes(chunk, aggregates)
+        unkeyed += np.count_nonzero(insee_keys(chunk["code_insee"]) == MISSING_KEY)
+        update_partition_hashes(heatmap_hashes, chunk, _departments(chunk["code_insee"]))
+    commune_dimension = build_commune_dimension(aggregates, read_pvd_keys())
+    osm_rows = osm_equipments(commune_dimension)
+    if osm_rows is not None:
+        location_options = dict(equipment_options, usecols=["Type", "Equipement_latitude", "Equipement_longitude"])
+        osm_rows = drop_known_equipments(osm_rows, read_chunks(EQUIPMENTS_PATH, chunk_rows, **location_options))
+
+    def equipment_chunks():
+        yield from read_chunks(EQUIPMENTS_PATH, chunk_rows, **equipment_options)
+        if osm_rows is not None:
+            yield osm_rows
+
+    # Second pass: equipments
+    print("Transforming data...")
+    previous = None if force else previous_partitions(manifest, STEP, signature)
+    equipment_hashes = {}
+    if previous is None or not os.path.exists(COMMUNES_PATH):
+        for path in glob.glob(os.path.join(PARTITION_DIR, "*.parquet")):
+            os.remove(path)
+        write_partitions(
+            equipment_chunks(),
+            commune_dimension,
+            hashers=equipment_hashes,
+            buffer_rows=chunk_rows,
+        )
+        print(f"Recomputed all {len(equipment_hashes)} department partitions")
+    else:
+        changed_keys = set()
+        if changed_partitions(previous.get("heatmap"), hexdigests(heatmap_hashes)):
+            previous_communes = read_table(COMMUNES_PATH, schema=COMMUNE_SCHEMA)
+            changed_keys = changed_communes(previous_communes, commune_dimension)
+
+        # Find the departments to recompute, keeping the equipments if read whole
+        departments = set()
+        kept = [] if chunk_rows is None else None
+        for chunk in equipment_chunks():
+            keys = _departments(chunk["Code_insee"])
+            update_partition_hashes(equipment_hashes, chunk, keys)
+            affected = np.isin(insee_keys(chunk["Code_insee"]), list(changed_keys))
+            departments |= set(keys[affected])
+            if kept is not None:
+                kept.append(chunk)
+        departments |= changed_partitions(previous.get("equipements"), hexdigests(equipment_hashes))
+        departments |= {
+            department
+            for department in equipment_hashes
+            if not os.path.exists(_partition_path(department))
+        }
+
+        print(f"Recomputing {len(departments)} of {len(equipment_hashes)} department partitions...")
+        if departments:
+            chunks = kept if kept is not None else equipment_chunks()
+            write_partitions(chunks, commune_dimension, departments, buffer_rows=chunk_rows)
+
+    print("Saving Parquet files...")
+    with TableWriter(CULTURAL_OUTPUT_PATH, CULTURAL_SCHEMA) as output:
+        for department in sorted(equipment_hashes):
+            output.append_file(_partition_path(department), chunk_rows)
 
     # Create a separate DataFrame for heatmap data
-    heatmap_data = commune_stats[["latitude", "longitude", "cultural_density"]].copy()
+    heatmap_data = commune_dimension[["latitude", "longitude", "cultural_density"]].copy()
     heatmap_data = heatmap_data.dropna(
         subset=["latitude", "longitude", "cultural_density"]
     )
-
-    print("Saving CSV files...")
-    # Save both DataFrames as CSV
-    transformed_data.to_csv("data/cultural_data.csv", index=False, encoding="utf-8")
-    heatmap_data.to_csv("data/heatmap_data.csv", index=False, encoding="utf-8")
-    print("Done! Data saved to data/cultural_data.csv and data/heatmap_data.csv")
+    write_table(heatmap_data, HEATMAP_OUTPUT_PATH, HEATMAP_SCHEMA)
+    write_table(commune_dimension, COMMUNES_PATH, COMMUNE_SCHEMA)
+    stats = join_report(read_table(CULTURAL_OUTPUT_PATH, ["commune_key"])["commune_key"], commune_dimension)
+    stats["heatmap_rows_without_key"] = int(unkeyed)
+    print(
+        f"{stats['matched']} equipments joined to {len(commune_dimension)} communes, "
+        f"{stats['without_key']} without INSEE code, {stats['unmatched']} with an unknown one"
+    )
+    partitions = {"equipements": hexdigests(equipment_hashes), "heatmap": hexdigests(heatmap_hashes)}
+    record_step(manifest, STEP, signature, outputs, partitions, stats=stats)
+    save_manifest(manifest)
+    print(f"Done! Data saved to {CULTURAL_OUTPUT_PATH} and {HEATMAP_OUTPUT_PATH}")
 
 
 if __name__ == "__main__":
-    transform_data()
+    parser = argparse.ArgumentParser(description="Prepare the cultural data.")
+    parser.add_argument("--force", action="store_true", help="Recompute every partition")
+    parser.add_argument(
+        "--chunk-rows",
+        type=int,
+        default=PREPARE_CONFIG["CHUNK_ROWS"],
+        help="Stream the inputs by chunks of this many rows",
+    )
+    args = parser.parse_args()
+    transform_data(force=args.force, chunk_rows=args.chunk_rows)
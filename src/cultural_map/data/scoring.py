@@ -0,0 +1,145 @@
+"""Cultural score of the communes, for any set of parameters.
+
+The score of a commune is its weighted number of cultural elements per N
+inhabitants, capped at a threshold. The number of elements of each
+(category, type) pair is counted per commune once; scores for any number
+of parameter sets are then a matrix product over all communes, without
+grouping the rows again.
+"""
+
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+
+from .communes import MISSING_KEY, insee_keys, normalize_area_codes, normalize_insee_codes
+
+# Commune attributes of Heatmap_Culture, kept from the first row of each commune
+COMMUNE_COLUMNS = [
+    "code_insee",
+    "Commune",
+    "Region",
+    "latitude",
+    "longitude",
+    "Population_Totale",
+    "Num_Region",
+    "Num_Dep",
+]
+
+
+class ScoreParameters(NamedTuple):
+    """
+    Parameters of the cultural score.
+
+    Weights are given as (name, weight) pairs, so that parameters stay
+    hashable and can key caches; a dict is accepted too. Weights missing
+    from `category_weights` and `type_weights` are 1; the weight of an
+    element is the product of those of its category and type.
+    """
+
+    per_inhabitants: float = 1000
+    threshold: float = 10
+    category_weights: tuple = ()
+    type_weights: tuple = ()
+
+
+class ScoreEngine:
+    """
+    Per-commune sufficient statistics of the cultural score.
+
+    Args:
+        synthese (pd.DataFrame): Rows of Heatmap_Culture.csv, with the
+            COMMUNE_COLUMNS and Nombre_categorie, categorie and
+            Type_equipement columns
+    """
+
+    def __init__(self, synthese):
+        keys = insee_keys(synthese["code_insee"])
+        rows = np.flatnonzero(keys != MISSING_KEY)
+        commune_ids, commune_keys = pd.factorize(keys[rows], sort=True)
+        category_ids, categories = pd.factorize(synthese["categorie"].astype(str).to_numpy()[rows], sort=True)
+        type_ids, types = pd.factorize(synthese["Type_equipement"].astype(str).to_numpy()[rows], sort=True)
+        group_ids, pairs = pd.factorize(category_ids * len(types) + type_ids, sort=True)
+        groups = pd.DataFrame(
+            {"categorie": categories[pairs // len(types)], "Type_equipement": types[pairs % len(types)]}
+        )
+        # One bincount over the (commune, group) cells
+        counts = np.bincount(
+            commune_ids * len(groups) + group_ids,
+            weights=synthese["Nombre_categorie"].to_numpy(dtype="float64")[rows],
+            minlength=len(commune_keys) * len(groups),
+        )
+        first = np.unique(commune_ids, return_index=True)[1]
+        self.communes = synthese.iloc[rows[first]][COMMUNE_COLUMNS].reset_index(drop=True)
+        self.communes.insert(0, "commune_key", commune_keys.astype("int32"))
+        self.communes["code_insee"] = normalize_insee_codes(self.communes["code_insee"])
+        # Department codes include "2A" and "2B", so codes are kept as labels
+        self.communes["Num_Dep"] = normalize_area_codes(self.communes["Num_Dep"])
+        self.communes["Num_Region"] = normalize_area_codes(self.communes["Num_Region"])
+        self.groups = groups
+        self.counts = counts.reshape(len(commune_keys), len(groups))
+        population = self.communes["Population_Totale"].to_numpy(dtype="float64")
+        # No score without inhabitants
+        self.population = np.where(population > 0, population, np.nan)
+
+    def weights(self, parameters):
+        """Get the weight of each (category, type) group for a parameter set."""
+        category_weights = dict(parameters.category_weights or ())
+        type_weights = dict(parameters.type_weights or ())
+        return np.array(
+            [
+                category_weights.get(category, 1) * type_weights.get(kind, 1)
+                for category, kind in zip(self.groups["categorie"], self.groups["Type_equipement"])
+            ],
+            dtype="float64",
+        )
+
+    def totals(self, parameters_list):
+        """
+        Weighted number of elements of the communes.
+
+        Returns:
+            np.ndarray: One row per commune, one column per parameter set
+        """
+        weights = np.column_stack([self.weights(parameters) for parameters in parameters_list])
+        return self.counts @ weights
+
+    def evaluate(self, parameters_list):
+        """
+        Score the communes for several parameter sets at once.
+
+        Args:
+            parameters_list (list): ScoreParameters to evaluate
+
+        Returns:
+            np.ndarray: Scores, one row per commune and one column per
+                parameter set, NaN for communes without inhabitants
+        """
+        per_inhabitants = np.array([parameters.per_inhabitants for parameters in parameters_list])
+        thresholds = np.array([parameters.threshold for parameters in parameters_list])
+        scores = self.totals(parameters_list) / self.population[:, None] * per_inhabitants
+        return np.minimum(scores, thresholds)
+
+    def score(self, parameters=ScoreParameters()):
+        """Score the communes for one parameter set."""
+        return self.evaluate([parameters])[:, 0]
+
+    def score_table(self, parameters=ScoreParameters()):
+        """
+        Score table of the communes, as written to Heatmap_Culture_with_score.
+
+        Communes without inhabitants or with a missing attribute are left out.
+
+        Returns:
+            pd.DataFrame: Commune attributes, nbr_total_culturel, the uncapped
+                Nbre_culturels_N_habitants and the capped score, named
+                "Nbre culturels pour<N> habitants"
+        """
+        total = self.totals([parameters])[:, 0]
+        table = self.communes.copy()
+        table["nbr_total_culturel"] = total
+        table["Nbre_culturels_N_habitants"] = total / self.population * parameters.per_inhabitants
+        table[f"Nbre culturels pour{parameters.per_inhabitants} habitants"] = np.minimum(
+            table["Nbre_culturels_N_habitants"], parameters.threshold
+        )
+        return table.dropna().reset_index(drop=True)
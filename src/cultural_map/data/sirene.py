@@ -0,0 +1,233 @@
+"""Cultural establishments of the Sirene register, counted per commune.
+
+The StockEtablissement file (CSV, or the zip it is published in) is read
+by blocks of lines, each parsed by a worker process reading only the
+needed columns. Active establishments with a cultural NAF code are counted
+per commune and activity, and the counts of the blocks summed, so memory
+depends on the block size and the number of workers, not on the file size.
+
+The result holds one row per commune, keyed like cultural_data by
+communes.insee_keys; municipal arrondissements are counted in their
+commune.
+"""
+
+import argparse
+import io
+import os
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+import pandas as pd
+
+from .columnar import write_table
+from .communes import MISSING_KEY, insee_codes, insee_keys
+from .manifest import (
+    MANIFEST_PATH,
+    is_up_to_date,
+    load_manifest,
+    record_step,
+    save_manifest,
+    step_signature,
+)
+
+SIRENE_PATH = "data/StockEtablissement_utf8.zip"
+OUTPUT_PATH = "data/sirene_communes.parquet"
+
+STEP = "sirene"
+
+# Columns read from StockEtablissement
+COMMUNE_COLUMN = "codeCommuneEtablissement"
+STATUS_COLUMN = "etatAdministratifEtablissement"
+ACTIVITY_COLUMN = "activitePrincipaleEtablissement"
+NOMENCLATURE_COLUMN = "nomenclatureActivitePrincipaleEtablissement"
+SIRENE_COLUMNS = [COMMUNE_COLUMN, STATUS_COLUMN, ACTIVITY_COLUMN, NOMENCLATURE_COLUMN]
+
+# Cultural NAF rév. 2 codes, and the column counting them
+CULTURAL_NAF_CODES = {
+    "47.61Z": "nombre_librairies",
+    "47.63Z": "nombre_disquaires",
+    "59.14Z": "nombre_cinemas",
+    "85.52Z": "nombre_enseignement_culturel",
+    "90.01Z": "nombre_arts_du_spectacle",
+    "90.02Z": "nombre_arts_du_spectacle",
+    "90.03A": "nombre_creation_artistique",
+    "90.03B": "nombre_creation_artistique",
+    "90.04Z": "nombre_salles_de_spectacle",
+    "91.01Z": "nombre_bibliotheques_archives",
+    "91.02Z": "nombre_musees",
+    "91.03Z": "nombre_patrimoine",
+}
+COUNT_COLUMNS = list(dict.fromkeys(CULTURAL_NAF_CODES.values()))
+
+SIRENE_SCHEMA = {
+    "commune_key": "int32",
+    "code_insee": "object",
+    "etablissements_culturels": "int32",
+    **{column: "int32" for column in COUNT_COLUMNS},
+}
+
+# Municipal arrondissements (first, last) and the key of their commune
+ARRONDISSEMENTS = {(75101, 75120): 75056, (69381, 69389): 69123, (13201, 13216): 13055}
+
+
+def _open(path):
+    """Open a CSV file, or the first file of a zip archive, as a binary stream."""
+    if not path.endswith(".zip"):
+        return open(path, "rb")
+    archive = zipfile.ZipFile(path)
+    return archive.open(archive.namelist()[0])
+
+
+def read_blocks(f, block_bytes):
+    """
+    Read a file by blocks of whole lines.
+
+    Args:
+        f (file): Binary file, positioned after the header
+        block_bytes (int): Approximate size of the blocks
+
+    Yields:
+        bytes: Consecutive blocks, each ending with a line end
+    """
+    rest = b""
+    while True:
+        data = f.read(block_bytes)
+        if not data:
+            break
+        data = rest + data
+        cut = data.rfind(b"\n") + 1
+        rest = data[cut:]
+        if cut:
+            yield data[:cut]
+    if rest:
+        yield rest
+
+
+def commune_keys(codes):
+    """Key the commune codes of Sirene, municipal arrondissements becoming their commune."""
+    keys = insee_keys(codes)
+    for (first, last), commune in ARRONDISSEMENTS.items():
+        keys[(keys >= first) & (keys <= last)] = commune
+    return keys
+
+
+def count_block(block, header):
+    """
+    Count the active cultural establishments of a block of lines.
+
+    Args:
+        block (bytes): Lines of StockEtablissement
+        header (list): Column names of the file
+
+    Returns:
+        pd.Series: Number of establishments per (commune_key, count column)
+    """
+    chunk = pd.read_csv(
+        io.BytesIO(block), header=None, names=header, usecols=SIRENE_COLUMNS, dtype=str
+    )
+    chunk = chunk[
+        (chunk[STATUS_COLUMN] == "A")
+        & (chunk[NOMENCLATURE_COLUMN] == "NAFRev2")
+        & chunk[ACTIVITY_COLUMN].isin(list(CULTURAL_NAF_CODES))
+    ]
+    keys = commune_keys(chunk[COMMUNE_COLUMN])
+    columns = chunk[ACTIVITY_COLUMN].map(CULTURAL_NAF_CODES).to_numpy()
+    kept = keys != MISSING_KEY
+    index = pd.MultiIndex.from_arrays([keys[kept], columns[kept]])
+    return pd.Series(1, index=index).groupby(level=[0, 1]).sum()
+
+
+def count_establishments(path, jobs=None, block_bytes=32 << 20):
+    """
+    Count the active cultural establishments per commune, in parallel.
+
+    At most two blocks per worker are in flight, which bounds memory.
+
+    Args:
+        path (str): StockEtablissement CSV file, or zip archive
+        jobs (int): Number of worker processes, defaults to the CPU count
+        block_bytes (int): Approximate size of the blocks
+
+    Returns:
+        tuple: (pd.DataFrame with the columns of SIRENE_SCHEMA, number of
+            lines read)
+    """
+    jobs = jobs or os.cpu_count()
+    counts = []
+    lines = 0
+    with _open(path) as f, ProcessPoolExecutor(jobs) as pool:
+        header = f.readline().decode("utf-8").strip().split(",")
+        header = [name.strip('"') for name in header]
+        pending = set()
+        for block in read_blocks(f, block_bytes):
+            lines += block.count(b"\n") + (not block.endswith(b"\n"))
+            if len(pending) >= 2 * jobs:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                counts += [future.result() for future in done]
+            pending.add(pool.submit(count_block, block, header))
+            # Sum the counts so far, which are small, as the blocks complete
+            if len(counts) > 64:
+                counts = [pd.concat(counts).groupby(level=[0, 1]).sum()]
+        counts += [future.result() for future in pending]
+
+    totals = pd.concat(counts).groupby(level=[0, 1]).sum() if counts else pd.Series(dtype="int64")
+    table = totals.unstack(fill_value=0).reindex(columns=COUNT_COLUMNS, fill_value=0)
+    table = table.rename_axis("commune_key").reset_index()
+    table["code_insee"] = insee_codes(table["commune_key"]).astype(object)
+    table["etablissements_culturels"] = table[COUNT_COLUMNS].sum(axis=1)
+    return table[list(SIRENE_SCHEMA)].astype(SIRENE_SCHEMA), lines
+
+
+def ingest_sirene(
+    path=SIRENE_PATH, output_path=OUTPUT_PATH, jobs=None, force=False, manifest_path=MANIFEST_PATH
+):
+    """
+    Write the number of cultural establishments per commune.
+
+    The step is skipped when the manifest shows that its input did not change.
+
+    Args:
+        path (str): StockEtablissement CSV file, or zip archive
+        output_path (str): Output table
+        jobs (int): Number of worker processes, defaults to the CPU count
+        force (bool): Count even if the output is up to date
+        manifest_path (str): Path of the data manifest
+
+    Returns:
+        dict: Number of "lines" read, of "communes" and of "establishments"
+            counted, and whether the step was "skipped"
+    """
+    manifest = load_manifest(manifest_path)
+    signature = step_signature(
+        manifest, [path], params={"naf": CULTURAL_NAF_CODES}, code=[__file__], manifest_path=manifest_path
+    )
+    if not force and is_up_to_date(manifest, STEP, signature, [output_path], manifest_path=manifest_path):
+        save_manifest(manifest, manifest_path)
+        return dict(manifest["steps"][STEP]["stats"], skipped=True)
+
+    table, lines = count_establishments(path, jobs)
+    write_table(table, output_path, SIRENE_SCHEMA)
+    stats = {
+        "lines": lines,
+        "communes": len(table),
+        "establishments": int(np.sum(table["etablissements_culturels"])),
+    }
+    record_step(manifest, STEP, signature, [output_path], stats=stats, manifest_path=manifest_path)
+    save_manifest(manifest, manifest_path)
+    return dict(stats, skipped=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Count the cultural establishments of Sirene per commune.")
+    parser.add_argument("--path", default=SIRENE_PATH, help="StockEtablissement CSV file or zip archive")
+    parser.add_argument("--jobs", type=int, help="Worker processes, the CPU count by default")
+    parser.add_argument("--force", action="store_true", help="Count even if up to date")
+    args = parser.parse_args()
+    stats = ingest_sirene(args.path, jobs=args.jobs, force=args.force)
+    if stats["skipped"]:
+        print("Sirene counts are up to date, nothing to do.")
+    print(
+        f"{stats['establishments']} cultural establishments in {stats['communes']} communes, "
+        f"from {stats['lines']} lines"
+    )
@@ -0,0 +1,295 @@
+"""In-memory spatial index over equipment coordinates."""
+
+import numpy as np
+
+# Mean Earth radius
+EARTH_RADIUS_KM = 6371.0088
+
+
+def haversine_km(latitude1, longitude1, latitude2, longitude2):
+    """Great-circle distance in km between points given in degrees."""
+    latitude1, longitude1, latitude2, longitude2 = map(
+        np.radians, (latitude1, longitude1, latitude2, longitude2)
+    )
+    a = (
+        np.sin((latitude2 - latitude1) / 2) ** 2
+        + np.cos(latitude1) * np.cos(latitude2) * np.sin((longitude2 - longitude1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+
+def radius_bounds(latitude, longitude, radius_km):
+    """
+    Get the boxes holding the circles of a radius around points.
+
+    Returns:
+        tuple: (south, west, north, east) arrays in degrees
+    """
+    latitude = np.asarray(latitude, dtype="float64")
+    longitude = np.asarray(longitude, dtype="float64")
+    delta = np.degrees(radius_km / EARTH_RADIUS_KM)
+    # Longitudes span the most at the latitude of the box edge closest to a pole
+    widest = np.radians(np.minimum(np.abs(latitude) + delta, 90))
+    with np.errstate(divide="ignore"):
+        lon_delta = np.where(widest < np.pi / 2, delta / np.cos(widest), 180)
+    return latitude - delta, longitude - lon_delta, latitude + delta, longitude + lon_delta
+
+
+class GridIndex:
+    """
+    Packed uniform grid over latitude/longitude.
+
+    Points are sorted by grid cell and each occupied cell stores the offset
+    of its first point (CSR layout), so the points of a row of cells are one
+    contiguous slice and a bounding-box query costs one slice per grid row.
+    Only the occupied cells are stored, found by bisection, so memory does
+    not grow with the extent of the grid: points spread from mainland
+    France to the overseas departments do not allocate the empty ocean
+    between them.
+
+    Args:
+        latitude (array-like): Latitudes in degrees
+        longitude (array-like): Longitudes in degrees
+        cell_size (float): Cell size in degrees
+    """
+
+    def __init__(self, latitude, longitude, cell_size=0.05):
+        latitude = np.asarray(latitude, dtype="float64")
+        longitude = np.asarray(longitude, dtype="float64")
+        valid = np.flatnonzero(~(np.isnan(latitude) | np.isnan(longitude)))
+        self.cell_size = cell_size
+        self.size = len(latitude)
+        if len(valid):
+            self.south = latitude[valid].min()
+            self.west = longitude[valid].min()
+            self.n_rows = int((latitude[valid].max() - self.south) // cell_size) + 1
+            self.n_cols = int((longitude[valid].max() - self.west) // cell_size) + 1
+        else:
+            self.south = self.west = 0.0
+            self.n_rows = self.n_cols = 0
+
+        cells = self._cell_rows(latitude[valid]) * self.n_cols + self._cell_cols(
+            longitude[valid]
+        )
+        order = np.argsort(cells, kind="stable")
+        self.positions = valid[order]
+        self.latitude = latitude[self.positions]
+        self.longitude = longitude[self.positions]
+        self.cells, starts = np.unique(cells[order], return_index=True)
+        self.starts = np.append(starts, len(valid))
+        self._cos_latitude = np.cos(np.radians(self.latitude))
+
+    def _cell_rows(self, latitude):
+        rows = (np.asarray(latitude) - self.south) // self.cell_size
+        return np.clip(rows, 0, max(self.n_rows - 1, 0)).astype("int64")
+
+    def _cell_cols(self, longitude):
+        cols = (np.asarray(longitude) - self.west) // self.cell_size
+        return np.clip(cols, 0, max(self.n_cols - 1, 0)).astype("int64")
+
+    def _cell_starts(self, cells):
+        """Get the sorted-order slot of the first point of each cell, or of the next occupied one."""
+        return self.starts[np.searchsorted(self.cells, cells)]
+
+    def candidates(self, south, west, north, east):
+        """Get the sorted-order slots of the points in the cells covering a box."""
+        if self.n_rows == 0 or north < self.south or east < self.west:
+            return np.empty(0, dtype="int64")
+        rows = np.arange(self._cell_rows(south), self._cell_rows(north) + 1)
+        first_col, last_col = self._cell_cols(west), self._cell_cols(east)
+        starts = self._cell_starts(rows * self.n_cols + first_col)
+        stops = self._cell_starts(rows * self.n_cols + last_col + 1)
+        lengths = stops - starts
+        if lengths.sum() == 0:
+            return np.empty(0, dtype="int64")
+        # Concatenate the per-row ranges without a Python loop
+        shifts = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        return shifts + np.arange(lengths.sum())
+
+    def query_bbox(self, south, west, north, east):
+        """
+        Find the points inside a bounding box.
+
+        Args:
+            south (float): Minimum latitude
+            west (float): Minimum longitude
+            north (float): Maximum latitude
+            east (float): Maximum longitude
+
+        Returns:
+            np.ndarray: Sorted positions of the matching points in the input
+        """
+        slots = self.candidates(south, west, north, east)
+        latitude = self.latitude[slots]
+        longitude = self.longitude[slots]
+        inside = (
+            (latitude >= south) & (latitude <= north)
+            & (longitude >= west) & (longitude <= east)
+        )
+        return np.sort(self.positions[slots[inside]])
+
+    def query_radius(self, latitude, longitude, radius_km):
+        """
+        Find the points within a distance of a center.
+
+        Args:
+            latitude (float): Latitude of the center
+            longitude (float): Longitude of the center
+            radius_km (float): Distance in km
+
+        Returns:
+            tuple: (positions in the input, distances in km), nearest first
+        """
+        _, positions, distances = self.query_radius_batch([latitude], [longitude], radius_km)
+        return positions, distances
+
+    def query_radius_batch(self, latitudes, longitudes, radius_km, sort=True, max_pairs=4_000_000):
+        """
+        Find the points within a distance of each of many centers.
+
+        The (center, candidate) pairs of all the centers are built and
+        measured together, at most `max_pairs` at once.
+
+        Args:
+            latitudes (array-like): Latitudes of the centers
+            longitudes (array-like): Longitudes of the centers
+            radius_km (float): Distance in km
+            sort (bool): Order the points of each center nearest first,
+                otherwise they come in no particular order
+            max_pairs (int): Candidate pairs measured at once, which bounds memory
+
+        Returns:
+            tuple: (offsets, positions, distances): the points of center i
+                are positions[offsets[i]:offsets[i + 1]], at distances[...] km
+        """
+        latitudes = np.asarray(latitudes, dtype="float64")
+        longitudes = np.asarray(longitudes, dtype="float64")
+        segment_centers, segment_starts, lengths = self._radius_segments(latitudes, longitudes, radius_km)
+        # Haversine term of the radius, compared before taking any arcsin
+        limit = np.sin(min(radius_km / EARTH_RADIUS_KM, np.pi) / 2) ** 2
+        pair_counts = np.bincount(segment_centers, weights=lengths, minlength=len(latitudes))
+        chunks = (np.cumsum(pair_counts) - pair_counts) // max_pairs
+        boundaries = np.searchsorted(chunks, np.arange(chunks[-1] + 2 if len(chunks) else 1))
+        segment_boundaries = np.searchsorted(segment_centers, boundaries)
+
+        centers, positions, distances = [], [], []
+        for first, last in zip(segment_boundaries[:-1], segment_boundaries[1:]):
+            lengths_chunk = lengths[first:last]
+            total = int(lengths_chunk.sum())
+            if total == 0:
+                continue
+            offsets = np.cumsum(lengths_chunk) - lengths_chunk
+            slots = np.repeat(segment_starts[first:last] - offsets, lengths_chunk) + np.arange(total)
+            pair_centers = np.repeat(segment_centers[first:last], lengths_chunk)
+            center_latitude = np.radians(latitudes[pair_centers])
+            a = (
+                np.sin((np.radians(self.latitude[slots]) - center_latitude) / 2) ** 2
+                + np.cos(center_latitude)
+                * self._cos_latitude[slots]
+                * np.sin(np.radians(self.longitude[slots] - longitudes[pair_centers]) / 2) ** 2
+            )
+            inside = np.flatnonzero(a <= limit)
+            pair_distances = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a[inside]))
+            if sort:
+                # Pairs come grouped by center, so one key orders them by
+                # center then distance, distances being below `span`
+                span = min(radius_km, np.pi * EARTH_RADIUS_KM) + 1
+                order = np.argsort(pair_centers[inside] * span + pair_distances)
+                inside, pair_distances = inside[order], pair_distances[order]
+            centers.append(pair_centers[inside])
+            positions.append(self.positions[slots[inside]])
+            distances.append(pair_distances)
+
+        centers = np.concatenate(centers) if centers else np.empty(0, dtype="int64")
+        positions = np.concatenate(positions) if positions else np.empty(0, dtype="int64")
+        distances = np.concatenate(distances) if distances else np.empty(0, dtype="float64")
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(centers, minlength=len(latitudes)))])
+        return offsets, positions, distances
+
+    def _radius_segments(self, latitudes, longitudes, radius_km):
+        """Get the contiguous slot ranges, one per center and grid row, covering the circles."""
+        if self.n_rows == 0:
+            empty = np.empty(0, dtype="int64")
+            return empty, empty, empty
+        valid = ~(np.isnan(latitudes) | np.isnan(longitudes))
+        south, west, north, east = radius_bounds(
+            np.where(valid, latitudes, 0), np.where(valid, longitudes, 0), radius_km
+        )
+        first_rows, last_rows = self._cell_rows(south), self._cell_rows(north)
+        first_cols, last_cols = self._cell_cols(west), self._cell_cols(east)
+        row_counts = np.where(
+            valid & (north >= self.south) & (east >= self.west), last_rows - first_rows + 1, 0
+        )
+        segment_centers = np.repeat(np.arange(len(latitudes)), row_counts)
+        rows = first_rows[segment_centers] + np.arange(len(segment_centers)) - np.repeat(
+            np.cumsum(row_counts) - row_counts, row_counts
+        )
+        starts = self._cell_starts(rows * self.n_cols + first_cols[segment_centers])
+        stops = self._cell_starts(rows * self.n_cols + last_cols[segment_centers] + 1)
+        return segment_centers, starts, stops - starts
+
+    def query_nearest(self, latitude, longitude, k=10):
+        """
+        Find the k points nearest to a center.
+
+        Returns:
+            tuple: (positions in the input, distances in km), nearest
+                first, fewer than k if the index holds fewer points
+        """
+        positions, distances = self.query_nearest_batch([latitude], [longitude], k)
+        found = positions[0] >= 0
+        return positions[0][found], distances[0][found]
+
+    def query_nearest_batch(self, latitudes, longitudes, k=10):
+        """
+        Find the k points nearest to each of many centers.
+
+        The points within a radius are searched for all the centers, the
+        radius doubling for the centers with fewer than k of them.
+
+        Args:
+            latitudes (array-like): Latitudes of the centers
+            longitudes (array-like): Longitudes of the centers
+            k (int): Number of neighbours
+
+        Returns:
+            tuple: (positions, distances) arrays of shape (centers, k),
+                nearest first, padded with -1 and inf
+        """
+        latitudes = np.asarray(latitudes, dtype="float64")
+        longitudes = np.asarray(longitudes, dtype="float64")
+        positions = np.full((len(latitudes), k), -1, dtype="int64")
+        distances = np.full((len(latitudes), k), np.inf)
+        k_found = min(k, len(self.positions))
+        pending = np.flatnonzero(~(np.isnan(latitudes) | np.isnan(longitudes)))
+        # Start from the radius of a cell, doubling up to half the circumference
+        radius_km = np.radians(self.cell_size) * EARTH_RADIUS_KM
+        while len(pending) and k_found:
+            offsets, found, found_distances = self.query_radius_batch(
+                latitudes[pending], longitudes[pending], radius_km
+            )
+            counts = np.diff(offsets)
+            done = (counts >= k_found) | (radius_km >= np.pi * EARTH_RADIUS_KM)
+            slots = offsets[:-1][done, None] + np.arange(k_found)
+            positions[pending[done], :k_found] = found[slots]
+            distances[pending[done], :k_found] = found_distances[slots]
+            pending = pending[~done]
+            radius_km *= 2
+        return positions, distances
+
+
+def expand_bounds(south, west, north, east, margin=0.5):
+    """Grow a bounding box by `margin` times its size on each side."""
+    lat_margin = (north - south) * margin
+    lon_margin = (east - west) * margin
+    return south - lat_margin, west - lon_margin, north + lat_margin, east + lon_margin
+
+
+def snap_bounds(south, west, north, east, step=0.25):
+    """Snap a bounding box outward to multiples of `step` degrees."""
+    return (
+        np.floor(south / step) * step,
+        np.floor(west / step) * step,
+        np.ceil(north / step) * step,
+        np.ceil(east / step) * step,
+    )
@@ -0,0 +1,337 @@
+"""Offline tile pyramid of equipments and the local endpoint serving it.
+
+Tiles are compact JSON documents laid out as ``{z}/{x}/{y}.json``. Each one
+holds the equipments of a Web Mercator tile as integer coordinates on a
+4096-unit grid (as in Mapbox Vector Tiles), a type index and an id. The
+tiles of the last zoom level also hold the tooltip fields of their
+equipments: a name, and a row of their own commune table.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+from .clustering import TILE_SIZE, mercator_pixels
+from .columnar import CULTURAL_SCHEMA, read_table, resolve_table
+from .communes import department_codes, normalize_insee_codes
+
+TILE_EXTENT = 4096
+METADATA_FILE = "metadata.json"
+TILE_INDEX_FILE = "tile_index.npz"
+# Response header naming the directory served by start_static_server
+ROOT_HEADER = "X-Static-Root"
+
+
+def equipment_ids(data):
+    """
+    Get stable ids for equipments, independent of their row order.
+
+    Ids are 48-bit hashes of the commune code, name, type and coordinates
+    (rounded to 1e-6 degree against CSV float noise), so they survive partial
+    rebuilds and stay exact as JavaScript numbers.
+    """
+    keys = data[["code_postal", "nom_infrastructure", "type_infrastructure"]].assign(
+        latitude=data["latitude"].round(6), longitude=data["longitude"].round(6)
+    )
+    hashes = pd.util.hash_pandas_object(keys, index=False)
+    return (hashes.to_numpy() >> np.uint64(16)).astype("int64")
+
+
+def build_commune_table(data):
+    """
+    Deduplicate the commune-level fields of the equipments.
+
+    Args:
+        data (pd.DataFrame): Equipments with the columns of cultural_data.csv
+
+    Returns:
+        tuple: (commune row of each equipment, dict of commune columns)
+    """
+    density = data["cultural_density"].astype("float64")
+    fields = pd.DataFrame(
+        {
+            "name": data["nom_commune"].astype("string").fillna(""),
+            "population": data["population"].fillna(0).round().astype("int64"),
+            "density": np.round(density.where(np.isfinite(density), 0), 1),
+            "code": data["code_postal"].astype("string").fillna(""),
+        }
+    )
+    rows = fields.groupby(list(fields.columns), sort=False, dropna=False).ngroup()
+    communes = fields.drop_duplicates()
+    return rows.to_numpy(), {column: communes[column].tolist() for column in communes}
+
+
+def _tile_keys(latitude, longitude, zoom):
+    """Get the tile of each point and its position inside the tile."""
+    x, y = mercator_pixels(latitude, longitude, zoom)
+    n_tiles = 2**zoom
+    tile_x = np.clip(x // TILE_SIZE, 0, n_tiles - 1).astype("int64")
+    tile_y = np.clip(y // TILE_SIZE, 0, n_tiles - 1).astype("int64")
+    local_x = ((x - tile_x * TILE_SIZE) * (TILE_EXTENT / TILE_SIZE)).astype("int32")
+    local_y = ((y - tile_y * TILE_SIZE) * (TILE_EXTENT / TILE_SIZE)).astype("int32")
+    return tile_x << 32 | tile_y, local_x, local_y
+
+
+def _tile_path(out_dir, zoom, key):
+    return os.path.join(out_dir, str(zoom), str(key >> 32), f"{key & 0xFFFFFFFF}.json")
+
+
+def build_zoom_tiles(zoom, columns, out_dir, departments=None, previous=None, attributes=None):
+    """
+    Write the tiles of one zoom level.
+
+    Args:
+        zoom (int): Zoom level
+        columns (dict): latitude, longitude, type, id and department arrays
+        out_dir (str): Root directory of the pyramid
+        departments (list): Only rewrite the tiles touched by these
+            departments, or every tile if None
+        previous (np.ndarray): Tile keys of `departments` in the last build,
+            so that tiles they no longer touch are rewritten too
+        attributes (dict): Tooltip fields to add to the tiles: "name" and
+            "commune" arrays, and the "communes" table of build_commune_table
+
+    Returns:
+        tuple: Unique (tile key, department) pairs of this zoom level
+    """
+    keys, local_x, local_y = _tile_keys(columns["latitude"], columns["longitude"], zoom)
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    tiles, starts = np.unique(sorted_keys, return_index=True)
+    stops = np.append(starts[1:], len(sorted_keys))
+
+    pairs = pd.DataFrame({"key": keys, "department": columns["department"]})
+    pairs = pairs.drop_duplicates()
+
+    if departments is None:
+        targets = tiles
+    else:
+        touched = pairs.loc[pairs["department"].isin(departments), "key"].to_numpy()
+        targets = np.union1d(touched, previous if previous is not None else [])
+
+    positions = np.searchsorted(tiles, targets)
+    for key, position in zip(targets.tolist(), positions.tolist()):
+        path = _tile_path(out_dir, zoom, key)
+        if position >= len(tiles) or tiles[position] != key:
+            # The tile has become empty
+            if os.path.exists(path):
+                os.remove(path)
+            continue
+        rows = order[starts[position]:stops[position]]
+        tile = {
+            "x": local_x[rows].tolist(),
+            "y": local_y[rows].tolist(),
+            "type": columns["type"][rows].tolist(),
+            "id": columns["id"][rows].tolist(),
+        }
+        if attributes is not None:
+            communes, local = np.unique(attributes["commune"][rows], return_inverse=True)
+            tile["name"] = attributes["name"][rows].tolist()
+            tile["commune"] = local.tolist()
+            tile["communes"] = {
+                field: [values[commune] for commune in communes.tolist()]
+                for field, values in attributes["communes"].items()
+            }
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(tile, f, separators=(",", ":"))
+    return pairs["key"].to_numpy(), pairs["department"].to_numpy(dtype=str)
+
+
+def build_tiles(
+    source="data/cultural_data.parquet",
+    out_dir="static/tiles",
+    min_zoom=5,
+    max_zoom=14,
+    departments=None,
+    workers=None,
+):
+    """
+    Build the equipment tile pyramid, one zoom level per worker process.
+
+    When `departments` is given, only the tiles containing equipments of
+    these departments, before or after the change, are rewritten. A full
+    rebuild is forced if the pyramid has no index yet or if the set of
+    equipment types changed.
+
+    Args:
+        source (str): Path to the cultural_data table
+        out_dir (str): Root directory of the pyramid
+        min_zoom (int): First zoom level
+        max_zoom (int): Last zoom level
+        departments (list): Department codes to rebuild, or None for all
+        workers (int): Number of worker processes, defaults to the CPU count
+
+    Returns:
+        int: Number of zoom levels written
+    """
+    data = read_table(
+        resolve_table(source),
+        [
+            "nom_infrastructure", "type_infrastructure", "code_postal",
+            "latitude", "longitude", "nom_commune", "population", "cultural_density",
+        ],
+        CULTURAL_SCHEMA,
+    )
+    data = data.dropna(subset=["latitude", "longitude"])
+    type_codes, types = pd.factorize(data["type_infrastructure"], sort=True)
+    columns = {
+        "latitude": data["latitude"].to_numpy(),
+        "longitude": data["longitude"].to_numpy(),
+        "type": type_codes.astype("int16"),
+        "id": equipment_ids(data),
+        "department": department_codes(normalize_insee_codes(data["code_postal"]))
+        .fillna("")
+        .to_numpy(dtype=str),
+    }
+    # Only sent to the worker of the last zoom level
+    commune_rows, communes = build_commune_table(data)
+    attributes = {
+        "name": data["nom_infrastructure"].astype(str).to_numpy(),
+        "commune": commune_rows,
+        "communes": communes,
+    }
+    metadata = {
+        "types": [str(name) for name in types],
+        "min_zoom": min_zoom,
+        "max_zoom": max_zoom,
+        "attribute_zoom": max_zoom,
+        "extent": TILE_EXTENT,
+    }
+
+    metadata_path = os.path.join(out_dir, METADATA_FILE)
+    index_path = os.path.join(out_dir, TILE_INDEX_FILE)
+    previous_index = None
+    if departments is not None and os.path.exists(index_path):
+        with open(metadata_path, encoding="utf-8") as f:
+            if json.load(f) == metadata:
+                with np.load(index_path) as saved:
+                    previous_index = {key: saved[key] for key in saved.files}
+    zooms = list(range(min_zoom, max_zoom + 1))
+    if previous_index is None:
+        departments = None
+        for zoom in zooms:
+            shutil.rmtree(os.path.join(out_dir, str(zoom)), ignore_errors=True)
+    os.makedirs(out_dir, exist_ok=True)
+
+    previous = [None] * len(zooms)
+    if departments is not None:
+        touched = np.isin(previous_index["department"], departments)
+        previous = [
+            previous_index["key"][touched & (previous_index["zoom"] == zoom)]
+            for zoom in zooms
+        ]
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(
+                build_zoom_tiles, zoom, columns, out_dir, departments, keys,
+                attributes if zoom == max_zoom else None,
+            )
+            for zoom, keys in zip(zooms, previous)
+        ]
+        results = [future.result() for future in futures]
+
+    np.savez(
+        index_path,
+        zoom=np.concatenate([np.full(len(keys), zoom) for zoom, (keys, _) in zip(zooms, results)]),
+        key=np.concatenate([keys for keys, _ in results]),
+        department=np.concatenate([deps for _, deps in results]),
+    )
+    with open(metadata_path, "w", encoding="utf-8") as f:
+        json.dump(metadata, f, ensure_ascii=False)
+    return len(zooms)
+
+
+def load_tile_metadata(out_dir="static/tiles"):
+    """Load the metadata of a built pyramid, or None if there is none."""
+    path = os.path.join(out_dir, METADATA_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def static_root_id(root):
+    """Identify a served directory, without disclosing its path."""
+    return hashlib.sha1(os.path.abspath(root).encode("utf-8")).hexdigest()[:16]
+
+
+class StaticRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Serve static files with CORS headers and without request logging.
+
+    Every response names the served directory with static_root_id, so that
+    a server found on a busy port can be recognized.
+    """
+
+    def end_headers(self):
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Cache-Control", "public, max-age=3600")
+        self.send_header(ROOT_HEADER, static_root_id(self.directory))
+        super().end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _served_root(host, port):
+    """Get the static_root_id of the server listening on a port, None if it is not one of ours."""
+    probe_host = "127.0.0.1" if host in ("", "0.0.0.0") else host
+    request = urllib.request.Request(f"http://{probe_host}:{port}/", method="HEAD")
+    try:
+        with urllib.request.urlopen(request, timeout=2) as response:
+            return response.headers.get(ROOT_HEADER)
+    except urllib.error.HTTPError as error:
+        return error.headers.get(ROOT_HEADER)
+    except (OSError, ValueError):
+        return None
+
+
+def start_static_server(root="static", host="127.0.0.1", port=8765):
+    """
+    Serve a directory over HTTP from a daemon thread.
+
+    If the port is already taken by a server of this module serving the
+    same directory (for instance started by another Streamlit process), it
+    is reused.
+
+    Returns:
+        str: Base URL of the server
+
+    Raises:
+        RuntimeError: If the port is taken by anything else
+    """
+    handler = partial(StaticRequestHandler, directory=os.path.abspath(root))
+    try:
+        server = ThreadingHTTPServer((host, port), handler)
+    except OSError as error:
+        if _served_root(host, port) != static_root_id(root):
+            raise RuntimeError(
+                f"Cannot serve {root} on {host}:{port}, the port is used by another process"
+            ) from error
+        return f"http://{host}:{port}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://{host}:{port}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the equipment tile pyramid.")
+    parser.add_argument("--source", default="data/cultural_data.parquet")
+    parser.add_argument("--out-dir", default="static/tiles")
+    parser.add_argument("--departments", nargs="*", help="Only rebuild these departments")
+    parser.add_argument("--workers", type=int)
+    args = parser.parse_args()
+    build_tiles(args.source, args.out_dir, departments=args.departments, workers=args.workers)
+    print(f"Tiles written to {args.out_dir}")
@@ -0,0 +1,351 @@
+"""Data preparation pipeline.
+
+Every preparation stage is declared with the files it reads and writes; a
+stage runs once the stages writing its inputs are done, and independent
+stages run in parallel, each in a fresh worker process. Stages skip their
+own work when their outputs are up to date. At the end, the time and peak
+memory of each stage are reported.
+
+Run with ``python -m cultural_map.pipeline`` from the repository root, with
+``PYTHONPATH=src``. The notebooks building the raw inputs stay manual.
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import NamedTuple
+
+from .config.settings import (
+    CLUSTER_CONFIG,
+    DATABASE_CONFIG,
+    DENSITY_RASTER_CONFIG,
+    MAP_CONFIG,
+    TILE_CONFIG,
+)
+from .data import accessibility, merge_categories, osm, prepare_data, sirene, tiles
+from .data.clustering import build_cluster_index, load_cluster_index, save_cluster_index
+from .data.columnar import CULTURAL_SCHEMA, read_table
+from .data.convert_coordinates import convert_coordinates
+from .data.database import build_database, open_database
+from .data.density_raster import METADATA_FILE, build_density_rasters, load_density_metadata
+from .data.heatmap_visualization import path_score, scores_communes
+from .data.manifest import (
+    MANIFEST_PATH,
+    is_up_to_date,
+    load_manifest,
+    record_step,
+    save_manifest,
+    step_signature,
+)
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+class Stage(NamedTuple):
+    """
+    A pipeline stage: a function taking a `force` argument, and its files.
+
+    Optional inputs are used when present: the stage waits for the stages
+    writing them, but still runs when they are missing or were skipped.
+    """
+
+    name: str
+    function: object
+    inputs: tuple
+    outputs: tuple
+    optional: tuple = ()
+
+
+def build_clusters(
+    source=prepare_data.CULTURAL_OUTPUT_PATH, path=CLUSTER_CONFIG["INDEX_PATH"], force=False
+):
+    """Build the per-zoom cluster index, unless it is newer than its source."""
+    if not force and load_cluster_index(path, source=source) is not None:
+        print("Cluster index is up to date.")
+        return
+    data = read_table(
+        source, ["latitude", "longitude", "categorie", "type_infrastructure"], CULTURAL_SCHEMA
+    )
+    index = build_cluster_index(
+        data,
+        min_zoom=CLUSTER_CONFIG["MIN_ZOOM"],
+        max_zoom=CLUSTER_CONFIG["MAX_ZOOM"],
+        radius=CLUSTER_CONFIG["RADIUS_PX"],
+    )
+    save_cluster_index(index, path, source=source)
+
+
+def build_equipment_database(
+    source=prepare_data.CULTURAL_OUTPUT_PATH, path=DATABASE_CONFIG["PATH"], force=False
+):
+    """Build the equipment database, unless it is newer than its source."""
+    database = None if force else open_database(path, source=source, size=1)
+    if database is not None:
+        database.close()
+        print("Equipment database is up to date.")
+        return
+    build_database(source, path, DATABASE_CONFIG["CELL_SIZE"])
+
+
+def build_density(source=prepare_data.HEATMAP_OUTPUT_PATH, force=False):
+    """Build the density rasters, unless they are newer than their source."""
+    out_dir = DENSITY_RASTER_CONFIG["DIR"]
+    if not force and load_density_metadata(out_dir, source=source) is not None:
+        print("Density rasters are up to date.")
+        return
+    build_density_rasters(
+        source,
+        out_dir,
+        bounds=(MAP_CONFIG["FRANCE_SW"], MAP_CONFIG["FRANCE_NE"]),
+        min_zoom=DENSITY_RASTER_CONFIG["MIN_ZOOM"],
+        max_zoom=DENSITY_RASTER_CONFIG["MAX_ZOOM"],
+        radius=DENSITY_RASTER_CONFIG["RADIUS_PX"],
+        blur=DENSITY_RASTER_CONFIG["BLUR_PX"],
+        min_opacity=DENSITY_RASTER_CONFIG["MIN_OPACITY"],
+        max_opacity=DENSITY_RASTER_CONFIG["MAX_OPACITY"],
+    )
+
+
+def build_tile_pyramid(
+    source=prepare_data.CULTURAL_OUTPUT_PATH, force=False, manifest_path=MANIFEST_PATH
+):
+    """Build the equipment tile pyramid, unless the manifest shows it is up to date."""
+    out_dir = TILE_CONFIG["DIR"]
+    outputs = [os.path.join(out_dir, tiles.METADATA_FILE), os.path.join(out_dir, tiles.TILE_INDEX_FILE)]
+    manifest = load_manifest(manifest_path)
+    signature = step_signature(
+        manifest,
+        [source],
+        params={"min_zoom": TILE_CONFIG["MIN_ZOOM"], "max_zoom": TILE_CONFIG["MAX_ZOOM"]},
+        code=[tiles.__file__],
+        manifest_path=manifest_path,
+    )
+    if not force and is_up_to_date(manifest, "tiles", signature, outputs, manifest_path=manifest_path):
+        save_manifest(manifest, manifest_path)
+        print("Tile pyramid is up to date.")
+        return
+    tiles.build_tiles(source, out_dir, TILE_CONFIG["MIN_ZOOM"], TILE_CONFIG["MAX_ZOOM"])
+    record_step(manifest, "tiles", signature, outputs, manifest_path=manifest_path)
+    save_manifest(manifest, manifest_path)
+
+
+STAGES = [
+    Stage("osm", osm.update_osm, (osm.EXTRACT_PATH,), (osm.FEATURES_PATH, osm.WAY_NODES_PATH)),
+    Stage("sirene", sirene.ingest_sirene, (sirene.SIRENE_PATH,), (sirene.OUTPUT_PATH,)),
+    Stage(
+        "merge_categories",
+        merge_categories.merge_categories,
+        (merge_categories.COMMUNES_PATH, merge_categories.CATEGORIES_PATH),
+        (merge_categories.OUTPUT_PATH,),
+    ),
+    Stage(
+        "convert_coordinates",
+        convert_coordinates,
+        (prepare_data.EQUIPMENTS_PATH,),
+        (prepare_data.EQUIPMENTS_PATH,),
+    ),
+    Stage(
+        "heatmap_score",
+        scores_communes,
+        (prepare_data.HEATMAP_SOURCE_PATH,),
+        (path_score,),
+    ),
+    Stage(
+        "prepare_data",
+        prepare_data.transform_data,
+        (prepare_data.EQUIPMENTS_PATH, prepare_data.HEATMAP_SOURCE_PATH),
+        (
+            prepare_data.CULTURAL_OUTPUT_PATH,
+            prepare_data.HEATMAP_OUTPUT_PATH,
+            prepare_data.COMMUNES_PATH,
+        ),
+        (prepare_data.OSM_EQUIPMENTS_PATH,),
+    ),
+    Stage(
+        "cluster_index",
+        build_clusters,
+        (prepare_data.CULTURAL_OUTPUT_PATH,),
+        (CLUSTER_CONFIG["INDEX_PATH"],),
+    ),
+    Stage(
+        "tiles",
+        build_tile_pyramid,
+        (prepare_data.CULTURAL_OUTPUT_PATH,),
+        (os.path.join(TILE_CONFIG["DIR"], tiles.METADATA_FILE),),
+    ),
+    Stage(
+        "database",
+        build_equipment_database,
+        (prepare_data.CULTURAL_OUTPUT_PATH,),
+        (DATABASE_CONFIG["PATH"],),
+    ),
+    Stage(
+        "accessibility",
+        accessibility.build_accessibility,
+        (prepare_data.CULTURAL_OUTPUT_PATH, prepare_data.COMMUNES_PATH),
+        (accessibility.OUTPUT_PATH,),
+    ),
+    Stage(
+        "density_rasters",
+        build_density,
+        (prepare_data.HEATMAP_OUTPUT_PATH,),
+        (os.path.join(DENSITY_RASTER_CONFIG["DIR"], METADATA_FILE),),
+    ),
+]
+
+
+def dependencies(stages, optional=True):
+    """
+    Get the stages each stage waits for: those writing one of its inputs.
+
+    A stage rewriting its own input in place does not depend on itself.
+
+    Args:
+        stages (list): Stages of the pipeline
+        optional (bool): Include the stages writing the optional inputs
+
+    Returns:
+        dict: Names of the stages each stage depends on
+    """
+    writers = {}
+    for stage in stages:
+        for path in stage.outputs:
+            writers.setdefault(path, set()).add(stage.name)
+    return {
+        stage.name: set().union(
+            *(writers.get(path, set()) for path in stage.inputs + (stage.optional if optional else ()))
+        )
+        - {stage.name}
+        for stage in stages
+    }
+
+
+def missing_inputs(stages):
+    """Get the inputs no other stage writes and that do not exist, per stage."""
+    written = {}
+    for stage in stages:
+        for path in stage.outputs:
+            written.setdefault(path, set()).add(stage.name)
+    return {
+        stage.name: [
+            path
+            for path in stage.inputs
+            if not written.get(path, set()) - {stage.name} and not os.path.exists(path)
+        ]
+        for stage in stages
+    }
+
+
+def _peak_mb():
+    if resource is None:
+        return None
+    # Largest of this process and of the worker processes it waited for
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / 1024
+
+
+def _run_stage(function, force):
+    """Run a stage in a worker process and measure it."""
+    start = time.perf_counter()
+    function(force=force)
+    return time.perf_counter() - start, _peak_mb()
+
+
+def _entry(name, status, seconds=None, peak_mb=None, detail=""):
+    return {"stage": name, "status": status, "seconds": seconds, "peak_mb": peak_mb, "detail": detail}
+
+
+def run_pipeline(stages=STAGES, jobs=None, force=False):
+    """
+    Run the stages in dependency order, independent ones in parallel.
+
+    A stage whose inputs are missing, which depends on a stage that failed,
+    or on a skipped stage writing one of its required inputs, is skipped.
+
+    Args:
+        stages (list): Stages to run
+        jobs (int): Number of worker processes, defaults to the CPU count
+        force (bool): Rerun every stage even if up to date
+
+    Returns:
+        list: Report of each stage: "stage", "status" ("done", "failed" or
+            "skipped"), "seconds", "peak_mb" and "detail"
+    """
+    waiting = dependencies(stages)
+    required = dependencies(stages, optional=False)
+    missing = missing_inputs(stages)
+    by_name = {stage.name: stage for stage in stages}
+    report = {}
+    running = {}
+    # A fresh process per stage, so that its peak memory is its own
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(jobs, mp_context=context, max_tasks_per_child=1) as pool:
+        while len(report) < len(stages):
+            for name, needed in waiting.items():
+                if name in report or name in running.values():
+                    continue
+                failed = sorted(
+                    other
+                    for other in needed
+                    if other in report
+                    and report[other]["status"] != "done"
+                    and (report[other]["status"] == "failed" or other in required[name])
+                )
+                if missing[name]:
+                    report[name] = _entry(name, "skipped", detail=f"missing {', '.join(missing[name])}")
+                elif failed:
+                    report[name] = _entry(name, "skipped", detail=f"after {', '.join(failed)}")
+                elif all(other in report for other in needed):
+                    print(f"[{name}] started")
+                    running[pool.submit(_run_stage, by_name[name].function, force)] = name
+                    continue
+                else:
+                    continue
+                print(f"[{name}] skipped: {report[name]['detail']}")
+            if not running:
+                if len(report) < len(stages):
+                    raise ValueError(f"Cyclic stage dependencies: {sorted(set(by_name) - set(report))}")
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    report[name] = _entry(name, "done", *future.result())
+                except Exception as error:
+                    report[name] = _entry(name, "failed", detail=repr(error))
+                print(f"[{name}] {report[name]['status']}")
+    return [report[stage.name] for stage in stages]
+
+
+def print_report(report, wall_seconds):
+    """Print the time and peak memory of each stage."""
+    print(f"{'stage':>20} {'status':>8} {'seconds':>8} {'peak MB':>8}  detail")
+    for row in report:
+        seconds = "" if row["seconds"] is None else f"{row['seconds']:.2f}"
+        peak_mb = "" if row["peak_mb"] is None else f"{row['peak_mb']:.0f}"
+        print(f"{row['stage']:>20} {row['status']:>8} {seconds:>8} {peak_mb:>8}  {row['detail']}")
+    total = sum(row["seconds"] or 0 for row in report)
+    print(f"{wall_seconds:.2f} s elapsed for {total:.2f} s of stage time")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the data preparation pipeline.")
+    parser.add_argument("stages", nargs="*", metavar="stage", help=", ".join(stage.name for stage in STAGES))
+    parser.add_argument("--jobs", type=int, help="Worker processes, the CPU count by default")
+    parser.add_argument("--force", action="store_true", help="Rerun every stage even if up to date")
+    args = parser.parse_args()
+    selected = [stage for stage in STAGES if not args.stages or stage.name in args.stages]
+    start = time.perf_counter()
+    report = run_pipeline(selected, args.jobs, args.force)
+    print_report(report, time.perf_counter() - start)
+    sys.exit(any(row["status"] == "failed" for row in report))